@@ -18,6 +18,7 @@ from . import results_report
 from . import stock
 from . import uom
 from . import party
+from . import mail
 
 
 def register():
@@ -69,6 +70,7 @@ def register():
         analysis.CalculatedTypificationReadOnly,
         sample.PackagingType,
         analysis.AnalysisIncluded,
+        analysis.AnalysisIncludedClosure,
         analysis.AnalysisDevice,
         certification.CertificationType,
         certification.TechnicalScope,
@@ -102,6 +104,7 @@ def register():
         results_report.ResultsReportVersion,
         results_report.ResultsReportVersionDetail,
         results_report.ResultsReportCachedReport,
+        results_report.ResultsReportGlobalReport,
         results_report.ResultsReportComment,
         results_report.ResultsReportVersionDetailSigner,
         results_report.ResultsReportVersionDetailCertification,
@@ -266,6 +269,8 @@ def register():
         party.Address,
         party.Company,
         party.Employee,
+        mail.MailOutbox,
+        mail.MailOutboxOrigin,
         notebook.PrintAnalysisCheckedPendingInformStart,
         planification.Planification,
         planification.PlanificationTechnician,
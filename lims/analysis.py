@@ -20,6 +20,8 @@ from trytond.transaction import Transaction
 from trytond.pyson import PYSONEncoder, Eval, Equal, Bool, Not, Or, And
 from trytond.exceptions import UserError
 from trytond.i18n import gettext
+from trytond import backend
+from .tools import id_set_clause
 
 FUNCTIONS = formulas.get_functions()
 
@@ -1264,100 +1266,78 @@ class Analysis(Workflow, ModelSQL, ModelView):
             ]
 
     @classmethod
-    def get_included_analysis(cls, analysis_id):
+    def get_included_paths(cls, analysis_id, analysis_type=None):
+        '''
+        Returns the (path, analysis, analysis type, included analysis,
+        included analysis type, included analysis code, method) of every
+        inclusion path that starts in the analysis, in depth-first order
+        '''
         cursor = Transaction().connection.cursor()
         pool = Pool()
         AnalysisIncluded = pool.get('lims.analysis.included')
+        AnalysisIncludedClosure = pool.get('lims.analysis.included.closure')
+
+        type_where = ''
+        params = [analysis_id]
+        if analysis_type:
+            type_where = 'AND a.type = %s '
+            params.append(analysis_type)
+        cursor.execute('SELECT c.path, ia.analysis, pa.type, '
+                'c.included_analysis, a.type, a.code, ia.method '
+            'FROM "' + AnalysisIncludedClosure._table + '" c '
+                'INNER JOIN "' + AnalysisIncluded._table + '" ia '
+                'ON ia.id = c.included '
+                'INNER JOIN "' + cls._table + '" pa '
+                'ON pa.id = ia.analysis '
+                'INNER JOIN "' + cls._table + '" a '
+                'ON a.id = c.included_analysis '
+            'WHERE c.analysis = %s ' +
+                type_where +
+            'ORDER BY CAST(STRING_TO_ARRAY(c.path, \'/\') AS integer[])',
+            params)
+        return cursor.fetchall()
 
-        childs = []
-        cursor.execute('SELECT included_analysis '
-            'FROM "' + AnalysisIncluded._table + '" '
-            'WHERE analysis = %s', (analysis_id,))
-        included_analysis_ids = [x[0] for x in cursor.fetchall()]
-        for analysis_id in included_analysis_ids:
-            if analysis_id not in childs:
-                childs.append(analysis_id)
-                childs.extend(cls.get_included_analysis(analysis_id))
-        return childs
+    @classmethod
+    def get_included_analysis(cls, analysis_id):
+        paths = cls.get_included_paths(analysis_id)
+        return list(dict.fromkeys(p[3] for p in paths))
 
     @classmethod
     def get_included_analysis_analysis(cls, analysis_id):
-        cursor = Transaction().connection.cursor()
-        pool = Pool()
-        AnalysisIncluded = pool.get('lims.analysis.included')
-        Analysis = pool.get('lims.analysis')
-
-        childs = []
-        cursor.execute('SELECT ia.included_analysis, a.type '
-            'FROM "' + AnalysisIncluded._table + '" ia '
-                'INNER JOIN "' + Analysis._table + '" a '
-                'ON a.id = ia.included_analysis '
-            'WHERE analysis = %s', (analysis_id,))
-        included_analysis = cursor.fetchall()
-        for analysis in included_analysis:
-            if analysis[1] == 'analysis' and analysis[0] not in childs:
-                childs.append(analysis[0])
-            childs.extend(cls.get_included_analysis_analysis(analysis[0]))
-        return childs
+        paths = cls.get_included_paths(analysis_id, 'analysis')
+        return list(dict.fromkeys(p[3] for p in paths))
 
     @classmethod
     def get_included_analysis_method(cls, analysis_id):
-        cursor = Transaction().connection.cursor()
-        pool = Pool()
-        AnalysisIncluded = pool.get('lims.analysis.included')
-
-        childs = []
-        cursor.execute('SELECT included_analysis, method '
-            'FROM "' + AnalysisIncluded._table + '" '
-            'WHERE analysis = %s', (analysis_id,))
-        included_analysis = cursor.fetchall()
-        for analysis in included_analysis:
-            if analysis not in childs:
-                childs.append(analysis)
-            childs.extend(cls.get_included_analysis_method(analysis[0]))
-        return childs
+        paths = cls.get_included_paths(analysis_id)
+        return list(dict.fromkeys((p[3], p[6]) for p in paths))
 
     @classmethod
     def get_included_analysis_analysis_method(cls, analysis_id):
-        cursor = Transaction().connection.cursor()
-        pool = Pool()
-        AnalysisIncluded = pool.get('lims.analysis.included')
-        Analysis = pool.get('lims.analysis')
-
-        childs = []
-        cursor.execute('SELECT ia.included_analysis, ia.method, a.type '
-            'FROM "' + AnalysisIncluded._table + '" ia '
-                'INNER JOIN "' + Analysis._table + '" a '
-                'ON a.id = ia.included_analysis '
-            'WHERE analysis = %s', (analysis_id,))
-        included_analysis = cursor.fetchall()
-        for analysis in included_analysis:
-            if analysis[2] == 'analysis' and analysis[:2] not in childs:
-                childs.append(analysis[:2])
-            childs.extend(cls.get_included_analysis_analysis_method(
-                analysis[0]))
-        return childs
+        paths = cls.get_included_paths(analysis_id, 'analysis')
+        return list(dict.fromkeys((p[3], p[6]) for p in paths))
 
     @classmethod
     def get_parents_analysis(cls, analysis_id):
         cursor = Transaction().connection.cursor()
         pool = Pool()
         AnalysisIncluded = pool.get('lims.analysis.included')
-        Analysis = pool.get('lims.analysis')
-
-        parents = []
-        cursor.execute('SELECT ia.analysis '
-            'FROM "' + AnalysisIncluded._table + '" ia '
-                'INNER JOIN "' + Analysis._table + '" a '
-                'ON a.id = ia.analysis '
-            'WHERE ia.included_analysis = %s '
-                'AND a.state = \'active\'', (analysis_id,))
-        parents_analysis_ids = [x[0] for x in cursor.fetchall()]
-        for analysis_id in parents_analysis_ids:
-            if analysis_id not in parents:
-                parents.append(analysis_id)
-                parents.extend(cls.get_parents_analysis(analysis_id))
-        return parents
+        AnalysisIncludedClosure = pool.get('lims.analysis.included.closure')
+
+        # Only the analysis reached through active analysis are parents
+        cursor.execute('SELECT DISTINCT c.analysis '
+            'FROM "' + AnalysisIncludedClosure._table + '" c '
+            'WHERE c.included_analysis = %s '
+                'AND NOT EXISTS ('
+                    'SELECT 1 '
+                    'FROM "' + AnalysisIncluded._table + '" ia '
+                        'INNER JOIN "' + cls._table + '" a '
+                        'ON a.id = ia.analysis '
+                    'WHERE ia.id = ANY(CAST('
+                            'STRING_TO_ARRAY(c.path, \'/\') AS integer[])) '
+                        'AND a.state != \'active\')',
+            (analysis_id,))
+        return [x[0] for x in cursor.fetchall()]
 
     def get_rec_name(self, name):
         if self.code:
@@ -1474,6 +1454,22 @@ class Analysis(Workflow, ModelSQL, ModelView):
                         vals['description'], a.id)
         super().write(*args)
 
+    @classmethod
+    def delete(cls, analysis):
+        cursor = Transaction().connection.cursor()
+        AnalysisIncludedClosure = Pool().get('lims.analysis.included.closure')
+
+        analysis_ids = [a.id for a in analysis]
+        included_clause, included_params = id_set_clause(
+            'included_analysis', analysis_ids)
+        cursor.execute('SELECT DISTINCT analysis '
+            'FROM "' + AnalysisIncludedClosure._table + '" '
+            'WHERE ' + included_clause, included_params)
+        parents_ids = set(x[0] for x in cursor.fetchall())
+        super().delete(analysis)
+        AnalysisIncludedClosure.update_closure(
+            parents_ids.difference(analysis_ids))
+
     @classmethod
     @ModelView.button_action('lims.wiz_lims_relate_analysis')
     def relate_analysis(cls, analysis):
@@ -1533,12 +1529,13 @@ class Analysis(Workflow, ModelSQL, ModelView):
                     if t_set_group:
                         CalculatedTypification.delete(t_set_group)
                     continue
-                included_ids = ', '.join(str(a[0]) for a in ia)
+                included_clause, included_params = id_set_clause(
+                    'analysis', [a[0] for a in ia])
 
                 cursor.execute('SELECT DISTINCT(product_type, matrix) '
                     'FROM "' + Typification._table + '" '
                     'WHERE valid '
-                        'AND analysis IN (' + included_ids + ')')
+                        'AND ' + included_clause, included_params)
                 typifications = cursor.fetchall()
                 if not typifications:
                     t_set_group = CalculatedTypification.search([
@@ -1838,7 +1835,8 @@ class Analysis(Workflow, ModelSQL, ModelView):
         dates_where += ('AND srv.confirmation_date::date <= \'%s\'::date ' %
             date_to)
 
-        cursor.execute('SELECT DISTINCT(nl.service) '
+        preplanned_clause, preplanned_params = id_set_clause('srv.id', (
+            'SELECT nl.service '
             'FROM "' + NotebookLine._table + '" nl '
                 'INNER JOIN "' + PlanificationServiceDetail._table +
                 '" psd ON psd.notebook_line = nl.id '
@@ -1846,24 +1844,17 @@ class Analysis(Workflow, ModelSQL, ModelView):
                 'ON psd.detail = pd.id '
                 'INNER JOIN "' + Planification._table + '" p '
                 'ON pd.planification = p.id '
-            'WHERE p.state = \'preplanned\'')
-        planned_services = [s[0] for s in cursor.fetchall()]
-        planned_services_ids = ', '.join(
-            str(s) for s in [0] + planned_services)
-        preplanned_clause = 'AND srv.id NOT IN (%s) ' % planned_services_ids
+            'WHERE p.state = \'preplanned\' '
+                'AND nl.service IS NOT NULL', []), exclude=True)
 
-        cursor.execute('SELECT DISTINCT(d.service) '
+        not_planned_clause, not_planned_params = id_set_clause('srv.id', (
+            'SELECT d.service '
             'FROM "' + EntryDetailAnalysis._table + '" d '
                 'INNER JOIN "' + Analysis._table + '" a '
                 'ON a.id = d.analysis '
             'WHERE d.plannable = TRUE '
                 'AND d.state IN (\'draft\', \'unplanned\') '
-                'AND a.behavior != \'internal_relation\'')
-        not_planned_services = [s[0] for s in cursor.fetchall()]
-        not_planned_services_ids = ', '.join(
-            str(s) for s in [0] + not_planned_services)
-        not_planned_services_clause = ('AND id IN (%s) ' %
-            not_planned_services_ids)
+                'AND a.behavior != \'internal_relation\'', []))
 
         if analysis_ids:
             all_analysis_ids = analysis_ids
@@ -1873,25 +1864,17 @@ class Analysis(Workflow, ModelSQL, ModelView):
 
         res = {}
         for analysis_id in all_analysis_ids:
-            count = 0
-            cursor.execute('SELECT srv.id '
+            cursor.execute('SELECT COUNT(*) '
                 'FROM "' + Service._table + '" srv '
                     'INNER JOIN "' + Fraction._table + '" frc '
                     'ON frc.id = srv.fraction '
                 'WHERE srv.analysis = %s '
                     'AND frc.confirmed = TRUE ' +
-                    dates_where + preplanned_clause,
-                (analysis_id,))
-            pending_services = [s[0] for s in cursor.fetchall()]
-            if pending_services:
-                pending_services_ids = ', '.join(str(s) for s in
-                    pending_services)
-                cursor.execute('SELECT COUNT(*) '
-                    'FROM "' + Service._table + '" '
-                    'WHERE id IN (' + pending_services_ids + ') ' +
-                        not_planned_services_clause)
-                count = cursor.fetchone()[0]
-            res[analysis_id] = count
+                    dates_where +
+                    'AND ' + preplanned_clause + ' '
+                    'AND ' + not_planned_clause,
+                [analysis_id] + preplanned_params + not_planned_params)
+            res[analysis_id] = cursor.fetchone()[0]
         return res
 
     @staticmethod
@@ -2017,10 +2000,27 @@ class AnalysisIncluded(ModelSQL, ModelView):
 
     @classmethod
     def create(cls, vlist):
+        AnalysisIncludedClosure = Pool().get('lims.analysis.included.closure')
         included_analysis = super().create(vlist)
+        AnalysisIncludedClosure.update_closure(
+            [i.analysis.id for i in included_analysis])
         cls.create_typification_calculated(included_analysis)
         return included_analysis
 
+    @classmethod
+    def write(cls, *args):
+        AnalysisIncludedClosure = Pool().get('lims.analysis.included.closure')
+        actions = iter(args)
+        analysis_ids = set()
+        for included_analysis, vals in zip(actions, actions):
+            if 'analysis' in vals or 'included_analysis' in vals:
+                analysis_ids.update(i.analysis.id for i in included_analysis)
+                if vals.get('analysis'):
+                    analysis_ids.add(vals['analysis'])
+        super().write(*args)
+        if analysis_ids:
+            AnalysisIncludedClosure.update_closure(analysis_ids)
+
     @classmethod
     def create_typification_calculated(cls, included_analysis):
         cursor = Transaction().connection.cursor()
@@ -2049,12 +2049,13 @@ class AnalysisIncluded(ModelSQL, ModelView):
                     if t_set_group:
                         CalculatedTypification.delete(t_set_group)
                     continue
-                included_ids = ', '.join(str(a[0]) for a in ia)
+                included_clause, included_params = id_set_clause(
+                    'analysis', [a[0] for a in ia])
 
                 cursor.execute('SELECT DISTINCT(product_type, matrix) '
                     'FROM "' + Typification._table + '" '
                     'WHERE valid '
-                        'AND analysis IN (' + included_ids + ')')
+                        'AND ' + included_clause, included_params)
                 typifications = cursor.fetchall()
                 if not typifications:
                     t_set_group = CalculatedTypification.search([
@@ -2120,8 +2121,11 @@ class AnalysisIncluded(ModelSQL, ModelView):
 
     @classmethod
     def delete(cls, included_analysis):
+        AnalysisIncludedClosure = Pool().get('lims.analysis.included.closure')
+        analysis_ids = set(i.analysis.id for i in included_analysis)
         cls.delete_typification_calculated(included_analysis)
         super().delete(included_analysis)
+        AnalysisIncludedClosure.update_closure(analysis_ids)
 
     @classmethod
     def delete_typification_calculated(cls, included_analysis):
@@ -2160,12 +2164,13 @@ class AnalysisIncluded(ModelSQL, ModelView):
                     if t_set_group:
                         CalculatedTypification.delete(t_set_group)
                     continue
-                included_ids = ', '.join(str(a[0]) for a in ia)
+                included_clause, included_params = id_set_clause(
+                    'analysis', [a[0] for a in ia])
 
                 cursor.execute('SELECT DISTINCT(product_type, matrix) '
                     'FROM "' + Typification._table + '" '
                     'WHERE valid '
-                        'AND analysis IN (' + included_ids + ')')
+                        'AND ' + included_clause, included_params)
                 typifications = cursor.fetchall()
                 if not typifications:
                     t_set_group = CalculatedTypification.search([
@@ -2235,6 +2240,86 @@ class AnalysisIncluded(ModelSQL, ModelView):
             ]
 
 
+class AnalysisIncludedClosure(ModelSQL):
+    'Included Analysis - Closure'
+    __name__ = 'lims.analysis.included.closure'
+
+    analysis = fields.Many2One('lims.analysis', 'Analysis', required=True,
+        ondelete='CASCADE', select=True)
+    included_analysis = fields.Many2One('lims.analysis', 'Included analysis',
+        required=True, ondelete='CASCADE', select=True)
+    included = fields.Many2One('lims.analysis.included', 'Inclusion',
+        required=True, ondelete='CASCADE', select=True)
+    depth = fields.Integer('Depth', required=True)
+    path = fields.Char('Path', required=True)
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.TableHandler
+        closure_table_exist = TableHandler.table_exist(cls._table)
+        super().__register__(module_name)
+        if not closure_table_exist:
+            cls.update_closure()
+
+    @classmethod
+    def update_closure(cls, analysis_ids=None):
+        '''
+        Rebuilds the inclusion paths of the analysis and of all the analysis
+        that include them at any level, or of every analysis if analysis_ids
+        is None. The path is the list of lims.analysis.included ids from
+        the analysis to the included analysis.
+        '''
+        cursor = Transaction().connection.cursor()
+        AnalysisIncluded = Pool().get('lims.analysis.included')
+
+        if analysis_ids is None:
+            cursor.execute('DELETE FROM "' + cls._table + '"')
+            root_clause, root_params = 'TRUE', []
+        else:
+            analysis_ids = set(analysis_ids)
+            if not analysis_ids:
+                return
+            included_clause, included_params = id_set_clause(
+                'included_analysis', analysis_ids)
+            cursor.execute('SELECT DISTINCT analysis '
+                'FROM "' + cls._table + '" '
+                'WHERE ' + included_clause, included_params)
+            analysis_ids.update(x[0] for x in cursor.fetchall())
+            analysis_clause, analysis_params = id_set_clause(
+                'analysis', analysis_ids)
+            cursor.execute('DELETE FROM "' + cls._table + '" '
+                'WHERE ' + analysis_clause, analysis_params)
+            root_clause, root_params = id_set_clause(
+                'ia.analysis', analysis_ids)
+
+        # An analysis is not followed twice in the same path, so cycles
+        # in the included analysis do not loop forever
+        cursor.execute('INSERT INTO "' + cls._table + '" '
+                '(create_uid, create_date, analysis, included_analysis, '
+                'included, depth, path) '
+            'WITH RECURSIVE paths (analysis, included_analysis, included, '
+                    'depth, path, visited) AS ('
+                'SELECT ia.analysis, ia.included_analysis, ia.id, 1, '
+                    'CAST(ia.id AS VARCHAR), '
+                    'ARRAY[ia.analysis, ia.included_analysis] '
+                'FROM "' + AnalysisIncluded._table + '" ia '
+                'WHERE ia.analysis != ia.included_analysis '
+                    'AND ' + root_clause + ' '
+                'UNION ALL '
+                'SELECT p.analysis, ia.included_analysis, ia.id, '
+                    'p.depth + 1, p.path || \'/\' || CAST(ia.id AS VARCHAR), '
+                    'p.visited || ia.included_analysis '
+                'FROM paths p '
+                    'INNER JOIN "' + AnalysisIncluded._table + '" ia '
+                    'ON ia.analysis = p.included_analysis '
+                'WHERE ia.included_analysis != ALL(p.visited)'
+            ') '
+            'SELECT %s, CURRENT_TIMESTAMP, analysis, included_analysis, '
+                'included, depth, path '
+            'FROM paths',
+            root_params + [Transaction().user])
+
+
 class AnalysisLaboratory(ModelSQL, ModelView):
     'Analysis - Laboratory'
     __name__ = 'lims.analysis-laboratory'
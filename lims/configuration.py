@@ -800,6 +800,8 @@ class Cron(metaclass=PoolMeta):
                     "Lims Process Waiting Planification"),
                 ('lims.trend.chart|clean',
                     "Lims Clean Inactive Trend Charts"),
+                ('lims.mail.outbox|send_pending',
+                    "Lims Send Mail Outbox"),
                 ])
 
 
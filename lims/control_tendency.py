@@ -3,11 +3,16 @@
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
 import pandas as pd
+import hashlib
+import json
+import logging
 from io import BytesIO
 from math import sqrt
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
 import matplotlib.pyplot as plt
-import gc
 
+from trytond.config import config
 from trytond.model import ModelView, ModelSQL, fields
 from trytond.wizard import (Wizard, StateTransition, StateView, StateAction,
     StateReport, Button)
@@ -17,6 +22,71 @@ from trytond.transaction import Transaction
 from trytond.report import Report
 from trytond.exceptions import UserError
 from trytond.i18n import gettext
+from .tools import LRUCache
+
+logger = logging.getLogger(__name__)
+
+# Number of rendered trend charts kept in memory
+TREND_CHART_CACHE_SIZE = config.getint('lims', 'trend_chart_cache_size',
+    default=64)
+# Render the trend charts in a background thread once their data is computed
+TREND_CHART_BACKGROUND_RENDER = config.getboolean('lims',
+    'trend_chart_background_render', default=False)
+TREND_CHART_DPI = 300
+TREND_CHART_PREVIEW_DPI = config.getint('lims', 'trend_chart_preview_dpi',
+    default=100)
+
+# pyplot keeps a global state, renders are serialized
+_plot_lock = Lock()
+
+
+class PlotCache(LRUCache):
+    """
+    Process-wide LRU cache of rendered charts. Renders can also be queued
+    to a background thread so the image is already cached when it is
+    requested.
+    """
+
+    def __init__(self, size_limit):
+        super().__init__(size_limit)
+        self._pending = {}
+        self._executor = None
+
+    def get(self, key):
+        image = super().get(key)
+        if image is not None:
+            return image
+        with self._lock:
+            future = self._pending.get(key)
+        if future is not None:
+            try:
+                return future.result()
+            except Exception:
+                logger.warning('Background chart render failed',
+                    exc_info=True)
+        return None
+
+    def submit(self, key, render, *args):
+        with self._lock:
+            if key in self._cache or key in self._pending:
+                return
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1,
+                    thread_name_prefix='lims_trend_chart')
+            self._pending[key] = self._executor.submit(
+                self._render, key, render, *args)
+
+    def _render(self, key, render, *args):
+        try:
+            image = render(*args)
+            self.set(key, image)
+            return image
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+
+
+plot_cache = PlotCache(TREND_CHART_CACHE_SIZE)
 
 
 class RangeType(ModelSQL, ModelView):
@@ -788,58 +858,103 @@ class MeansDeviationsCalc(Wizard):
 
     def _create_lines(self):
         cursor = Transaction().connection.cursor()
-        pool = Pool()
-        ControlResultLine = pool.get('lims.control.result_line')
-        AnalysisFamilyCertificant = pool.get(
+        AnalysisFamilyCertificant = Pool().get(
             'lims.analysis.family.certificant')
-        NotebookLine = pool.get('lims.notebook.line')
 
-        clause = [
-            ('laboratory', '=', self.start.laboratory.id),
-            ('end_date', '>=', self.start.date_from),
-            ('end_date', '<=', self.start.date_to),
-            ('notebook.fraction.type', '=', self.start.fraction_type.id),
-            ('analysis.behavior', '=', 'normal'),
-            ('concentration_level', '!=', None),
-            ('result', 'not in', [None, '']),
-            ('annulled', '=', False),
-            ]
+        query, params = self._get_lines_query(
+            'NULL, s.product_type, s.matrix')
         if self.start.product_type:
-            clause.append(('notebook.product_type', '=',
-                self.start.product_type.id))
+            query += 'AND s.product_type = %s '
+            params.append(self.start.product_type.id)
         if self.start.matrix:
-            clause.append(('notebook.matrix', '=', self.start.matrix.id))
-        if self.start.concentration_level:
-            clause.append(('concentration_level', '=',
-                self.start.concentration_level.id))
+            query += 'AND s.matrix = %s '
+            params.append(self.start.matrix.id)
+        if self.start.family:
+            query += ('AND EXISTS (SELECT 1 '
+                'FROM "' + AnalysisFamilyCertificant._table + '" afc '
+                'WHERE afc.family = %s '
+                    'AND afc.product_type = s.product_type '
+                    'AND afc.matrix = s.matrix) ')
+            params.append(self.start.family.id)
+        cursor.execute(query + 'ORDER BY nl.end_date ASC, nl.id ASC',
+            params)
+        return self._create_result_lines(cursor.fetchall())
 
-        lines = NotebookLine.search(clause,
-            order=[('end_date', 'ASC'), ('id', 'ASC')])
-        if not lines:
-            return []
+    def _create_grouped_lines(self):
+        cursor = Transaction().connection.cursor()
+        AnalysisFamilyCertificant = Pool().get(
+            'lims.analysis.family.certificant')
+
+        join = ('INNER JOIN "' + AnalysisFamilyCertificant._table + '" afc '
+            'ON afc.product_type = s.product_type '
+            'AND afc.matrix = s.matrix ')
+        query, params = self._get_lines_query('afc.family, NULL, NULL', join)
+        if self.start.family:
+            query += 'AND afc.family = %s '
+            params.append(self.start.family.id)
+        cursor.execute(query +
+            'ORDER BY afc.family, nl.end_date ASC, nl.id ASC', params)
+        return self._create_result_lines(cursor.fetchall())
+
+    def _get_lines_query(self, group_columns, join=''):
+        """
+        Returns the query and params to fetch the control results,
+        group_columns are the family, product type and matrix expressions
+        """
+        pool = Pool()
+        NotebookLine = pool.get('lims.notebook.line')
+        Notebook = pool.get('lims.notebook')
+        Fraction = pool.get('lims.fraction')
+        Sample = pool.get('lims.sample')
+        Analysis = pool.get('lims.analysis')
+
+        query = ('SELECT ' + group_columns + ', f.type, nl.analysis, '
+                'nl.concentration_level, nl.end_date, f.id, nl.device, '
+                'nl.result '
+            'FROM "' + NotebookLine._table + '" nl '
+                'INNER JOIN "' + Notebook._table + '" n '
+                'ON n.id = nl.notebook '
+                'INNER JOIN "' + Fraction._table + '" f '
+                'ON f.id = n.fraction '
+                'INNER JOIN "' + Sample._table + '" s '
+                'ON s.id = f.sample '
+                'INNER JOIN "' + Analysis._table + '" a '
+                'ON a.id = nl.analysis ' + join +
+            'WHERE nl.laboratory = %s '
+                'AND nl.end_date >= %s '
+                'AND nl.end_date <= %s '
+                'AND f.type = %s '
+                'AND a.behavior = \'normal\' '
+                'AND nl.concentration_level IS NOT NULL '
+                'AND nl.result IS NOT NULL '
+                'AND nl.result != \'\' '
+                'AND nl.annulled = FALSE ')
+        params = [self.start.laboratory.id, self.start.date_from,
+            self.start.date_to, self.start.fraction_type.id]
+        if self.start.concentration_level:
+            query += 'AND nl.concentration_level = %s '
+            params.append(self.start.concentration_level.id)
+        return query, params
+
+    def _create_result_lines(self, rows):
+        """
+        Creates the result lines with their details from the rows of
+        control results (ordered by date), computing the statistics of
+        each group in a single pass
+        """
+        pool = Pool()
+        ControlResultLine = pool.get('lims.control.result_line')
+        ControlResultLineDetail = pool.get('lims.control.result_line.detail')
 
         range_min = self.start.range_min
         range_max = self.start.range_max
 
-        check_line_family = False
-        if self.start.family:
-            check_line_family = True
-            cursor.execute('SELECT product_type, matrix '
-                'FROM "' + AnalysisFamilyCertificant._table + '" '
-                'WHERE family = %s',
-                (self.start.family.id,))
-            res = cursor.fetchall()
-            families = [(x[0], x[1]) for x in res]
-
         records = {}
-        for line in lines:
-            if check_line_family:
-                family_key = (line.notebook.product_type.id,
-                    line.notebook.matrix.id)
-                if family_key not in families:
-                    continue
+        for (family_id, product_type_id, matrix_id, fraction_type_id,
+                analysis_id, concentration_level_id, end_date, fraction_id,
+                device_id, result) in rows:
             try:
-                result = float(line.result or None)
+                result = float(result)
             except (TypeError, ValueError):
                 continue
             if range_min and result < range_min:
@@ -847,225 +962,80 @@ class MeansDeviationsCalc(Wizard):
             if range_max and result > range_max:
                 continue
 
-            product_type_id = line.notebook.product_type.id
-            matrix_id = line.notebook.matrix.id
-            fraction_type_id = line.notebook.fraction_type.id
-            analysis_id = line.analysis.id
-            concentration_level_id = line.concentration_level.id
-
-            key = (product_type_id, matrix_id, analysis_id,
+            key = (family_id, product_type_id, matrix_id, analysis_id,
                 concentration_level_id)
             if key not in records:
                 records[key] = {
+                    'family': family_id,
                     'product_type': product_type_id,
                     'matrix': matrix_id,
                     'fraction_type': fraction_type_id,
                     'analysis': analysis_id,
                     'concentration_level': concentration_level_id,
-                    'details': {},
+                    'details': [],
                     'mr_last_result': None,
                     }
-            mr = (records[key]['mr_last_result'] and
-                abs(result - records[key]['mr_last_result']) or 0.0)
-            records[key]['mr_last_result'] = result
-            records[key]['details'][line.id] = {
-                'date': line.end_date,
-                'fraction': line.notebook.fraction.id,
-                'device': line.device.id if line.device else None,
+            record = records[key]
+            mr = (record['mr_last_result'] and
+                abs(result - record['mr_last_result']) or 0.0)
+            record['mr_last_result'] = result
+            record['details'].append({
+                'date': end_date,
+                'fraction': fraction_id,
+                'device': device_id,
                 'result': result,
                 'mr': mr,
-                }
+                })
         if not records:
             return []
 
         to_create = []
         for record in records.values():
-            details = [d for d in record['details'].values()]
+            details = record['details']
+            count = len(details)
+            total = 0.00
+            mr_abs_diff = 0.00
+            for detail in details:
+                total += detail['result']
+                mr_abs_diff += detail['mr']
+            if count > 2:
+                mr_avg_abs_diff = round(mr_abs_diff / (count - 1), 2)
+            else:
+                mr_avg_abs_diff = mr_abs_diff
+            mean = round(total / count, 2)
+            total = 0.00
+            for detail in details:
+                total += (detail['result'] - mean) ** 2
+            # Se toma correcion poblacional Bessel n-1
+            if count > 1:
+                deviation = round(sqrt(total / (count - 1)), 2)
+            else:
+                deviation = 0.00
             to_create.append({
                 'session_id': self._session_id,
-                'family': None,
+                'family': record['family'],
                 'product_type': record['product_type'],
                 'matrix': record['matrix'],
                 'fraction_type': record['fraction_type'],
                 'analysis': record['analysis'],
                 'concentration_level': record['concentration_level'],
-                'details': [('create', details)],
                 'date_from': self.start.date_from,
                 'date_to': self.start.date_to,
                 'range_min': range_min,
                 'range_max': range_max,
+                'mean': mean,
+                'deviation': deviation,
+                'mr_avg_abs_diff': mr_avg_abs_diff,
                 })
-        if to_create:
-            res_lines = ControlResultLine.create(to_create)
-
-            to_save = []
-            for line in res_lines:
-                count = 0
-                total = 0.00
-                mr_abs_diff = 0.00
-                for detail in line.details:
-                    count += 1
-                    total += detail.result
-                    mr_abs_diff += detail.mr
-                if count > 2:
-                    mr_avg_abs_diff = round(
-                        mr_abs_diff / (count - 1), 2)
-                else:
-                    mr_avg_abs_diff = mr_abs_diff
-                mean = round(total / count, 2)
-                total = 0.00
-                for detail in line.details:
-                    total += (detail.result - mean) ** 2
-                # Se toma correcion poblacional Bessel n-1
-                if count > 1:
-                    deviation = round(sqrt(total / (count - 1)), 2)
-                else:
-                    deviation = 0.00
-                line.mean = mean
-                line.deviation = deviation
-                line.mr_avg_abs_diff = mr_avg_abs_diff
-                to_save.append(line)
-            ControlResultLine.save(to_save)
-            return res_lines
-        return []
+        res_lines = ControlResultLine.create(to_create)
 
-    def _create_grouped_lines(self):
-        cursor = Transaction().connection.cursor()
-        pool = Pool()
-        ControlResultLine = pool.get('lims.control.result_line')
-        AnalysisFamily = pool.get('lims.analysis.family')
-        AnalysisFamilyCertificant = pool.get(
-            'lims.analysis.family.certificant')
-        NotebookLine = pool.get('lims.notebook.line')
-
-        clause = [
-            ('laboratory', '=', self.start.laboratory.id),
-            ('end_date', '>=', self.start.date_from),
-            ('end_date', '<=', self.start.date_to),
-            ('notebook.fraction.type', '=', self.start.fraction_type.id),
-            ('analysis.behavior', '=', 'normal'),
-            ('concentration_level', '!=', None),
-            ('result', 'not in', [None, '']),
-            ('annulled', '=', False),
-            ]
-        if self.start.concentration_level:
-            clause.append(('concentration_level', '=',
-                self.start.concentration_level.id))
-
-        lines = NotebookLine.search(clause,
-            order=[('end_date', 'ASC'), ('id', 'ASC')])
-        if not lines:
-            return []
-
-        range_min = self.start.range_min
-        range_max = self.start.range_max
-
-        if self.start.family:
-            all_families = [self.start.family]
-        else:
-            all_families = AnalysisFamily.search([])
-
-        records = {}
-        for family in all_families:
-            cursor.execute('SELECT product_type, matrix '
-                'FROM "' + AnalysisFamilyCertificant._table + '" '
-                'WHERE family = %s',
-                (family.id,))
-            res = cursor.fetchall()
-            families = [(x[0], x[1]) for x in res]
-
-            for line in lines:
-                family_key = (line.notebook.product_type.id,
-                    line.notebook.matrix.id)
-                if family_key not in families:
-                    continue
-                try:
-                    result = float(line.result or None)
-                except (TypeError, ValueError):
-                    continue
-                if range_min and result < range_min:
-                    continue
-                if range_max and result > range_max:
-                    continue
-
-                family_id = family.id
-                fraction_type_id = line.notebook.fraction_type.id
-                analysis_id = line.analysis.id
-                concentration_level_id = line.concentration_level.id
-
-                key = (family_id, analysis_id, concentration_level_id)
-                if key not in records:
-                    records[key] = {
-                        'family': family_id,
-                        'fraction_type': fraction_type_id,
-                        'analysis': analysis_id,
-                        'concentration_level': concentration_level_id,
-                        'details': {},
-                        'mr_last_result': None,
-                        }
-                mr = (records[key]['mr_last_result'] and
-                    abs(result - records[key]['mr_last_result']) or 0.0)
-                records[key]['mr_last_result'] = result
-                records[key]['details'][line.id] = {
-                    'date': line.end_date,
-                    'fraction': line.notebook.fraction.id,
-                    'device': line.device.id if line.device else None,
-                    'result': result,
-                    'mr': mr,
-                    }
-        if not records:
-            return []
-
-        to_create = []
-        for record in records.values():
-            details = [d for d in record['details'].values()]
-            to_create.append({
-                'session_id': self._session_id,
-                'family': record['family'],
-                'product_type': None,
-                'matrix': None,
-                'fraction_type': record['fraction_type'],
-                'analysis': record['analysis'],
-                'concentration_level': record['concentration_level'],
-                'details': [('create', details)],
-                'date_from': self.start.date_from,
-                'date_to': self.start.date_to,
-                'range_min': range_min,
-                'range_max': range_max,
-                })
-        if to_create:
-            res_lines = ControlResultLine.create(to_create)
-
-            to_save = []
-            for line in res_lines:
-                count = 0
-                total = 0.00
-                mr_abs_diff = 0.00
-                for detail in line.details:
-                    count += 1
-                    total += detail.result
-                    mr_abs_diff += detail.mr
-                if count > 2:
-                    mr_avg_abs_diff = round(
-                        mr_abs_diff / (count - 1), 2)
-                else:
-                    mr_avg_abs_diff = mr_abs_diff
-                mean = round(total / count, 2)
-                total = 0.00
-                for detail in line.details:
-                    total += (detail.result - mean) ** 2
-                # Se toma correcion poblacional Bessel n-1
-                if count > 1:
-                    deviation = round(sqrt(total / (count - 1)), 2)
-                else:
-                    deviation = 0.00
-                line.mean = mean
-                line.deviation = deviation
-                line.mr_avg_abs_diff = mr_avg_abs_diff
-                to_save.append(line)
-            ControlResultLine.save(to_save)
-            return res_lines
-        return []
+        details = []
+        for line, record in zip(res_lines, records.values()):
+            for detail in record['details']:
+                detail['line'] = line.id
+                details.append(detail)
+        ControlResultLineDetail.create(details)
+        return res_lines
 
     def default_result(self, fields):
         lines = [l.id for l in self.result.lines]
@@ -1168,6 +1138,62 @@ class MeansDeviationsCalc(Wizard):
         return action, {}
 
 
+class TendencyRules(object):
+    """
+    Incremental evaluation of the control rules of a tendency. For each
+    rule it keeps the length of the current run of consecutive results
+    above and below its limits (and the previous one), so every new
+    result is checked in constant time instead of walking the history.
+    """
+    WINDOW = 8  # Qty of results of the widest rule
+
+    def __init__(self, tendency):
+        mean = tendency.mean
+        # (rule, upper limit, lower limit, occurrences, total)
+        self.rules = [
+            # 1 value above or below the mean +/- 3 SD
+            ('4', mean + tendency.three_sd_adj,
+                mean - tendency.three_sd_adj, 1, 1),
+            # 2 of 3 consecutive values above or below the mean +/- 2 SD
+            ('3', mean + tendency.two_sd_adj,
+                mean - tendency.two_sd_adj, 2, 3),
+            # 4 of 5 consecutive values above or below the mean +/- 1 SD
+            ('2', mean + tendency.one_sd_adj,
+                mean - tendency.one_sd_adj, 4, 5),
+            # 8 consecutive values above or below the mean
+            ('1', mean, mean, 8, 8),
+            ]
+        self.count = 0
+        self.runs = [(0, 0)] * len(self.rules)
+        self.prev_runs = [(0, 0)] * len(self.rules)
+
+    def add(self, result):
+        """
+        Adds a result and returns the rules it breaks (or [''] if none)
+        """
+        self.count += 1
+        rules = []
+        for i, (rule, upper, lower, occurrences, total) in enumerate(
+                self.rules):
+            upper_run, lower_run = self.runs[i]
+            if result > upper:
+                run = (upper_run + 1, 0)
+            elif result < lower:
+                run = (0, lower_run + 1)
+            else:
+                run = (0, 0)
+            self.prev_runs[i], self.runs[i] = self.runs[i], run
+            if self.count < total:
+                continue
+            # the run has to be inside the last 'total' results
+            if (min(max(run), total) >= occurrences or
+                    min(max(self.prev_runs[i]), total - 1) >= occurrences):
+                rules.append(rule)
+        if not rules:
+            rules.append('')
+        return rules
+
+
 class TendenciesAnalysisStart(ModelView):
     'Tendencies Analysis'
     __name__ = 'lims.control.tendencies_analysis.start'
@@ -1197,11 +1223,18 @@ class TendenciesAnalysisStart(ModelView):
         'Concentration level')
     analysis_group = fields.Many2One('lims.control.analysis_group',
         'Analysis Group')
+    only_new_results = fields.Boolean('Only new results',
+        help='Keep the previous details of the tendencies and evaluate '
+        'only the results after the last one')
 
     @staticmethod
     def default_group_by_family():
         return False
 
+    @staticmethod
+    def default_only_new_results():
+        return False
+
     @staticmethod
     def default_product_type_domain():
         cursor = Transaction().connection.cursor()
@@ -1329,11 +1362,41 @@ class TendenciesAnalysis(Wizard):
                 if family_key not in families:
                     continue
 
-            old_details = ControlTendencyDetail.search([
-                ('tendency', '=', tendency.id),
-                ])
-            if old_details:
-                ControlTendencyDetail.delete(old_details)
+            rules_checker = TendencyRules(tendency)
+            rule_counts = dict.fromkeys(['1', '2', '3', '4'], 0)
+            mr_last_result = None
+            last_details = []
+            if self.start.only_new_results:
+                last_details = ControlTendencyDetail.search([
+                    ('tendency', '=', tendency.id),
+                    ], order=[('date', 'DESC'), ('id', 'DESC')],
+                    limit=TendencyRules.WINDOW)
+            if last_details:
+                # resume the rules evaluation from the stored details
+                for detail in reversed(last_details):
+                    rules_checker.add(detail.result)
+                mr_last_result = last_details[0].result
+                rule_counts.update({
+                    '1': tendency.rule_1_count or 0,
+                    '2': tendency.rule_2_count or 0,
+                    '3': tendency.rule_3_count or 0,
+                    '4': tendency.rule_4_count or 0,
+                    })
+                date_from = max(last_details[0].date, self.start.date_from)
+                cursor.execute('SELECT notebook_line '
+                    'FROM "' + ControlTendencyDetail._table + '" '
+                    'WHERE tendency = %s '
+                        'AND date >= %s',
+                    (tendency.id, date_from))
+                evaluated_lines = set(x[0] for x in cursor.fetchall())
+            else:
+                old_details = ControlTendencyDetail.search([
+                    ('tendency', '=', tendency.id),
+                    ])
+                if old_details:
+                    ControlTendencyDetail.delete(old_details)
+                date_from = self.start.date_from
+                evaluated_lines = set()
 
             check_line_family = False
             if tendency.family:
@@ -1359,50 +1422,41 @@ class TendenciesAnalysis(Wizard):
                     ('notebook.matrix', '=', tendency.matrix.id),
                     ])
 
-            rule_1_count = 0
-            rule_2_count = 0
-            rule_3_count = 0
-            rule_4_count = 0
             all_lines = NotebookLine.search(clause + [
-                    ('end_date', '>=', self.start.date_from),
+                    ('end_date', '>=', date_from),
                     ('end_date', '<=', self.start.date_to),
                     ], order=[('end_date', 'ASC'), ('id', 'ASC')])
-            if not check_line_family:
-                lines = all_lines
-            else:
-                lines = []
-                for line in all_lines:
+            lines = []
+            for line in all_lines:
+                if line.id in evaluated_lines:
+                    continue
+                if check_line_family:
                     family_key = (line.notebook.product_type.id,
                         line.notebook.matrix.id)
-                    if family_key in tendency_families:
-                        lines.append(line)
+                    if family_key not in tendency_families:
+                        continue
+                lines.append(line)
             if lines:
-                results = []
-                prevs = 8 - len(lines)  # Qty of previous results required
-                if prevs > 0:
+                # Qty of previous results required
+                prevs = TendencyRules.WINDOW - len(lines)
+                if prevs > 0 and not last_details:
                     all_prev_lines = NotebookLine.search(clause + [
                             ('end_date', '<', self.start.date_from),
                             ], order=[('end_date', 'ASC'), ('id', 'ASC')],
                             limit=prevs)
-                    if not check_line_family:
-                        prev_lines = all_prev_lines
-                    else:
-                        prev_lines = []
-                        for line in all_prev_lines:
+                    for line in all_prev_lines:
+                        if check_line_family:
                             family_key = (line.notebook.product_type.id,
                                 line.notebook.matrix.id)
-                            if family_key in tendency_families:
-                                prev_lines.append(line)
-                    if prev_lines:
-                        for line in prev_lines:
-                            try:
-                                result = float(line.result if
-                                    line.result else None)
-                            except(TypeError, ValueError):
+                            if family_key not in tendency_families:
                                 continue
-                            results.append(result)
+                        try:
+                            result = float(line.result if
+                                line.result else None)
+                        except(TypeError, ValueError):
+                            continue
+                        rules_checker.add(result)
 
-                mr_last_result = None
                 to_create = []
                 for line in lines:
                     try:
@@ -1413,21 +1467,13 @@ class TendenciesAnalysis(Wizard):
                     mr = (mr_last_result and
                           abs(result - mr_last_result) or 0.0)
                     mr_last_result = result
-                    results.append(result)
-                    rules = self.get_rules(results, tendency)
+                    rules = rules_checker.add(result)
                     rules_to_create = []
                     for r in rules:
                         if r == '':
                             continue
                         rules_to_create.append({'rule': r})
-                        if r == '1':
-                            rule_1_count += 1
-                        elif r == '2':
-                            rule_2_count += 1
-                        elif r == '3':
-                            rule_3_count += 1
-                        elif r == '4':
-                            rule_4_count += 1
+                        rule_counts[r] += 1
 
                     record = {
                         'notebook_line': line.id,
@@ -1445,12 +1491,14 @@ class TendenciesAnalysis(Wizard):
 
                 ControlTendencyDetail.create(to_create)
                 tendency_result.append(tendency)
+            elif last_details:
+                tendency_result.append(tendency)
 
             ControlTendency.write([tendency], {
-                'rule_1_count': rule_1_count,
-                'rule_2_count': rule_2_count,
-                'rule_3_count': rule_3_count,
-                'rule_4_count': rule_4_count,
+                'rule_1_count': rule_counts['1'],
+                'rule_2_count': rule_counts['2'],
+                'rule_3_count': rule_counts['3'],
+                'rule_4_count': rule_counts['4'],
                 })
 
         if tendency_result:
@@ -1458,93 +1506,6 @@ class TendenciesAnalysis(Wizard):
             return 'open'
         return 'end'
 
-    def get_rules(self, results, tendency):
-
-        rules = []
-
-        # Check rule 4
-        # 1 value above or below the mean +/- 3 SD
-        upper_parameter = tendency.mean + tendency.three_sd_adj
-        lower_parameter = tendency.mean - tendency.three_sd_adj
-        occurrences = 1
-        total = 1
-        if self._check_rule(results, upper_parameter, lower_parameter,
-                occurrences, total):
-            rules.append('4')
-
-        # Check rule 3
-        # 2 of 3 consecutive values above or below the mean +/- 2 SD
-        upper_parameter = tendency.mean + tendency.two_sd_adj
-        lower_parameter = tendency.mean - tendency.two_sd_adj
-        occurrences = 2
-        total = 3
-        if self._check_rule(results, upper_parameter, lower_parameter,
-                occurrences, total):
-            rules.append('3')
-
-        # Check rule 2
-        # 4 of 5 consecutive values above or below the mean +/- 1 SD
-        upper_parameter = tendency.mean + tendency.one_sd_adj
-        lower_parameter = tendency.mean - tendency.one_sd_adj
-        occurrences = 4
-        total = 5
-        if self._check_rule(results, upper_parameter, lower_parameter,
-                occurrences, total):
-            rules.append('2')
-
-        # Check rule 1
-        # 8 consecutive values above or below the mean
-        upper_parameter = tendency.mean
-        lower_parameter = tendency.mean
-        occurrences = 8
-        total = 8
-        if self._check_rule(results, upper_parameter, lower_parameter,
-                occurrences, total):
-            rules.append('1')
-
-        if not rules:
-            rules.append('')
-
-        return rules
-
-    def _check_rule(self, results, upper_parameter, lower_parameter,
-            occurrences, total):
-
-        if len(results) < total:
-            return False
-
-        total_counter = 0
-        upper_counter = 0
-        lower_counter = 0
-        for result in reversed(results):
-
-            total_counter += 1
-            if result > upper_parameter:
-                upper_counter += 1
-                if total_counter == total:
-                    if (upper_counter >= occurrences or
-                            lower_counter >= occurrences):
-                        return True
-                    return False
-                lower_counter = 0
-            elif result < lower_parameter:
-                lower_counter += 1
-                if total_counter == total:
-                    if (lower_counter >= occurrences or
-                            upper_counter >= occurrences):
-                        return True
-                    return False
-                upper_counter = 0
-            else:
-                if total_counter == total:
-                    if (upper_counter >= occurrences or
-                            lower_counter >= occurrences):
-                        return True
-                    return False
-                upper_counter = 0
-                lower_counter = 0
-        return False
-
     def do_open(self, action):
         action['pyson_domain'] = PYSONEncoder().encode([
             ('id', 'in', [t.id for t in self.result.tendencies]),
@@ -1890,9 +1851,26 @@ class TrendChart(ModelSQL, ModelView):
             }
         return res
 
-    def get_plot(self, session_id):
-        pool = Pool()
-        TrendChartData = pool.get('lims.trend.chart.data')
+    def get_plot(self, session_id, preview=False):
+        """
+        Returns the chart image of the session data. Images are cached by
+        the chart definition and data, preview images are rendered at a
+        lower resolution for on-screen display.
+        """
+        data = self._get_plot_data(session_id)
+        dpi = TREND_CHART_PREVIEW_DPI if preview else TREND_CHART_DPI
+        return plot_cache.compute(self._get_plot_key(data, dpi),
+            render_trend_chart, data, dpi)
+
+    def queue_plot(self, session_id, preview=False):
+        "Renders the chart image of the session data in background"
+        data = self._get_plot_data(session_id)
+        dpi = TREND_CHART_PREVIEW_DPI if preview else TREND_CHART_DPI
+        plot_cache.submit(self._get_plot_key(data, dpi),
+            render_trend_chart, data, dpi)
+
+    def _get_plot_data(self, session_id):
+        TrendChartData = Pool().get('lims.trend.chart.data')
 
         index = []
         cols, cols_y2 = {}, {}
@@ -1924,73 +1902,96 @@ class TrendChart(ModelSQL, ModelView):
                 ds2[a_description].append(float(val)
                     if val is not None else None)
 
-        df = pd.DataFrame(ds, index=index)
-        df = df.reindex(cols.values(), axis=1)
+        return {
+            'index': index,
+            'columns': list(cols.values()),
+            'columns_y2': list(cols_y2.values()),
+            'values': ds,
+            'values_y2': ds2,
+            'x_label': self.x_axis_string,
+            'y_label': self.uom.symbol if self.uom else None,
+            'y2_label': self.uom_y2.symbol if self.uom_y2 else None,
+            }
+
+    @staticmethod
+    def _get_plot_key(data, dpi):
+        key = json.dumps([data, dpi], sort_keys=True, default=str)
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def clean(cls):
+        TrendChartData = Pool().get('lims.trend.chart.data')
+        to_delete = cls.search([('active', '=', False)])
+        cls.delete(to_delete)
+        to_delete = TrendChartData.search([])
+        TrendChartData.delete(to_delete)
+
+
+def render_trend_chart(data, dpi):
+    "Renders the image of a trend chart from its data"
+    index = data['index']
+    ds, ds2 = data['values'], data['values_y2']
+
+    df = pd.DataFrame(ds, index=index)
+    df = df.reindex(data['columns'], axis=1)
+    try:
+        df_interpolated = df.interpolate()
+    except TypeError:
+        df_interpolated = df
+    if ds2:
+        df2 = pd.DataFrame(ds2, index=index)
+        df2 = df2.reindex(data['columns_y2'], axis=1)
         try:
-            df_interpolated = df.interpolate()
+            df2_interpolated = df2.interpolate()
         except TypeError:
-            df_interpolated = df
-        if ds2:
-            df2 = pd.DataFrame(ds2, index=index)
-            df2 = df2.reindex(cols_y2.values(), axis=1)
-            try:
-                df2_interpolated = df2.interpolate()
-            except TypeError:
-                df2_interpolated = df2
+            df2_interpolated = df2
+
+    def set_legends(ax):
+        loc, i = ['upper left', 'upper right'], 0
+        for axis in ax.figure.axes:
+            handles, labels = [], []
+            for h, l in zip(*axis.get_legend_handles_labels()):
+                if l in labels:
+                    continue
+                handles.append(h)
+                labels.append(l)
+            axis.legend(handles, labels, loc=loc[i], fontsize=14)
+            i += 1
 
-        output = BytesIO()
+    output = BytesIO()
+    with _plot_lock, plt.rc_context(rc={'figure.max_open_warning': 0}):
         try:
-            with plt.rc_context(rc={'figure.max_open_warning': 0}):
-                ax = df_interpolated.plot(kind='line',
-                    rot=45, fontsize=14, figsize=(10, 7.5),
-                    linestyle='-', marker=None, legend=None)
-                ax = df.plot(kind='line',
-                    rot=45, fontsize=14, figsize=(10, 7.5),
-                    linestyle='', marker='o', color='black',
-                    legend=None, ax=ax)
-                ax.set_xlabel(self.x_axis_string)
-                if self.uom:
-                    ax.set_ylabel(self.uom.symbol)
-                if ds2:
-                    try:
-                        ax = df2_interpolated.plot(kind='line',
-                            rot=45, fontsize=14, figsize=(10, 7.5),
-                            linestyle='-', marker=None, legend=None,
-                            secondary_y=True, ax=ax)
-                        ax = df2.plot(kind='line',
-                            rot=45, fontsize=14, figsize=(10, 7.5),
-                            linestyle='', marker='o', color='black',
-                            legend=None, secondary_y=True, ax=ax)
-                        if self.uom_y2:
-                            ax.set_ylabel(self.uom_y2.symbol)
-                    except TypeError:
-                        pass
-                ax.xaxis.label.set_fontsize(14)
-                ax.yaxis.label.set_fontsize(14)
-
-                loc, i = ['upper left', 'upper right'], 0
-                for axis in ax.figure.axes:
-                    handles, labels = [], []
-                    for h, l in zip(*axis.get_legend_handles_labels()):
-                        if l in labels:
-                            continue
-                        handles.append(h)
-                        labels.append(l)
-                    axis.legend(handles, labels, loc=loc[i], fontsize=14)
-                    i += 1
-
-                ax.get_figure().savefig(output, bbox_inches='tight', dpi=300)
-                plt.close('all')
-                image = output.getvalue()
-                output.close()
-            # release memory
-            del ax, df, df_interpolated
+            ax = df_interpolated.plot(kind='line',
+                rot=45, fontsize=14, figsize=(10, 7.5),
+                linestyle='-', marker=None, legend=None)
+            ax = df.plot(kind='line',
+                rot=45, fontsize=14, figsize=(10, 7.5),
+                linestyle='', marker='o', color='black',
+                legend=None, ax=ax)
+            ax.set_xlabel(data['x_label'])
+            if data['y_label']:
+                ax.set_ylabel(data['y_label'])
             if ds2:
-                del df2, df2_interpolated
-            gc.collect()
-            return image
+                try:
+                    ax = df2_interpolated.plot(kind='line',
+                        rot=45, fontsize=14, figsize=(10, 7.5),
+                        linestyle='-', marker=None, legend=None,
+                        secondary_y=True, ax=ax)
+                    ax = df2.plot(kind='line',
+                        rot=45, fontsize=14, figsize=(10, 7.5),
+                        linestyle='', marker='o', color='black',
+                        legend=None, secondary_y=True, ax=ax)
+                    if data['y2_label']:
+                        ax.set_ylabel(data['y2_label'])
+                except TypeError:
+                    pass
+            ax.xaxis.label.set_fontsize(14)
+            ax.yaxis.label.set_fontsize(14)
+            set_legends(ax)
+            ax.get_figure().savefig(output, bbox_inches='tight', dpi=dpi)
 
         except (TypeError, ModuleNotFoundError):
+            plt.close('all')
             if ds2:
                 try:
                     ax = df2_interpolated.plot(kind='line',
@@ -2001,51 +2002,21 @@ class TrendChart(ModelSQL, ModelView):
                         rot=45, fontsize=14, figsize=(10, 7.5),
                         linestyle='', marker='o', color='black',
                         legend=None, secondary_y=True, ax=ax)
-                    ax.set_xlabel(self.x_axis_string)
-                    if self.uom_y2:
-                        ax.set_ylabel(self.uom_y2.symbol)
+                    ax.set_xlabel(data['x_label'])
+                    if data['y2_label']:
+                        ax.set_ylabel(data['y2_label'])
                     ax.xaxis.label.set_fontsize(14)
                     ax.yaxis.label.set_fontsize(14)
-
-                    loc, i = ['upper left', 'upper right'], 0
-                    for axis in ax.figure.axes:
-                        handles, labels = [], []
-                        for h, l in zip(*axis.get_legend_handles_labels()):
-                            if l in labels:
-                                continue
-                            handles.append(h)
-                            labels.append(l)
-                        axis.legend(handles, labels, loc=loc[i], fontsize=14)
-                        i += 1
-
+                    set_legends(ax)
                     ax.get_figure().savefig(output, bbox_inches='tight',
-                        dpi=300)
-                    plt.close('all')
-                    image = output.getvalue()
-                    output.close()
-                    # release memory
-                    del ax, df, df_interpolated
-                    if ds2:
-                        del df2, df2_interpolated
-                    gc.collect()
-                    return image
-
+                        dpi=dpi)
                 except (TypeError, ModuleNotFoundError):
                     pass
-            # release memory
-            del df, df_interpolated
-            if ds2:
-                del df2, df2_interpolated
-            gc.collect()
-            return output.getvalue()
-
-    @classmethod
-    def clean(cls):
-        TrendChartData = Pool().get('lims.trend.chart.data')
-        to_delete = cls.search([('active', '=', False)])
-        cls.delete(to_delete)
-        to_delete = TrendChartData.search([])
-        TrendChartData.delete(to_delete)
+        finally:
+            plt.close('all')
+    image = output.getvalue()
+    output.close()
+    return image
 
 
 class TrendChartAnalysis(ModelSQL, ModelView):
@@ -2163,7 +2134,12 @@ class OpenTrendChart(Wizard):
             records.append(record)
         TrendChartData.create(records)
 
-        if Transaction().context.get('active_model') == 'lims.trend.chart':
+        # the chart is opened on screen only when computed from the chart
+        interactive = (Transaction().context.get('active_model') ==
+            'lims.trend.chart')
+        if TREND_CHART_BACKGROUND_RENDER:
+            chart.queue_plot(session_id, preview=interactive)
+        if interactive:
             return 'open'
         return 'end'
 
@@ -2311,5 +2287,6 @@ class TrendChartReport(Report):
         chart = TrendChart(chart_id)
 
         report_context['title'] = chart.name
-        report_context['plot'] = chart.get_plot(data.get('session_id'))
+        report_context['plot'] = chart.get_plot(data.get('session_id'),
+            preview=True)
         return report_context
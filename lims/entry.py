@@ -23,6 +23,7 @@ from trytond.report import Report
 from trytond.rpc import RPC
 from trytond.exceptions import UserError, UserWarning
 from trytond.i18n import gettext, lazy_gettext
+from .tools import id_set_clause
 
 logger = logging.getLogger(__name__)
 
@@ -718,6 +719,7 @@ class Entry(Workflow, ModelSQL, ModelView):
     def update_entries_state(cls, entry_ids):
         cursor = Transaction().connection.cursor()
         pool = Pool()
+        Sample = pool.get('lims.sample')
         NotebookLine = pool.get('lims.notebook.line')
         Service = pool.get('lims.service')
         Fraction = pool.get('lims.fraction')
@@ -725,37 +727,47 @@ class Entry(Workflow, ModelSQL, ModelView):
         entries_states = ['ongoing', 'finished']
         entries_exclude = cls._get_update_entries_state_exclude()
 
-        entries_to_save = []
         entries = cls.search([
             ('id', 'in', list(set(entry_ids) - set(entries_exclude))),
             ('state', 'in', entries_states),
             ])
-        for entry in entries:
-            state = 'finished'
-            for sample in entry.samples:
-                if sample.state not in ('report_released', 'annulled'):
-                    state = 'ongoing'
-                    break
-                # All services reported
-                cursor.execute('SELECT COUNT(*) '
+        if not entries:
+            return
+
+        # Entries with samples not yet released or with services not
+        # reported
+        entries_clause, entries_params = id_set_clause('sa.entry',
+            [e.id for e in entries])
+        cursor.execute('SELECT DISTINCT sa.entry '
+            'FROM "' + Sample._table + '" sa '
+            'WHERE ' + entries_clause + ' '
+                'AND (sa.state NOT IN '
+                    '(\'report_released\', \'annulled\') '
+                'OR EXISTS ('
+                    'SELECT 1 '
                     'FROM "' + NotebookLine._table + '" nl '
                         'INNER JOIN "' + Service._table + '" s '
                         'ON s.id = nl.service '
                         'INNER JOIN "' + Fraction._table + '" f '
                         'ON f.id = s.fraction '
-                    'WHERE f.sample = %s '
+                    'WHERE f.sample = sa.id '
                         'AND nl.report = TRUE '
                         'AND nl.annulled = FALSE '
-                        'AND nl.results_report IS NULL',
-                    (sample.id,))
-                if cursor.fetchone()[0] != 0:
-                    state = 'ongoing'
-                    break
+                        'AND nl.results_report IS NULL))',
+            entries_params)
+        ongoing_ids = set(x[0] for x in cursor.fetchall())
+
+        to_write = {'ongoing': [], 'finished': []}
+        for entry in entries:
+            state = 'ongoing' if entry.id in ongoing_ids else 'finished'
             if entry.state != state:
-                entry.state = state
-                entries_to_save.append(entry)
-        if entries_to_save:
-            cls.save(entries_to_save)
+                to_write[state].append(entry)
+        args = []
+        for state, records in to_write.items():
+            if records:
+                args.extend((records, {'state': state}))
+        if args:
+            cls.write(*args)
 
     @classmethod
     def _get_update_entries_state_exclude(cls):
@@ -2278,39 +2290,34 @@ class AcknowledgmentOfReceipt(Report):
     @classmethod
     def get_included_analysis(cls, analysis_id, fraction_id):
         pool = Pool()
-        AnalysisIncluded = pool.get('lims.analysis.included')
+        Analysis = pool.get('lims.analysis')
         EntryDetailAnalysis = pool.get('lims.entry.detail.analysis')
 
         childs = []
-        included_analysis = AnalysisIncluded.search([
-            ('analysis', '=', analysis_id),
-            ])
-        for analysis in included_analysis:
-            if analysis.included_analysis.type == 'analysis':
-                analysis_detail = EntryDetailAnalysis.search([
-                    ('fraction', '=', fraction_id),
-                    ('analysis', '=', analysis.included_analysis.id),
-                    ])
-                if analysis_detail:
-                    analysis_detail = analysis_detail[0]
-                    if cls.get_analysis_reportable(
+        for path in Analysis.get_included_paths(analysis_id, 'analysis'):
+            included_analysis = Analysis(path[3])
+            analysis_detail = EntryDetailAnalysis.search([
+                ('fraction', '=', fraction_id),
+                ('analysis', '=', included_analysis.id),
+                ])
+            if analysis_detail:
+                analysis_detail = analysis_detail[0]
+                if cls.get_analysis_reportable(
+                        analysis_detail.sample.product_type,
+                        analysis_detail.sample.matrix,
+                        analysis_detail.analysis,
+                        analysis_detail.method):
+                    childs.append({
+                        'method_id': analysis_detail.method.id,
+                        'method': analysis_detail.method,
+                        'analysis': included_analysis,
+                        'acredited': cls.get_accreditation(
                             analysis_detail.sample.product_type,
                             analysis_detail.sample.matrix,
                             analysis_detail.analysis,
-                            analysis_detail.method):
-                        childs.append({
-                            'method_id': analysis_detail.method.id,
-                            'method': analysis_detail.method,
-                            'analysis': analysis.included_analysis,
-                            'acredited': cls.get_accreditation(
-                                analysis_detail.sample.product_type,
-                                analysis_detail.sample.matrix,
-                                analysis_detail.analysis,
-                                analysis_detail.method,
-                                analysis_detail.laboratory),
-                            })
-            childs.extend(cls.get_included_analysis(
-                analysis.included_analysis.id, fraction_id))
+                            analysis_detail.method,
+                            analysis_detail.laboratory),
+                        })
         return childs
 
     @classmethod
@@ -0,0 +1,216 @@
+# This file is part of lims module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import logging
+import smtplib
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from trytond.model import ModelSQL, ModelView, fields
+from trytond.pool import Pool
+from trytond.pyson import Eval
+from trytond.transaction import Transaction
+from trytond.config import config
+
+from .tools import SMTPSender
+
+# Messages sent by the worker in each transaction
+OUTBOX_BATCH_SIZE = config.getint('lims', 'mail_outbox_batch_size',
+    default=20)
+# Attempts before a message with temporary errors is marked as failed,
+# waiting the retry delay (in seconds) doubled on each attempt
+OUTBOX_MAX_ATTEMPTS = config.getint('lims', 'mail_outbox_max_attempts',
+    default=6)
+OUTBOX_RETRY_DELAY = config.getint('lims', 'mail_outbox_retry_delay',
+    default=300)
+
+logger = logging.getLogger(__name__)
+
+
+class MailOutbox(ModelSQL, ModelView):
+    'Mail Outbox'
+    __name__ = 'lims.mail.outbox'
+
+    from_addr = fields.Char('From', readonly=True)
+    to_addrs = fields.Text('To', readonly=True)
+    subject = fields.Char('Subject', readonly=True)
+    message = fields.Binary('Message', readonly=True)
+    origins = fields.One2Many('lims.mail.outbox.origin', 'mail', 'Origins',
+        readonly=True)
+    state = fields.Selection([
+        ('pending', 'Pending'),
+        ('sent', 'Sent'),
+        ('failed', 'Failed'),
+        ], 'State', readonly=True, required=True, select=True)
+    attempts = fields.Integer('Attempts', readonly=True)
+    next_attempt = fields.DateTime('Next attempt', readonly=True)
+    sent_date = fields.DateTime('Sent date', readonly=True)
+    last_error = fields.Text('Last error', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls._order.insert(0, ('id', 'DESC'))
+        cls._buttons.update({
+            'retry': {
+                'invisible': Eval('state') != 'failed',
+                'depends': ['state'],
+                },
+            })
+
+    @staticmethod
+    def default_state():
+        return 'pending'
+
+    @staticmethod
+    def default_attempts():
+        return 0
+
+    @classmethod
+    def _get_origin(cls):
+        '''
+        Returns the models that can be the origin of a message. They must
+        implement the mail_sent and mail_failed class methods, that are
+        called with the origins of the messages once they are sent or
+        have failed
+        '''
+        return []
+
+    @classmethod
+    def get_origin(cls):
+        IrModel = Pool().get('ir.model')
+        models = cls._get_origin()
+        models = IrModel.search([
+            ('model', 'in', models),
+            ])
+        return [(None, '')] + [(m.model, m.name) for m in models]
+
+    @classmethod
+    def enqueue(cls, from_addr, to_addrs, msg, origins=None):
+        '''
+        Stores the rendered message to be delivered by the sender worker
+        origins is the list of records the message is sent for
+        '''
+        subject = None
+        if not isinstance(msg, (str, bytes)):
+            subject = msg['Subject'] and str(msg['Subject'])
+            msg = msg.as_string()
+        if isinstance(msg, str):
+            msg = msg.encode('utf-8')
+        to_addrs = sorted(set(to_addrs))
+        mail, = cls.create([{
+            'from_addr': from_addr,
+            'to_addrs': '\n'.join(to_addrs),
+            'subject': subject,
+            'message': msg,
+            'origins': [('create', [{'origin': str(o)}
+                        for o in origins or []])],
+            }])
+        return mail
+
+    @classmethod
+    @ModelView.button
+    def retry(cls, mails):
+        cls.write(mails, {
+            'state': 'pending',
+            'attempts': 0,
+            'next_attempt': None,
+            })
+
+    @classmethod
+    def send_pending(cls):
+        '''
+        Cron - Send Mail Outbox
+        Drains the pending messages in batches, committing after each
+        batch. Messages locked by another worker are skipped
+        '''
+        logger.info('Cron - Send Mail Outbox: INIT')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        now = datetime.now()
+        with SMTPSender(retries=1, backoff=0) as sender:
+            while True:
+                cursor.execute('SELECT id '
+                    'FROM "' + cls._table + '" '
+                    'WHERE state = \'pending\' '
+                        'AND (next_attempt IS NULL OR next_attempt <= %s) '
+                    'ORDER BY id '
+                    'LIMIT %s '
+                    'FOR UPDATE SKIP LOCKED',
+                    (now, OUTBOX_BATCH_SIZE))
+                mails = cls.browse([x[0] for x in cursor.fetchall()])
+                if not mails:
+                    break
+                available = True
+                for mail in mails:
+                    available = mail._send(sender)
+                    if not available:
+                        break
+                cls.save(mails)
+                cls._update_origins(mails)
+                transaction.commit()
+                if not available:
+                    logger.warning('Cron - Send Mail Outbox: '
+                        'SMTP server unavailable')
+                    break
+        logger.info('Cron - Send Mail Outbox: END')
+
+    @classmethod
+    def _update_origins(cls, mails):
+        '''
+        Notifies the origins of the mails that were sent or have failed
+        '''
+        pool = Pool()
+        origins = defaultdict(list)
+        for mail in mails:
+            if mail.state not in ('sent', 'failed'):
+                continue
+            for origin in mail.origins:
+                if origin.origin:
+                    origins[(mail.state, origin.origin.__name__)].append(
+                        origin.origin)
+        for (state, model), records in origins.items():
+            getattr(pool.get(model), 'mail_%s' % state)(records)
+
+    def _send(self, sender):
+        '''
+        Delivers the message and updates its state. Returns False if the
+        SMTP server could not be reached
+        '''
+        self.attempts = (self.attempts or 0) + 1
+        try:
+            sender.send(self.from_addr, self.to_addrs.split(),
+                bytes(self.message))
+        except Exception as e:
+            self.last_error = str(e)
+            temporary = sender.is_temporary(e)
+            if temporary and self.attempts < OUTBOX_MAX_ATTEMPTS:
+                self.next_attempt = datetime.now() + timedelta(
+                    seconds=OUTBOX_RETRY_DELAY * 2 ** (self.attempts - 1))
+            else:
+                self.state = 'failed'
+                logger.error('Cron - Send Mail Outbox: %s: FAILED: %s',
+                    self.id, e)
+            return not (temporary and
+                not isinstance(e, smtplib.SMTPResponseException))
+        self.state = 'sent'
+        self.sent_date = datetime.now()
+        self.next_attempt = None
+        self.last_error = None
+        return True
+
+
+class MailOutboxOrigin(ModelSQL, ModelView):
+    'Mail Outbox Origin'
+    __name__ = 'lims.mail.outbox.origin'
+
+    mail = fields.Many2One('lims.mail.outbox', 'Mail', required=True,
+        ondelete='CASCADE', select=True)
+    origin = fields.Reference('Origin', selection='get_origin',
+        required=True, readonly=True)
+
+    @classmethod
+    def get_origin(cls):
+        MailOutbox = Pool().get('lims.mail.outbox')
+        return MailOutbox.get_origin()
@@ -25,6 +25,7 @@ from trytond.i18n import gettext
 from .configuration import get_print_date
 from .formula_parser import FormulaParser
 from .sample import SAMPLE_STATES
+from .tools import id_set_clause
 
 ALLOWED_RESULT_TYPES = (str, int, float, Decimal, time, date, timedelta,
     type(None))
@@ -310,12 +311,26 @@ class Notebook(ModelSQL, ModelView):
             for n in notebooks:
                 result[n.id] = None
             return result
+        states = cls._get_notebooks_state(laboratory_id,
+            [n.id for n in notebooks])
         for n in notebooks:
-            result[n.id] = cls._get_notebook_state(n.id, laboratory_id)
+            result[n.id] = states.get(n.id)
         return result
 
     @classmethod
     def _get_notebook_state(cls, notebook_id, laboratory_id):
+        return cls._get_notebooks_state(laboratory_id,
+            [notebook_id]).get(notebook_id)
+
+    @classmethod
+    def _get_notebooks_state(cls, laboratory_id, notebooks_ids=None):
+        """
+        Returns a dict notebook id: 'complete' or 'in_progress' for the
+        notebooks with lines pending reporting in the laboratory. If
+        notebooks_ids is None all the notebooks of the laboratory are
+        resolved. Lines of a report grouper that still has analysis
+        without accepted results are not taken as complete.
+        """
         cursor = Transaction().connection.cursor()
         pool = Pool()
         ResultsLine = pool.get('lims.results_report.version.detail.line')
@@ -326,48 +341,52 @@ class Notebook(ModelSQL, ModelView):
         EntryDetailAnalysis = pool.get('lims.entry.detail.analysis')
         ResultModifier = pool.get('lims.result_modifier')
 
-        draft_lines_ids = ResultsLine.get_draft_lines_ids(
-            laboratory_id, notebook_id)
-        draft_lines_ids = ', '.join(str(l) for l in [0] + draft_lines_ids)
-
-        sql_query = ('SELECT COUNT(*) '
-            'FROM "' + NotebookLine._table + '" nl '
-                'INNER JOIN "' + Notebook._table + '" n '
-                'ON n.id = nl.notebook '
-                'INNER JOIN "' + Fraction._table + '" f '
-                'ON f.id = n.fraction '
-                'INNER JOIN "' + FractionType._table + '" ft '
-                'ON ft.id = f.type '
-                'LEFT JOIN "' + ResultModifier._table + '" rm '
-                'ON rm.id = nl.result_modifier '
-            'WHERE nl.notebook = %s '
-                'AND nl.laboratory = %s '
-                'AND ft.report = TRUE '
-                'AND nl.report = TRUE '
-                'AND nl.annulled = FALSE '
-                'AND nl.results_report IS NULL '
-                'AND nl.accepted = TRUE '
-                'AND nl.id NOT IN (' + draft_lines_ids + ') ')
+        if notebooks_ids is not None and not notebooks_ids:
+            return {}
 
-        excluded_notebooks = cls._get_excluded_notebooks([notebook_id],
-            laboratory_id)
-        if excluded_notebooks:
-            for n_id, grouper in excluded_notebooks:
-                cursor.execute('SELECT nl.id '
+        notebook_clause = ''
+        notebook_params = []
+        if notebooks_ids is not None:
+            notebook_clause, notebook_params = id_set_clause('nl.notebook',
+                notebooks_ids)
+            notebook_clause = 'AND ' + notebook_clause + ' '
+
+        draft_lines_clause, draft_lines_params = id_set_clause('nl.id',
+            ResultsLine.get_draft_lines_query(laboratory_id), exclude=True)
+
+        sql_query = ('WITH excluded AS ('
+                'SELECT DISTINCT pending.notebook, pending.report_grouper '
+                'FROM ('
+                    'SELECT nl.notebook, d.report_grouper, '
+                        'BOOL_OR(COALESCE(nl.accepted, FALSE)) '
+                        'AS accepted, '
+                        'BOOL_OR(BOOL_OR(COALESCE(nl.accepted, FALSE))) '
+                        'OVER (PARTITION BY nl.notebook) '
+                        'AS notebook_accepted '
                     'FROM "' + NotebookLine._table + '" nl '
                         'INNER JOIN "' + EntryDetailAnalysis._table + '" d '
                         'ON d.id = nl.analysis_detail '
-                    'WHERE nl.notebook = %s AND d.report_grouper = %s',
-                    (n_id, grouper))
-                excluded_lines = [x[0] for x in cursor.fetchall()]
-                excluded_lines_ids = ', '.join(str(l)
-                    for l in [0] + excluded_lines)
-                sql_query += 'AND nl.id NOT IN (' + excluded_lines_ids + ') '
-        cursor.execute(sql_query, (notebook_id, laboratory_id))
-        if cursor.fetchone()[0] > 0:
-            return 'complete'
-
-        sql_query = ('SELECT COUNT(*) '
+                        'INNER JOIN "' + Notebook._table + '" n '
+                        'ON n.id = nl.notebook '
+                        'INNER JOIN "' + Fraction._table + '" f '
+                        'ON f.id = n.fraction '
+                        'INNER JOIN "' + FractionType._table + '" ft '
+                        'ON ft.id = f.type '
+                    'WHERE nl.laboratory = %s '
+                        'AND ft.report = TRUE '
+                        'AND nl.report = TRUE '
+                        'AND nl.annulled = FALSE ' +
+                        notebook_clause +
+                    'GROUP BY nl.notebook, nl.analysis, nl.method, '
+                        'd.report_grouper'
+                    ') pending '
+                'WHERE pending.accepted = FALSE '
+                    'AND pending.notebook_accepted = TRUE'
+                ') '
+            'SELECT nl.notebook, '
+                'BOOL_OR(nl.accepted = TRUE AND ex.notebook IS NULL), '
+                'BOOL_OR(' + cls._get_samples_in_progress_sql_condition() +
+                ') '
             'FROM "' + NotebookLine._table + '" nl '
                 'INNER JOIN "' + Notebook._table + '" n '
                 'ON n.id = nl.notebook '
@@ -377,20 +396,30 @@ class Notebook(ModelSQL, ModelView):
                 'ON ft.id = f.type '
                 'LEFT JOIN "' + ResultModifier._table + '" rm '
                 'ON rm.id = nl.result_modifier '
-            'WHERE nl.notebook = %s '
-                'AND nl.laboratory = %s '
+                'LEFT JOIN "' + EntryDetailAnalysis._table + '" d '
+                'ON d.id = nl.analysis_detail '
+                'LEFT JOIN excluded ex '
+                'ON ex.notebook = nl.notebook '
+                'AND ex.report_grouper = d.report_grouper '
+            'WHERE nl.laboratory = %s '
                 'AND ft.report = TRUE '
                 'AND nl.report = TRUE '
                 'AND nl.annulled = FALSE '
                 'AND nl.results_report IS NULL '
-                'AND nl.id NOT IN (' + draft_lines_ids + ') ')
-        sql_query += cls._get_samples_in_progress_sql_clause()
-
-        cursor.execute(sql_query, (notebook_id, laboratory_id))
-        if cursor.fetchone()[0] > 0:
-            return 'in_progress'
+                'AND ' + draft_lines_clause + ' ' +
+                notebook_clause +
+            'GROUP BY nl.notebook')
+        cursor.execute(sql_query,
+            [laboratory_id] + notebook_params +
+            [laboratory_id] + draft_lines_params + notebook_params)
 
-        return None
+        result = {}
+        for notebook_id, complete, in_progress in cursor.fetchall():
+            if complete:
+                result[notebook_id] = 'complete'
+            elif in_progress:
+                result[notebook_id] = 'in_progress'
+        return result
 
     @classmethod
     def search_state(cls, name, domain=None):
@@ -404,58 +433,13 @@ class Notebook(ModelSQL, ModelView):
 
     @classmethod
     def _get_notebooks_complete(cls):
-        cursor = Transaction().connection.cursor()
-        pool = Pool()
-        ResultsLine = pool.get('lims.results_report.version.detail.line')
-        NotebookLine = pool.get('lims.notebook.line')
-        Notebook = pool.get('lims.notebook')
-        Fraction = pool.get('lims.fraction')
-        FractionType = pool.get('lims.fraction.type')
-        EntryDetailAnalysis = pool.get('lims.entry.detail.analysis')
-
         laboratory_id = Transaction().context.get(
             'samples_pending_reporting_laboratory', None)
         if not laboratory_id:
             return []
-
-        draft_lines_ids = ResultsLine.get_draft_lines_ids(laboratory_id)
-        draft_lines_ids = ', '.join(str(l) for l in [0] + draft_lines_ids)
-
-        sql_query = ('SELECT nl.notebook '
-            'FROM "' + NotebookLine._table + '" nl '
-                'INNER JOIN "' + Notebook._table + '" n '
-                'ON n.id = nl.notebook '
-                'INNER JOIN "' + Fraction._table + '" f '
-                'ON f.id = n.fraction '
-                'INNER JOIN "' + FractionType._table + '" ft '
-                'ON ft.id = f.type '
-            'WHERE nl.laboratory = %s '
-                'AND ft.report = TRUE '
-                'AND nl.report = TRUE '
-                'AND nl.annulled = FALSE '
-                'AND nl.results_report IS NULL '
-                'AND nl.accepted = TRUE '
-                'AND nl.id NOT IN (' + draft_lines_ids + ') ')
-        cursor.execute(sql_query, (laboratory_id,))
-        notebooks_ids = [x[0] for x in cursor.fetchall()]
-
-        excluded_notebooks = cls._get_excluded_notebooks(notebooks_ids,
-            laboratory_id)
-        if excluded_notebooks:
-            for n_id, grouper in excluded_notebooks:
-                cursor.execute('SELECT nl.id '
-                    'FROM "' + NotebookLine._table + '" nl '
-                        'INNER JOIN "' + EntryDetailAnalysis._table + '" d '
-                        'ON d.id = nl.analysis_detail '
-                    'WHERE nl.notebook = %s AND d.report_grouper = %s',
-                    (n_id, grouper))
-                excluded_lines = [x[0] for x in cursor.fetchall()]
-                excluded_lines_ids = ', '.join(str(l)
-                    for l in [0] + excluded_lines)
-                sql_query += 'AND nl.id NOT IN (' + excluded_lines_ids + ') '
-            cursor.execute(sql_query, (laboratory_id,))
-            notebooks_ids = [x[0] for x in cursor.fetchall()]
-        return notebooks_ids
+        states = cls._get_notebooks_state(laboratory_id)
+        return [n_id for n_id, state in states.items()
+            if state == 'complete']
 
     @classmethod
     def _get_excluded_notebooks(cls, notebooks_ids, laboratory_id):
@@ -469,7 +453,8 @@ class Notebook(ModelSQL, ModelView):
         Entry = pool.get('lims.entry')
         FractionType = pool.get('lims.fraction.type')
 
-        notebooks_ids = '\', \''.join(str(n) for n in notebooks_ids + [0])
+        notebooks_clause, notebooks_params = id_set_clause('n.id',
+            notebooks_ids)
 
         cursor.execute('SELECT nl.notebook, nl.analysis, nl.method, '
                 'd.report_grouper, nl.accepted '
@@ -490,8 +475,8 @@ class Notebook(ModelSQL, ModelView):
                 'AND ft.report = TRUE '
                 'AND nl.report = TRUE '
                 'AND nl.annulled = FALSE '
-                'AND n.id IN (\'' + notebooks_ids + '\')',
-            (laboratory_id,))
+                'AND ' + notebooks_clause,
+            [laboratory_id] + notebooks_params)
         notebook_lines = cursor.fetchall()
 
         # Check repetitions
@@ -518,48 +503,13 @@ class Notebook(ModelSQL, ModelView):
 
     @classmethod
     def _get_notebooks_in_progress(cls):
-        cursor = Transaction().connection.cursor()
-        pool = Pool()
-        ResultsLine = pool.get('lims.results_report.version.detail.line')
-        NotebookLine = pool.get('lims.notebook.line')
-        Notebook = pool.get('lims.notebook')
-        Fraction = pool.get('lims.fraction')
-        FractionType = pool.get('lims.fraction.type')
-        ResultModifier = pool.get('lims.result_modifier')
-
         laboratory_id = Transaction().context.get(
             'samples_pending_reporting_laboratory', None)
         if not laboratory_id:
             return []
-
-        draft_lines_ids = ResultsLine.get_draft_lines_ids(laboratory_id)
-        draft_lines_ids = ', '.join(str(l) for l in [0] + draft_lines_ids)
-
-        sql_query = ('SELECT nl.notebook '
-            'FROM "' + NotebookLine._table + '" nl '
-                'INNER JOIN "' + Notebook._table + '" n '
-                'ON n.id = nl.notebook '
-                'INNER JOIN "' + Fraction._table + '" f '
-                'ON f.id = n.fraction '
-                'INNER JOIN "' + FractionType._table + '" ft '
-                'ON ft.id = f.type '
-                'LEFT JOIN "' + ResultModifier._table + '" rm '
-                'ON rm.id = nl.result_modifier '
-            'WHERE nl.laboratory = %s '
-                'AND ft.report = TRUE '
-                'AND nl.report = TRUE '
-                'AND nl.annulled = FALSE '
-                'AND nl.results_report IS NULL '
-                'AND nl.id NOT IN (' + draft_lines_ids + ') ')
-        sql_query += cls._get_samples_in_progress_sql_clause()
-        cursor.execute(sql_query, (laboratory_id,))
-        notebooks_ids = [x[0] for x in cursor.fetchall()]
-
-        complete_notebooks_ids = cls._get_notebooks_complete()
-        if complete_notebooks_ids:
-            notebooks_ids = list(
-                set(notebooks_ids) - set(complete_notebooks_ids))
-        return notebooks_ids
+        states = cls._get_notebooks_state(laboratory_id)
+        return [n_id for n_id, state in states.items()
+            if state == 'in_progress']
 
     @classmethod
     def _get_samples_in_progress_clause(cls):
@@ -578,21 +528,21 @@ class Notebook(ModelSQL, ModelView):
         return clause
 
     @classmethod
-    def _get_samples_in_progress_sql_clause(cls):
+    def _get_samples_in_progress_sql_condition(cls):
         Config = Pool().get('lims.configuration')
         samples_in_progress = Config(1).samples_in_progress
-        sql_clause = ''
+        sql_condition = 'TRUE'
         if samples_in_progress == 'accepted':
-            sql_clause = 'AND nl.accepted = TRUE '
+            sql_condition = 'nl.accepted = TRUE'
         elif samples_in_progress == 'result':
-            sql_clause = ('AND ((nl.result IS NOT NULL '
+            sql_condition = ('((nl.result IS NOT NULL '
                 'AND nl.result != \'\') '
                 'OR (nl.literal_result IS NOT NULL '
                 'AND nl.literal_result != \'\') '
                 'OR rm.code IN '
                 '(\'d\', \'nd\', \'pos\', \'neg\', '
-                '\'ni\', \'abs\', \'pre\', \'na\')) ')
-        return sql_clause
+                '\'ni\', \'abs\', \'pre\', \'na\'))')
+        return sql_condition
 
     @classmethod
     def view_toolbar_get(cls):
@@ -1186,16 +1136,16 @@ class NotebookLine(ModelSQL, ModelView):
 
         super().write(*args)
 
-        context_update_samples_state = Transaction().context.get(
-            'update_samples_state', True)
         context_update_referrals_state = Transaction().context.get(
             'update_referrals_state', True)
+        context_update_detail_analysis = Transaction().context.get(
+            'update_detail_analysis', True)
 
         actions = iter(args)
         for lines, vals in zip(actions, actions):
             if vals.get('not_accepted_message'):
                 cls.write(lines, {'not_accepted_message': None})
-            if 'accepted' in vals:
+            if 'accepted' in vals and context_update_detail_analysis:
                 cls.update_detail_analysis(lines, vals['accepted'])
             if 'report' in vals:
                 cls.update_detail_report(lines)
@@ -1205,7 +1155,7 @@ class NotebookLine(ModelSQL, ModelView):
                 if field in vals:
                     update_samples_state = True
                     break
-            if update_samples_state and context_update_samples_state:
+            if update_samples_state:
                 sample_ids = list(set(nl.sample.id for nl in lines))
                 Sample.update_samples_state(sample_ids)
             update_referrals_state = False
@@ -5675,11 +5625,9 @@ class NotebookAddInternalRelations(Wizard):
         if not notebook_lines:
             return default
 
-        notebook_analysis = []
-        for notebook_line in notebook_lines:
-            notebook_analysis.append(notebook_line.analysis.code)
-        notebook_analysis_codes = '\', \''.join(str(a) for a
-            in notebook_analysis)
+        notebook_analysis_clause, notebook_analysis_params = id_set_clause(
+            'a.id', set(nl.analysis.id for nl in notebook_lines),
+            exclude=True)
 
         cursor.execute('SELECT DISTINCT(a.id, a.result_formula) '
             'FROM "' + Analysis._table + '" a '
@@ -5689,9 +5637,9 @@ class NotebookAddInternalRelations(Wizard):
                 'AND t.matrix = %s '
                 'AND t.valid '
                 'AND a.behavior = \'internal_relation\' '
-                'AND a.code NOT IN (\'' + notebook_analysis_codes + '\')',
-            (notebook.fraction.product_type.id,
-            notebook.fraction.matrix.id))
+                'AND ' + notebook_analysis_clause,
+            [notebook.fraction.product_type.id,
+            notebook.fraction.matrix.id] + notebook_analysis_params)
         internal_relations = cursor.fetchall()
         if not internal_relations:
             return default
@@ -16,6 +16,7 @@ from trytond.pyson import PYSONEncoder, Eval, Equal, Bool, Not, Or
 from trytond.exceptions import UserError
 from trytond.i18n import gettext
 from .configuration import get_print_date
+from .tools import id_set_clause
 
 
 class Planification(Workflow, ModelSQL, ModelView):
@@ -169,6 +170,8 @@ class Planification(Workflow, ModelSQL, ModelView):
         pool = Pool()
         AnalysisLaboratory = pool.get('lims.analysis-laboratory')
         Analysis = pool.get('lims.analysis')
+        AnalysisIncluded = pool.get('lims.analysis.included')
+        AnalysisIncludedClosure = pool.get('lims.analysis.included.closure')
 
         if not laboratory:
             return []
@@ -183,45 +186,40 @@ class Planification(Workflow, ModelSQL, ModelView):
             (laboratory.id,))
         analyzes_list = [a[0] for a in cursor.fetchall()]
 
-        others_list = []
-        cursor.execute('SELECT id '
-            'FROM "' + Analysis._table + '" '
-            'WHERE type != \'analysis\'')
-        others_list_ids = [x[0] for x in cursor.fetchall()]
-        for set_group_id in others_list_ids:
-            if Planification._get_set_group_available(set_group_id,
-                    analyzes_list):
-                others_list.append(set_group_id)
+        # A set or group is available when it includes some analysis and
+        # all the analysis included in it at any level are available
+        cursor.execute('SELECT sg.id '
+            'FROM "' + Analysis._table + '" sg '
+            'WHERE sg.type != \'analysis\' '
+                'AND EXISTS ('
+                    'SELECT 1 '
+                    'FROM "' + AnalysisIncluded._table + '" ia '
+                        'INNER JOIN "' + Analysis._table + '" a '
+                        'ON a.id = ia.included_analysis '
+                    'WHERE ia.analysis = sg.id '
+                        'AND a.behavior != \'internal_relation\') '
+                'AND NOT EXISTS ('
+                    'SELECT 1 '
+                    'FROM "' + AnalysisIncludedClosure._table + '" c '
+                        'INNER JOIN "' + Analysis._table + '" a '
+                        'ON a.id = c.included_analysis '
+                    'WHERE c.analysis = sg.id '
+                        'AND a.behavior != \'internal_relation\' '
+                        'AND ((a.type = \'analysis\' '
+                                'AND a.id != ALL(%s::integer[])) '
+                            'OR (a.type != \'analysis\' AND NOT EXISTS ('
+                                'SELECT 1 '
+                                'FROM "' + AnalysisIncluded._table + '" ia '
+                                    'INNER JOIN "' + Analysis._table + '" ai '
+                                    'ON ai.id = ia.included_analysis '
+                                'WHERE ia.analysis = a.id '
+                                    'AND ai.behavior != '
+                                    '\'internal_relation\'))))',
+            (analyzes_list,))
+        others_list = [x[0] for x in cursor.fetchall()]
 
         return analyzes_list + others_list
 
-    @staticmethod
-    def _get_set_group_available(set_group_id, analyzes_list):
-        cursor = Transaction().connection.cursor()
-        pool = Pool()
-        AnalysisIncluded = pool.get('lims.analysis.included')
-        Analysis = pool.get('lims.analysis')
-
-        cursor.execute('SELECT ia.included_analysis, a.type '
-            'FROM "' + AnalysisIncluded._table + '" ia '
-                'INNER JOIN "' + Analysis._table + '" a '
-                'ON a.id = ia.included_analysis '
-            'WHERE ia.analysis = %s '
-                'AND a.behavior != \'internal_relation\'',
-            (set_group_id,))
-        included_analysis = cursor.fetchall()
-        if not included_analysis:
-            return False
-        for analysis in included_analysis:
-            if (analysis[1] == 'analysis' and analysis[0] not in
-                    analyzes_list):
-                return False
-            if (analysis[1] != 'analysis' and not
-                    Planification._get_set_group_available(analysis[0],
-                    analyzes_list)):
-                return False
-        return True
-
     @classmethod
     def create(cls, vlist):
         pool = Pool()
@@ -322,11 +320,13 @@ class Planification(Workflow, ModelSQL, ModelView):
             ], order=[('id', 'ASC')])
         if planifications:
             logger.info('Cron - Processing planifications:INIT')
-            for planification in planifications:
-                if planification.state == 'confirmed':
-                    cls.do_confirm([planification])
-                elif planification.state == 'not_executed':
-                    cls.do_release_controls([planification])
+            # samples shared by several planifications are updated once
+            with Transaction().set_context(defer_samples_state=True):
+                for planification in planifications:
+                    if planification.state == 'confirmed':
+                        cls.do_confirm([planification])
+                    elif planification.state == 'not_executed':
+                        cls.do_release_controls([planification])
             logger.info('Cron - Processing planifications:END')
 
     @classmethod
@@ -384,11 +384,11 @@ class Planification(Workflow, ModelSQL, ModelView):
             (self.id,))
         res = cursor.fetchall()
         if res:
-            notebook_lines_ids = ', '.join(str(nl_id)
-                for nl_id, sd_id in res)
+            lines_clause, lines_params = id_set_clause('notebook_line',
+                set(nl_id for nl_id, sd_id in res))
             cursor.execute('DELETE FROM "' +
                 NotebookLineProfessional._table + '" '
-                'WHERE notebook_line IN (' + notebook_lines_ids + ')')
+                'WHERE ' + lines_clause, lines_params)
 
             to_create = []
             for notebook_line, professional in res:
@@ -411,11 +411,11 @@ class Planification(Workflow, ModelSQL, ModelView):
                 (self.id,))
             res = [x[0] for x in cursor.fetchall()]
             if res:
-                notebook_lines_ids = ', '.join(str(nl_id)
-                    for nl_id in res)
+                lines_clause, lines_params = id_set_clause('notebook_line',
+                    res)
                 cursor.execute('DELETE FROM "' +
                     NotebookLineControl._table + '" '
-                    'WHERE notebook_line IN (' + notebook_lines_ids + ')')
+                    'WHERE ' + lines_clause, lines_params)
 
                 to_create = []
                 for notebook_line in res:
@@ -1864,12 +1864,13 @@ class AddFractionControlStart(ModelView):
         if not notebook_lines:
             return []
 
-        notebook_lines_ids = ', '.join(str(nl.id) for nl in notebook_lines)
+        lines_clause, lines_params = id_set_clause('nl.id',
+            [nl.id for nl in notebook_lines])
         cursor.execute('SELECT DISTINCT(n.fraction) '
             'FROM "' + Notebook._table + '" n '
                 'INNER JOIN "' + NotebookLine._table + '" nl '
                 'ON nl.notebook = n.id '
-            'WHERE nl.id IN (' + notebook_lines_ids + ')')
+            'WHERE ' + lines_clause, lines_params)
         return [x[0] for x in cursor.fetchall()]
 
     @fields.depends('type', 'original_fraction', 'concentration_level',
@@ -2308,12 +2309,13 @@ class AddFractionRMBMZStart(ModelView):
         if not notebook_lines:
             return []
 
-        notebook_lines_ids = ', '.join(str(nl.id) for nl in notebook_lines)
+        lines_clause, lines_params = id_set_clause('nl.id',
+            [nl.id for nl in notebook_lines])
         cursor.execute('SELECT DISTINCT(n.fraction) '
             'FROM "' + Notebook._table + '" n '
                 'INNER JOIN "' + NotebookLine._table + '" nl '
                 'ON nl.notebook = n.id '
-            'WHERE nl.id IN (' + notebook_lines_ids + ')')
+            'WHERE ' + lines_clause, lines_params)
         return [x[0] for x in cursor.fetchall()]
 
     @staticmethod
@@ -4158,14 +4160,14 @@ class SearchFractions(Wizard):
 
         planification = Planification(Transaction().context['active_id'])
 
-        records_added = ['(%s,%s)' % (d.fraction.id, d.service_analysis.id)
+        records_added = [(d.fraction.id, d.service_analysis.id)
             for d in self.next.details]
-        records_ids_added = ', '.join(str(x)
-            for x in ['(0,0)'] + records_added)
-        extra_where = (
-            'AND (nb.fraction, srv.analysis) IN (' + records_ids_added + ') ')
+        extra_where, extra_params = id_set_clause(
+            ('nb.fraction', 'srv.analysis'), records_added)
+        extra_where = 'AND ' + extra_where + ' '
 
-        data = self._get_service_details(planification, extra_where)
+        data = self._get_service_details(planification, extra_where,
+            extra_params)
 
         to_create = []
         for k, v in data.items():
@@ -4191,9 +4193,17 @@ class SearchFractions(Wizard):
 
         return 'end'
 
-    def _get_service_details(self, planification, extra_where=''):
+    def _get_service_details(self, planification, extra_where='',
+            extra_params=None, lines=False):
+        '''
+        Returns the repetition of the plannable services of each
+        (fraction, service analysis) or, when filtering by extra_where or
+        with lines, the values of their planification service details
+        '''
         cursor = Transaction().connection.cursor()
         pool = Pool()
+        Planification = pool.get('lims.planification')
+        PlanificationDetail = pool.get('lims.planification.detail')
         PlanificationServiceDetail = pool.get(
             'lims.planification.service_detail')
         NotebookLine = pool.get('lims.notebook.line')
@@ -4202,82 +4212,92 @@ class SearchFractions(Wizard):
         EntryDetailAnalysis = pool.get('lims.entry.detail.analysis')
         Service = pool.get('lims.service')
         Analysis = pool.get('lims.analysis')
+        AnalysisIncludedClosure = pool.get('lims.analysis.included.closure')
 
-        planification_details = PlanificationServiceDetail.search([
-            ('planification.state', '=', 'preplanned'),
-            ('notebook_line', '!=', None),
-            ])
-        planned_lines = [pd.notebook_line.id for pd in planification_details]
-        planned_lines_ids = ', '.join(str(x) for x in [0] + planned_lines)
-        preplanned_where = 'AND nl.id NOT IN (%s) ' % planned_lines_ids
+        planned_analysis = [a.id for a in planification.analysis]
+        if not planned_analysis:
+            return {}
 
         dates_where = self._get_dates_clause(planification)
 
-        result = {}
-        nlines_added = []
-        for a in planification.analysis:
-            analysis_id = a.id
-
-            all_included_analysis = [analysis_id]
-            all_included_analysis.extend(
-                Analysis.get_included_analysis_analysis(analysis_id))
-            all_included_analysis_ids = ', '.join(str(x)
-                for x in all_included_analysis)
-            service_where = ('AND ad.analysis IN (%s) ' %
-                all_included_analysis_ids)
-
-            sql_select = (
-                'SELECT nl.id, nb.fraction, srv.analysis, nl.repetition != 0 ')
-
-            sql_from = (
-                'FROM "' + NotebookLine._table + '" nl '
+        # The services of each planned analysis are the analysis itself
+        # and all the analysis included in it at any level. Lines already
+        # in preplanned planifications are excluded.
+        sql_query = (
+            'WITH planned (analysis, sequence) AS ('
+                'SELECT * FROM UNNEST(%s::integer[]) WITH ORDINALITY'
+            '), '
+            'included (planned, analysis) AS ('
+                'SELECT analysis, analysis FROM planned '
+                'UNION '
+                'SELECT c.analysis, c.included_analysis '
+                'FROM "' + AnalysisIncludedClosure._table + '" c '
+                'WHERE c.analysis IN (SELECT analysis FROM planned)'
+            ') '
+            'SELECT nl.id, nb.fraction, srv.analysis, nl.repetition != 0, '
+                'p.analysis '
+            'FROM planned p '
+                'INNER JOIN included i '
+                'ON i.planned = p.analysis '
+                'INNER JOIN "' + Analysis._table + '" ia '
+                'ON ia.id = i.analysis '
+                'INNER JOIN "' + EntryDetailAnalysis._table + '" ad '
+                'ON ad.analysis = i.analysis '
+                'INNER JOIN "' + NotebookLine._table + '" nl '
+                'ON nl.analysis_detail = ad.id '
                 'INNER JOIN "' + Analysis._table + '" nla '
                 'ON nla.id = nl.analysis '
                 'INNER JOIN "' + Notebook._table + '" nb '
                 'ON nb.id = nl.notebook '
                 'INNER JOIN "' + Fraction._table + '" frc '
                 'ON frc.id = nb.fraction '
-                'INNER JOIN "' + EntryDetailAnalysis._table + '" ad '
-                'ON ad.id = nl.analysis_detail '
                 'INNER JOIN "' + Service._table + '" srv '
-                'ON srv.id = nl.service ')
-
-            sql_where = (
-                'WHERE ad.plannable = TRUE '
+                'ON srv.id = nl.service '
+            'WHERE (i.analysis = i.planned OR ia.type = \'analysis\') '
+                'AND ad.plannable = TRUE '
                 'AND nl.start_date IS NULL '
                 'AND nl.annulled = FALSE '
                 'AND nl.laboratory = %s '
-                'AND nla.behavior != \'internal_relation\' ' +
-                preplanned_where + dates_where + service_where + extra_where)
+                'AND nla.behavior != \'internal_relation\' '
+                'AND NOT EXISTS ('
+                    'SELECT 1 '
+                    'FROM "' + PlanificationServiceDetail._table + '" sd '
+                        'INNER JOIN "' + PlanificationDetail._table + '" pd '
+                        'ON pd.id = sd.detail '
+                        'INNER JOIN "' + Planification._table + '" pl '
+                        'ON pl.id = pd.planification '
+                    'WHERE sd.notebook_line = nl.id '
+                        'AND pl.state = \'preplanned\') ' +
+                dates_where + extra_where +
+            'ORDER BY p.sequence ASC, nb.fraction ASC, srv.analysis ASC')
 
-            sql_order = (
-                'ORDER BY nb.fraction ASC, srv.analysis ASC')
+        with Transaction().set_user(0):
+            cursor.execute(sql_query,
+                [planned_analysis, planification.laboratory.id] +
+                (extra_params or []))
+        notebook_lines = cursor.fetchall()
 
-            with Transaction().set_user(0):
-                cursor.execute(sql_select + sql_from + sql_where + sql_order,
-                    (planification.laboratory.id,))
-            notebook_lines = cursor.fetchall()
-            if not notebook_lines:
-                continue
-            if extra_where:
-                for nl in notebook_lines:
-                    f_ = nl[1]
-                    s_ = nl[2]
-                    if (f_, s_) not in result:
-                        result[(f_, s_)] = []
-                    if nl[0] not in nlines_added:
-                        nlines_added.append(nl[0])
-                        result[(f_, s_)].append({
-                            'notebook_line': nl[0],
-                            'planned_service': a.id,
-                            })
-            else:
-                for nl in notebook_lines:
-                    f_ = nl[1]
-                    s_ = nl[2]
-                    result[(f_, s_)] = {
-                        'repetition': nl[3],
-                        }
+        result = {}
+        nlines_added = set()
+        if extra_where or lines:
+            for nl in notebook_lines:
+                f_ = nl[1]
+                s_ = nl[2]
+                if (f_, s_) not in result:
+                    result[(f_, s_)] = []
+                if nl[0] not in nlines_added:
+                    nlines_added.add(nl[0])
+                    result[(f_, s_)].append({
+                        'notebook_line': nl[0],
+                        'planned_service': nl[4],
+                        })
+        else:
+            for nl in notebook_lines:
+                f_ = nl[1]
+                s_ = nl[2]
+                result[(f_, s_)] = {
+                    'repetition': nl[3],
+                    }
 
         return result
 
@@ -4384,14 +4404,13 @@ class SearchPlannedFractions(Wizard):
 
         planification = Planification(Transaction().context['active_id'])
 
-        records_added = ['(%s,%s)' % (d.fraction.id, d.service_analysis.id)
+        records_added = [(d.fraction.id, d.service_analysis.id)
             for d in self.next.details]
-        records_ids_added = ', '.join(str(x)
-            for x in ['(0,0)'] + records_added)
-        extra_where = (
-            'AND (nb.fraction, srv.analysis) IN (' + records_ids_added + ') ')
+        extra_where, extra_params = id_set_clause(
+            ('nb.fraction', 'srv.analysis'), records_added)
+        extra_where = 'AND ' + extra_where + ' '
 
-        data = self._get_service_details(extra_where)
+        data = self._get_service_details(extra_where, extra_params)
 
         to_create = []
         for k, v in data.items():
@@ -4417,7 +4436,7 @@ class SearchPlannedFractions(Wizard):
 
         return 'end'
 
-    def _get_service_details(self, extra_where=''):
+    def _get_service_details(self, extra_where='', extra_params=None):
         cursor = Transaction().connection.cursor()
         pool = Pool()
         NotebookLine = pool.get('lims.notebook.line')
@@ -4443,17 +4462,15 @@ class SearchPlannedFractions(Wizard):
             all_included_analysis = [analysis_id]
             all_included_analysis.extend(
                 Analysis.get_included_analysis_analysis(analysis_id))
-            all_included_analysis_ids = ', '.join(str(x)
-                for x in all_included_analysis)
-            service_where = ('AND ad.analysis IN (%s) ' %
-                all_included_analysis_ids)
+            service_where, service_params = id_set_clause('ad.analysis',
+                all_included_analysis)
+            service_where = 'AND ' + service_where + ' '
 
             excluded_fractions = self.get_control_fractions_excluded(
-                self.start.laboratory.id, service_where)
-            excluded_fractions_ids = ', '.join(str(x)
-                for x in [0] + excluded_fractions)
-            excluded_where = ('AND nb.fraction NOT IN (%s) ' %
-                excluded_fractions_ids)
+                self.start.laboratory.id, service_where, service_params)
+            excluded_where, excluded_params = id_set_clause('nb.fraction',
+                excluded_fractions, exclude=True)
+            excluded_where = 'AND ' + excluded_where + ' '
 
             sql_select = (
                 'SELECT nl.id, nb.fraction, srv.analysis, nl.repetition != 0 ')
@@ -4484,7 +4501,8 @@ class SearchPlannedFractions(Wizard):
 
             with Transaction().set_user(0):
                 cursor.execute(sql_select + sql_from + sql_where + sql_order,
-                    (self.start.laboratory.id,))
+                    [self.start.laboratory.id] + excluded_params +
+                    service_params + (extra_params or []))
             notebook_lines = cursor.fetchall()
             if notebook_lines:
                 if extra_where:
@@ -4510,7 +4528,8 @@ class SearchPlannedFractions(Wizard):
 
         return result
 
-    def get_control_fractions_excluded(self, laboratory, search_clause):
+    def get_control_fractions_excluded(self, laboratory, search_clause,
+            search_params=None):
         cursor = Transaction().connection.cursor()
         pool = Pool()
         NotebookLine = pool.get('lims.notebook.line')
@@ -4529,7 +4548,8 @@ class SearchPlannedFractions(Wizard):
             special_types.append(config.bre_fraction_type.id)
         if config.mrt_fraction_type:
             special_types.append(config.mrt_fraction_type.id)
-        special_types_ids = ', '.join(str(x) for x in [0] + special_types)
+        special_types_clause, special_types_params = id_set_clause(
+            'frc.type', special_types)
 
         cursor.execute('SELECT nl.analysis, nl.notebook '
             'FROM "' + NotebookLine._table + '" nl '
@@ -4539,11 +4559,12 @@ class SearchPlannedFractions(Wizard):
                 'ON frc.id = nb.fraction '
                 'INNER JOIN "' + EntryDetailAnalysis._table + '" ad '
                 'ON ad.id = nl.analysis_detail '
-            'WHERE frc.type IN (' + special_types_ids + ') '
+            'WHERE ' + special_types_clause + ' '
                 'AND nl.start_date IS NOT NULL '
                 'AND nl.end_date IS NULL '
                 'AND nl.laboratory = %s ' +
-                search_clause, (laboratory,))
+                search_clause,
+            special_types_params + [laboratory] + (search_params or []))
         notebook_lines = cursor.fetchall()
         if not notebook_lines:
             return []
@@ -4648,32 +4669,22 @@ class CreateFractionControlStart(ModelView):
         analyzes_list = [a[0] for a in cursor.fetchall()]
         if not analyzes_list:
             return []
-        lab_analysis_ids = ', '.join(str(a) for a in analyzes_list)
+        lab_analysis_ids = set(analyzes_list)
 
         others_list = []
         others = Analysis.search([
             ('type', '!=', 'analysis'),
             ])
         for set_group in others:
-            available = True
-
             ia = Analysis.get_included_analysis_analysis(set_group.id)
             if not ia:
                 continue
-            included_ids = ', '.join(str(a) for a in ia)
-
-            cursor.execute('SELECT id '
-                'FROM "' + Analysis._table + '" '
-                'WHERE id IN (' + included_ids + ') '
-                    'AND id NOT IN (' + lab_analysis_ids + ')')
-            if cursor.fetchone():
-                available = False
-
-            if available:
+            if set(ia).issubset(lab_analysis_ids):
                 others_list.append(set_group.id)
 
         analysis_domain = analyzes_list + others_list
-        analysis_domain_ids = ', '.join(str(a) for a in analysis_domain)
+        analysis_domain_clause, analysis_domain_params = id_set_clause(
+            'typ.analysis', analysis_domain)
 
         cursor.execute('SELECT DISTINCT(typ.analysis) '
             'FROM ('
@@ -4684,9 +4695,9 @@ class CreateFractionControlStart(ModelView):
                 '" ct '
                 'WHERE ct.product_type = %s AND ct.matrix = %s'
             ') AS typ '
-            'WHERE typ.analysis IN (' + analysis_domain_ids + ')',
-            (self.product_type.id, self.matrix.id,
-            self.product_type.id, self.matrix.id))
+            'WHERE ' + analysis_domain_clause,
+            [self.product_type.id, self.matrix.id,
+            self.product_type.id, self.matrix.id] + analysis_domain_params)
         typified_analysis = [a[0] for a in cursor.fetchall()]
         return typified_analysis
 
@@ -5056,31 +5067,33 @@ class ReleaseFraction(Wizard):
                 details_ids.append(service_detail.detail.id)
 
         if notebook_lines_ids:
-            notebook_lines_ids = ', '.join(str(nl)
-                for nl in notebook_lines_ids)
+            lines_clause, lines_params = id_set_clause('id',
+                notebook_lines_ids)
             cursor.execute('UPDATE "' + NotebookLine._table + '" '
                 'SET start_date = NULL, planification = NULL '
-                'WHERE id IN (' + notebook_lines_ids + ')')
+                'WHERE ' + lines_clause, lines_params)
+            lines_clause, lines_params = id_set_clause('notebook_line',
+                notebook_lines_ids)
             cursor.execute('DELETE FROM "' +
                 NotebookLineProfessional._table + '" '
-                'WHERE notebook_line IN (' + notebook_lines_ids + ')')
+                'WHERE ' + lines_clause, lines_params)
             cursor.execute('DELETE FROM "' +
                 NotebookLineControl._table + '" '
-                'WHERE notebook_line IN (' + notebook_lines_ids + ')')
+                'WHERE ' + lines_clause, lines_params)
 
         if analysis_detail_ids:
-            analysis_detail_ids = ', '.join(str(ad)
-                for ad in analysis_detail_ids)
+            details_clause, details_params = id_set_clause('id',
+                analysis_detail_ids)
             cursor.execute('UPDATE "' + EntryDetailAnalysis._table + '" '
                 'SET state = \'unplanned\' '
-                'WHERE id IN (' + analysis_detail_ids + ')')
+                'WHERE ' + details_clause, details_params)
 
         if service_details_ids:
-            service_details_ids = ', '.join(str(sd)
-                for sd in service_details_ids)
+            details_clause, details_params = id_set_clause('id',
+                service_details_ids)
             cursor.execute('DELETE FROM "' +
                 PlanificationServiceDetail._table + '" '
-                'WHERE id IN (' + service_details_ids + ')')
+                'WHERE ' + details_clause, details_params)
 
         details = PlanificationDetail.search([
             ('id', 'in', details_ids),
@@ -2,11 +2,12 @@
 # This file is part of lims module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
-from io import BytesIO
+import hashlib
 from datetime import datetime
-from PyPDF2 import PdfFileMerger
+from tempfile import TemporaryFile
 from sql import Literal, Null
 
+from trytond.filestore import filestore
 from trytond.model import (Workflow, ModelView, ModelSQL, Unique, fields,
     sequence_ordered)
 from trytond.wizard import Wizard, StateTransition, StateView, StateAction, \
@@ -21,6 +22,7 @@ from trytond.i18n import gettext
 from trytond import backend
 from .configuration import get_print_date
 from .notebook import NotebookLineRepeatAnalysis
+from .tools import id_set_clause, merge_pdf_reports
 
 
 class ResultsReport(ModelSQL, ModelView):
@@ -341,7 +343,8 @@ class ResultsReport(ModelSQL, ModelView):
                 if (r.entry_single_sending_report and
                         not r.entry_single_sending_report_ready):
                     excluded_ids.append(r.id)
-        excluded_ids = ', '.join(str(r) for r in [0] + excluded_ids)
+        excluded_clause, excluded_params = id_set_clause(
+            'rv.results_report', excluded_ids, exclude=True)
 
         cursor.execute('SELECT rr.id '
             'FROM "' + CachedReport._table + '" cr '
@@ -351,10 +354,10 @@ class ResultsReport(ModelSQL, ModelView):
                 'ON rd.report_version = rv.id '
                 'INNER JOIN "' + ResultsReport._table + '" rr '
                 'ON rv.results_report = rr.id '
-            'WHERE rv.results_report NOT IN (' + excluded_ids + ') '
+            'WHERE ' + excluded_clause + ' '
                 'AND rd.valid = TRUE '
                 'AND cr.report_language = rr.report_language '
-                'AND cr.report_format = \'pdf\'')
+                'AND cr.report_format = \'pdf\'', excluded_params)
         ready_ids = [x[0] for x in cursor.fetchall()]
 
         field, op, operand = clause
@@ -426,28 +429,120 @@ class ResultsReport(ModelSQL, ModelView):
         return cache
 
     def _get_global_report(self, details, language):
-        pool = Pool()
-        CachedReport = pool.get('lims.results_report.cached_report')
+        """
+        Merges the cached PDF reports of the details. The reports are
+        fetched with one query and spooled to temporary files one at a
+        time; the merged report is stored for each language and only
+        merged again when the set of cached reports changes. The global
+        report record of the language is written on every build that
+        merges the report.
+        """
+        key, cached_reports_ids = self._get_global_report_key(details,
+            language)
+        if not key:
+            return False
+        cache = self._get_stored_global_report(key, language)
+        if cache is not None:
+            return cache
+
+        with TemporaryFile() as output:
+            merge_pdf_reports(
+                self._get_cached_reports_content(cached_reports_ids),
+                output)
+            output.seek(0)
+            cache = output.read()
+        self._store_global_report(key, language, cache)
+        return cache
 
-        all_cache = []
-        for detail in details:
-            cached_reports = CachedReport.search([
-                ('version_detail', '=', detail.id),
+    def _get_global_report_key(self, details, language):
+        """
+        Returns the key of the stored global report and the ids of the
+        cached reports to merge, in the order of the details
+        """
+        cursor = Transaction().connection.cursor()
+        CachedReport = Pool().get('lims.results_report.cached_report')
+
+        details_ids = [d.id for d in details]
+        if not details_ids:
+            return None, []
+        cursor.execute('SELECT id, version_detail, '
+                'COALESCE(write_date, create_date) '
+            'FROM "' + CachedReport._table + '" '
+            'WHERE version_detail = ANY(%s) '
+                'AND report_language = %s '
+                'AND report_format = \'pdf\'',
+            (details_ids, language.id))
+        cached_reports = cursor.fetchall()
+        if not cached_reports:
+            return None, []
+        order = {d: i for i, d in enumerate(details_ids)}
+        cached_reports.sort(key=lambda x: order[x[1]])
+
+        key = hashlib.sha1(repr((language.id,
+            [(x[0], x[2]) for x in cached_reports])).encode()).hexdigest()
+        return key, [x[0] for x in cached_reports]
+
+    def _get_stored_global_report(self, key, language):
+        "Returns the global report stored for the language if it has key"
+        GlobalReport = Pool().get('lims.results_report.global_report')
+        with Transaction().set_user(0):
+            global_reports = GlobalReport.search([
+                ('results_report', '=', self.id),
+                ('report_language', '=', language.id),
+                ('report_cache_key', '=', key),
+                ], limit=1)
+            if global_reports:
+                return global_reports[0].report_cache
+
+    def _store_global_report(self, key, language, cache):
+        GlobalReport = Pool().get('lims.results_report.global_report')
+        if not cache:
+            return
+        with Transaction().set_user(0):
+            global_reports = GlobalReport.search([
+                ('results_report', '=', self.id),
                 ('report_language', '=', language.id),
-                ('report_format', '=', 'pdf'),
                 ])
-            if cached_reports:
-                all_cache.append(cached_reports[0].report_cache)
-        if not all_cache:
-            return False
+            if global_reports:
+                GlobalReport.write(global_reports, {
+                    'report_cache': cache,
+                    'report_cache_key': key,
+                    })
+            else:
+                GlobalReport.create([{
+                    'results_report': self.id,
+                    'report_language': language.id,
+                    'report_cache': cache,
+                    'report_cache_key': key,
+                    }])
+
+    @staticmethod
+    def _get_cached_reports_content(cached_reports_ids):
+        """
+        Yields the content of the cached PDF reports in the given order,
+        reading them through a server side cursor
+        """
+        pool = Pool()
+        CachedReport = pool.get('lims.results_report.cached_report')
+        transaction = Transaction()
 
-        merger = PdfFileMerger(strict=False)
-        for cache in all_cache:
-            filedata = BytesIO(cache)
-            merger.append(filedata)
-        output = BytesIO()
-        merger.write(output)
-        return bytearray(output.getvalue())
+        prefix = (CachedReport.report_cache.store_prefix or
+            transaction.database.name)
+        cursor = transaction.connection.cursor('lims_global_report')
+        cursor.itersize = 1
+        try:
+            cursor.execute('SELECT report_cache_id, report_cache '
+                'FROM "' + CachedReport._table + '" '
+                'WHERE id = ANY(%s) '
+                'ORDER BY array_position(%s, id)',
+                (cached_reports_ids, cached_reports_ids))
+            for file_id, report_cache in cursor:
+                if file_id:
+                    yield filestore.get(file_id, prefix=prefix)
+                elif report_cache:
+                    yield bytes(report_cache)
+        finally:
+            cursor.close()
 
     @classmethod
     def get_samples_list(cls, reports, name):
@@ -547,15 +642,15 @@ class ResultsReport(ModelSQL, ModelView):
             entry_ids = [x[0] for x in cursor.fetchall()]
             if not entry_ids:
                 continue
-            entry_ids = ', '.join(str(e) for e in entry_ids)
+            entry_clause, entry_params = id_set_clause('e.id', entry_ids)
 
             cursor.execute('SELECT e.number, count(s.id) '
                 'FROM "' + Entry._table + '" e '
                     'INNER JOIN "' + Sample._table + '" s '
                     'ON e.id = s.entry '
-                'WHERE e.id IN (' + entry_ids + ') '
+                'WHERE ' + entry_clause + ' '
                 'GROUP BY e.number '
-                'ORDER BY e.number ASC')
+                'ORDER BY e.number ASC', entry_params)
             res = cursor.fetchone()
             if not res:
                 continue
@@ -1249,8 +1344,13 @@ class ResultsReportVersionDetail(Workflow, ModelSQL, ModelView):
 
     @classmethod
     def do_release(cls, details):
-        Sample = Pool().get('lims.sample')
         cls.link_notebook_lines(details)
+        cls.generate_reports(details)
+
+    @classmethod
+    def generate_reports(cls, details):
+        "Generates the reports of the released details"
+        Sample = Pool().get('lims.sample')
         for detail in details:
             detail.generate_report()
             detail.generate_render()
@@ -1782,15 +1882,15 @@ class ResultsReportVersionDetail(Workflow, ModelSQL, ModelView):
             entry_ids = [x[0] for x in cursor.fetchall()]
             if not entry_ids:
                 continue
-            entry_ids = ', '.join(str(e) for e in entry_ids)
+            entry_clause, entry_params = id_set_clause('e.id', entry_ids)
 
             cursor.execute('SELECT e.number, count(s.id) '
                 'FROM "' + Entry._table + '" e '
                     'INNER JOIN "' + Sample._table + '" s '
                     'ON e.id = s.entry '
-                'WHERE e.id IN (' + entry_ids + ') '
+                'WHERE ' + entry_clause + ' '
                 'GROUP BY e.number '
-                'ORDER BY e.number ASC')
+                'ORDER BY e.number ASC', entry_params)
             res = cursor.fetchone()
             if not res:
                 continue
@@ -1888,6 +1988,29 @@ class ResultsReportCachedReport(ModelSQL):
             ]
 
 
+class ResultsReportGlobalReport(ModelSQL):
+    'Global Results Report'
+    __name__ = 'lims.results_report.global_report'
+
+    results_report = fields.Many2One('lims.results_report', 'Results Report',
+        required=True, ondelete='CASCADE', select=True)
+    report_language = fields.Many2One('ir.lang', 'Language', required=True)
+    report_cache = fields.Binary('Report cache', readonly=True,
+        file_id='report_cache_id', store_prefix='results_report')
+    report_cache_id = fields.Char('Report cache id', readonly=True)
+    report_cache_key = fields.Char('Report cache key', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('report_language_uniq', Unique(t,
+                t.results_report, t.report_language),
+                'lims.msg_detail_language_unique_id'),
+            ]
+
+
 class ResultsReportComment(ModelSQL):
     'Results Report Comment'
     __name__ = 'lims.results_report.comment'
@@ -2433,19 +2556,23 @@ class ResultsReportVersionDetailLine(ModelSQL, ModelView):
     @classmethod
     def get_draft_lines_ids(cls, laboratory_id=None, notebook_id=None):
         cursor = Transaction().connection.cursor()
+        sql_query, sql_params = cls.get_draft_lines_query(
+            laboratory_id, notebook_id)
+        cursor.execute(sql_query, sql_params)
+        return [x[0] for x in cursor.fetchall()]
+
+    @classmethod
+    def get_draft_lines_query(cls, laboratory_id=None, notebook_id=None):
+        """
+        Returns the query (and its params) that selects the ids of notebook
+        lines included in a draft report, to be used as a subquery
+        """
         pool = Pool()
         ResultsSample = pool.get('lims.results_report.version.detail.sample')
         ResultsDetail = pool.get('lims.results_report.version.detail')
         ResultsVersion = pool.get('lims.results_report.version')
 
-        laboratory_clause = ''
-        if laboratory_id:
-            laboratory_clause = 'AND rv.laboratory = %s ' % laboratory_id
-        notebook_clause = ''
-        if notebook_id:
-            notebook_clause = 'AND rs.notebook = %s ' % notebook_id
-
-        cursor.execute('SELECT rl.notebook_line '
+        sql_query = ('SELECT rl.notebook_line '
             'FROM "' + cls._table + '" rl '
                 'INNER JOIN "' + ResultsSample._table + '" rs '
                 'ON rl.detail_sample = rs.id '
@@ -2455,9 +2582,15 @@ class ResultsReportVersionDetailLine(ModelSQL, ModelView):
                 'ON rd.report_version = rv.id '
             'WHERE rl.notebook_line IS NOT NULL '
                 'AND rd.state NOT IN (\'released\', \'annulled\') '
-                'AND rd.type != \'preliminary\' ' +
-                laboratory_clause + notebook_clause)
-        return [x[0] for x in cursor.fetchall()]
+                'AND rd.type != \'preliminary\' ')
+        sql_params = []
+        if laboratory_id:
+            sql_query += 'AND rv.laboratory = %s '
+            sql_params.append(laboratory_id)
+        if notebook_id:
+            sql_query += 'AND rs.notebook = %s '
+            sql_params.append(notebook_id)
+        return sql_query, sql_params
 
     @classmethod
     def delete(cls, details):
@@ -3323,7 +3456,8 @@ class SampleResultsReportInProgress(Wizard):
         ResultsDetail = pool.get('lims.results_report.version.detail')
 
         active_ids = Transaction().context['active_ids']
-        sample_ids = ', '.join(str(r) for r in active_ids)
+        sample_clause, sample_params = id_set_clause('f.sample',
+            active_ids)
         samples = Sample.browse(active_ids)
 
         cursor.execute('SELECT rd.id '
@@ -3334,8 +3468,9 @@ class SampleResultsReportInProgress(Wizard):
                 'ON n.id = rs.notebook '
                 'INNER JOIN "' + Fraction._table + '" f '
                 'ON f.id = n.fraction '
-            'WHERE f.sample IN (' + sample_ids + ') '
-                'AND rd.state NOT IN (\'released\', \'annulled\')')
+            'WHERE ' + sample_clause + ' '
+                'AND rd.state NOT IN (\'released\', \'annulled\')',
+            sample_params)
         details_ids = [x[0] for x in cursor.fetchall()]
 
         action['pyson_domain'] = PYSONEncoder().encode([
@@ -4768,10 +4903,6 @@ class PrintGlobalResultReport(Wizard):
             if not cache:
                 raise UserError(gettext('lims.msg_global_report_build'))
 
-            results_report.report_cache = cache
-            results_report.report_format = 'pdf'
-            results_report.save()
-
         return 'print_'
 
     def do_print_(self, action):
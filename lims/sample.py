@@ -28,6 +28,7 @@ from trytond.rpc import RPC
 from trytond.config import config as tconfig
 from trytond.tools import get_smtp_server
 from trytond import backend
+from .tools import id_set_clause
 
 logger = logging.getLogger(__name__)
 
@@ -754,94 +755,88 @@ class Service(ModelSQL, ModelView):
             service_context=None):
         cursor = Transaction().connection.cursor()
         pool = Pool()
+        Analysis = pool.get('lims.analysis')
         Typification = pool.get('lims.typification')
 
         childs = []
-        if analysis.included_analysis:
-            for included in analysis.included_analysis:
-                if (analysis.type == 'set' and
-                        included.included_analysis.type == 'analysis'):
-                    origin = analysis_origin
-                else:
-                    origin = (analysis_origin + ' > ' +
-                        included.included_analysis.code)
-
-                if included.included_analysis.type == 'analysis':
-
-                    laboratory_id = None
-                    cursor.execute('SELECT laboratory '
-                        'FROM "' + Typification._table + '" '
-                        'WHERE product_type = %s '
-                            'AND matrix = %s '
-                            'AND analysis = %s '
-                            'AND valid IS TRUE '
-                            'AND by_default IS TRUE '
-                            'AND laboratory IS NOT NULL',
-                        (service_context['product_type'],
-                            service_context['matrix'],
-                            included.included_analysis.id))
-                    res = cursor.fetchone()
-                    if res:
-                        laboratory_id = res[0]
-                    if not laboratory_id:
-                        for l in included.included_analysis.laboratories:
-                            if l.by_default is True:
-                                laboratory_id = l.laboratory.id
-
-                    method_id = (included.method.id
-                        if included.method else None)
-                    if method_id:
-                        cursor.execute('SELECT id '
-                            'FROM "' + Typification._table + '" '
-                            'WHERE product_type = %s '
-                                'AND matrix = %s '
-                                'AND analysis = %s '
-                                'AND method = %s '
-                                'AND valid IS TRUE',
-                            (service_context['product_type'],
-                                service_context['matrix'],
-                                included.included_analysis.id,
-                                method_id))
-                        res = cursor.fetchone()
-                        if not res:
-                            method_id = None
-                    else:
-                        cursor.execute('SELECT method '
-                            'FROM "' + Typification._table + '" '
-                            'WHERE product_type = %s '
-                                'AND matrix = %s '
-                                'AND analysis = %s '
-                                'AND valid IS TRUE '
-                                'AND by_default IS TRUE',
-                            (service_context['product_type'],
-                                service_context['matrix'],
-                                included.included_analysis.id))
-                        res = cursor.fetchone()
-                        if res:
-                            method_id = res[0]
-
-                    if not method_id:
-                        raise UserError(gettext(
-                            'lims.msg_included_no_method',
-                            included=included.included_analysis.rec_name,
-                            analysis=analysis.rec_name))
-
-                    device_id = None
-                    if included.included_analysis.devices:
-                        for d in included.included_analysis.devices:
-                            if (d.laboratory.id == laboratory_id and
-                                    d.by_default is True):
-                                device_id = d.device.id
-
-                    childs.append({
-                        'id': included.included_analysis.id,
-                        'origin': origin,
-                        'laboratory': laboratory_id,
-                        'method': method_id,
-                        'device': device_id,
-                        })
-                childs.extend(cls._get_included_analysis(
-                    included.included_analysis, origin, service_context))
+        origins = {'': analysis_origin}
+        for (path, parent_id, parent_type, included_id, included_type,
+                included_code, method_id) in Analysis.get_included_paths(
+                analysis.id):
+            origin = origins[path.rpartition('/')[0]]
+            if not (parent_type == 'set' and included_type == 'analysis'):
+                origin = origin + ' > ' + included_code
+            origins[path] = origin
+            if included_type != 'analysis':
+                continue
+            included_analysis = Analysis(included_id)
+
+            laboratory_id = None
+            cursor.execute('SELECT laboratory '
+                'FROM "' + Typification._table + '" '
+                'WHERE product_type = %s '
+                    'AND matrix = %s '
+                    'AND analysis = %s '
+                    'AND valid IS TRUE '
+                    'AND by_default IS TRUE '
+                    'AND laboratory IS NOT NULL',
+                (service_context['product_type'],
+                    service_context['matrix'], included_id))
+            res = cursor.fetchone()
+            if res:
+                laboratory_id = res[0]
+            if not laboratory_id:
+                for l in included_analysis.laboratories:
+                    if l.by_default is True:
+                        laboratory_id = l.laboratory.id
+
+            if method_id:
+                cursor.execute('SELECT id '
+                    'FROM "' + Typification._table + '" '
+                    'WHERE product_type = %s '
+                        'AND matrix = %s '
+                        'AND analysis = %s '
+                        'AND method = %s '
+                        'AND valid IS TRUE',
+                    (service_context['product_type'],
+                        service_context['matrix'], included_id, method_id))
+                res = cursor.fetchone()
+                if not res:
+                    method_id = None
+            else:
+                cursor.execute('SELECT method '
+                    'FROM "' + Typification._table + '" '
+                    'WHERE product_type = %s '
+                        'AND matrix = %s '
+                        'AND analysis = %s '
+                        'AND valid IS TRUE '
+                        'AND by_default IS TRUE',
+                    (service_context['product_type'],
+                        service_context['matrix'], included_id))
+                res = cursor.fetchone()
+                if res:
+                    method_id = res[0]
+
+            if not method_id:
+                raise UserError(gettext(
+                    'lims.msg_included_no_method',
+                    included=included_analysis.rec_name,
+                    analysis=Analysis(parent_id).rec_name))
+
+            device_id = None
+            if included_analysis.devices:
+                for d in included_analysis.devices:
+                    if (d.laboratory.id == laboratory_id and
+                            d.by_default is True):
+                        device_id = d.device.id
+
+            childs.append({
+                'id': included_id,
+                'origin': origin,
+                'laboratory': laboratory_id,
+                'method': method_id,
+                'device': device_id,
+                })
         return childs
 
     @staticmethod
@@ -1408,15 +1403,16 @@ class Service(ModelSQL, ModelView):
         if not self.analysis:
             return []
 
-        typification_ids = ', '.join(str(t) for t in
-            self.on_change_with_typification_domain())
+        typification_ids = self.on_change_with_typification_domain()
         if not typification_ids:
             return []
+        typification_clause, typification_params = id_set_clause('id',
+            typification_ids)
         cursor.execute('SELECT DISTINCT(method) '
             'FROM "' + Typification._table + '" '
-            'WHERE id IN (' + typification_ids + ') '
+            'WHERE ' + typification_clause + ' '
                 'AND analysis = %s',
-            (self.analysis.id,))
+            typification_params + [self.analysis.id])
         res = cursor.fetchall()
         if not res:
             return []
@@ -1937,7 +1933,8 @@ class Fraction(ModelSQL, ModelView):
 
         plannable = ('TRUE' if FractionType(fraction_type_id).plannable
             else 'FALSE')
-        fractions_ids = ', '.join(str(f.id) for f in fractions)
+        fractions_clause, fractions_params = id_set_clause('srv.fraction',
+            [f.id for f in fractions])
 
         cursor.execute('UPDATE "' + EntryDetailAnalysis._table + '" d '
             'SET plannable = ' + plannable + ' FROM '
@@ -1945,7 +1942,7 @@ class Fraction(ModelSQL, ModelView):
             'WHERE d.service = srv.id '
             'AND d.state IN (\'draft\', \'unplanned\') '
             'AND d.referable = FALSE '
-            'AND srv.fraction IN (' + fractions_ids + ')')
+            'AND ' + fractions_clause, fractions_params)
 
     @classmethod
     def copy(cls, fractions, default=None):
@@ -2785,6 +2782,46 @@ class Fraction(ModelSQL, ModelView):
         return [x[0] for x in cursor.fetchall() if x[1] == 'storage']
 
 
+class SamplesStateDataManager(object):
+    """
+    Collects the samples whose state must be recomputed in a transaction
+    and recomputes them once, when the transaction is committed or when
+    the samples state is flushed
+    """
+
+    def __init__(self):
+        self.sample_ids = set()
+
+    def __eq__(self, other):
+        return isinstance(other, SamplesStateDataManager)
+
+    def add(self, sample_ids):
+        self.sample_ids.update(sample_ids)
+
+    def flush(self):
+        if not self.sample_ids:
+            return
+        sample_ids, self.sample_ids = list(self.sample_ids), set()
+        Sample = Pool().get('lims.sample')
+        with Transaction().set_context(defer_samples_state=False):
+            Sample.update_samples_state(sample_ids)
+
+    def tpc_begin(self, trans):
+        pass
+
+    def commit(self, trans):
+        self.flush()
+
+    def tpc_vote(self, trans):
+        pass
+
+    def tpc_finish(self, trans):
+        pass
+
+    def tpc_abort(self, trans):
+        self.sample_ids.clear()
+
+
 class Sample(ModelSQL, ModelView):
     'Sample'
     __name__ = 'lims.sample'
@@ -2949,8 +2986,7 @@ class Sample(ModelSQL, ModelView):
         if (not qty_lines_pending_exist or
                 not qty_lines_pending_acceptance_exist):
             logger.info('Updating Pending lines in Samples...')
-            for sample in cls.search([]):
-                sample.update_qty_lines()
+            cls.update_qty_lines(cls.search([]))
         if not party_exist:
             logger.info('Updating Party in Samples...')
             cursor.execute('UPDATE "' + cls._table + '" s '
@@ -3859,22 +3895,59 @@ class Sample(ModelSQL, ModelView):
 
     @classmethod
     def update_samples_state(cls, sample_ids):
+        '''
+        Recomputes the dates and state of the samples. With the
+        defer_samples_state context they are collected and recomputed
+        once at commit time or when flush_samples_state is called.
+        '''
+        transaction = Transaction()
+        if transaction.context.get('defer_samples_state'):
+            transaction.join(SamplesStateDataManager()).add(sample_ids)
+            return
+
         Entry = Pool().get('lims.entry')
-        entry_ids = set()
-        samples = cls.browse(sample_ids)
-        for sample in samples:
-            sample.update_sample_dates()
-            sample.update_sample_state()
-            sample.update_qty_lines()
-            entry_ids.add(sample.entry.id)
+        samples = cls.browse(list(set(sample_ids)))
+        if not samples:
+            return
+        values = cls._get_samples_state_values(samples)
+        cls._write_changed_values(samples, values)
+        entry_ids = set(s.entry.id for s in samples)
         if entry_ids:
             Entry.update_entries_state(list(entry_ids))
 
-    def update_sample_dates(self):
-        dates = self._get_sample_dates()
-        for field, value in dates.items():
-            setattr(self, field, value)
-        self.save()
+    @classmethod
+    def flush_samples_state(cls):
+        Transaction().join(SamplesStateDataManager()).flush()
+
+    @classmethod
+    def update_qty_lines(cls, samples):
+        counts = cls._get_samples_lines_counts([s.id for s in samples])
+        values = {}
+        for sample in samples:
+            sample_counts = counts.get(sample.id, {})
+            values[sample.id] = {
+                'qty_lines_pending': sample_counts.get('lines_pending', 0),
+                'qty_lines_pending_acceptance': sample_counts.get(
+                    'lines_pending_acceptance', 0),
+                }
+        cls._write_changed_values(samples, values)
+
+    @classmethod
+    def _write_changed_values(cls, samples, values):
+        to_write = {}
+        for sample in samples:
+            changes = {}
+            for field, value in values[sample.id].items():
+                if getattr(sample, field) != value:
+                    changes[field] = value
+            if changes:
+                key = tuple(sorted(changes.items()))
+                to_write.setdefault(key, []).append(sample)
+        if to_write:
+            args = []
+            for key, records in to_write.items():
+                args.extend((records, dict(key)))
+            cls.write(*args)
 
     def _get_origin_default_dates(self):
         ''' Used on Manage services context
@@ -3889,7 +3962,41 @@ class Sample(ModelSQL, ModelView):
             res['confirmation_datetime'] = None
         return res
 
-    def _get_sample_dates(self):
+    @classmethod
+    def _get_samples_state_values(cls, samples):
+        '''
+        Returns a dict with the dates, state and quantity of pending lines
+        of each sample, computed for all of them at once
+        '''
+        manage_service = Transaction().context.get('manage_service', False)
+        counts = cls._get_samples_lines_counts([s.id for s in samples])
+        res = {}
+        for sample in samples:
+            sample_counts = counts.get(sample.id, {})
+            values = cls._get_sample_dates(sample_counts)
+            if manage_service:
+                origin_dates = sample._get_origin_default_dates()
+                if 'confirmation_date' in origin_dates:
+                    for field in ('confirmation_date',
+                            'confirmation_datetime'):
+                        if field in origin_dates:
+                            values[field] = origin_dates[field]
+                        else:
+                            del values[field]
+            values['state'] = cls._get_sample_state(values, sample_counts)
+            values['qty_lines_pending'] = sample_counts.get(
+                'lines_pending', 0)
+            values['qty_lines_pending_acceptance'] = sample_counts.get(
+                'lines_pending_acceptance', 0)
+            res[sample.id] = values
+        return res
+
+    @classmethod
+    def _get_samples_lines_counts(cls, sample_ids):
+        '''
+        Returns a dict with the aggregated services, notebook lines and
+        results reports figures of each sample
+        '''
         cursor = Transaction().connection.cursor()
         pool = Pool()
         Fraction = pool.get('lims.fraction')
@@ -3901,302 +4008,143 @@ class Sample(ModelSQL, ModelView):
         ResultsDetail = pool.get('lims.results_report.version.detail')
         ResultsSample = pool.get('lims.results_report.version.detail.sample')
 
-        res = {}
-        if Transaction().context.get(
-                    'manage_service', False):
-            res = self._get_origin_default_dates()
-
-        # Confirmation date
-        if 'confirmation_date' not in res:
-            cursor.execute('SELECT MIN(s.confirmation_date) '
-                'FROM "' + Service._table + '" s '
-                    'INNER JOIN "' + Fraction._table + '" f '
-                    'ON f.id = s.fraction '
-                'WHERE f.sample = %s',
-                (self.id,))
-            res['confirmation_date'] = cursor.fetchone()[0] or None
-
-            cursor.execute('SELECT MIN(s.confirmation_datetime) '
-                'FROM "' + Service._table + '" s '
-                    'INNER JOIN "' + Fraction._table + '" f '
-                    'ON f.id = s.fraction '
-                'WHERE f.sample = %s',
-                (self.id,))
-            res['confirmation_datetime'] = cursor.fetchone()[0] or None
+        if not sample_ids:
+            return {}
 
-        # Laboratory deadline
-        cursor.execute('SELECT MAX(s.laboratory_date) '
-            'FROM "' + Service._table + '" s '
-                'INNER JOIN "' + Fraction._table + '" f '
-                'ON f.id = s.fraction '
-            'WHERE f.sample = %s',
-            (self.id,))
-        res['laboratory_date'] = cursor.fetchone()[0] or None
+        names = [
+            'confirmation_date', 'confirmation_datetime', 'laboratory_date',
+            'report_date', 'all_services', 'annulled_services',
+            'laboratory_start_date', 'max_end_date', 'max_acceptance_date',
+            'all_lines', 'annulled_lines', 'finished_without_report',
+            'finished_lines', 'lines_pending', 'lines_pending_acceptance',
+            'lines_not_accepted', 'lines_not_reported',
+            'results_report_create_date', 'results_report_release_date',
+            ]
 
-        # Date agreed for result
-        cursor.execute('SELECT MAX(s.report_date) '
-            'FROM "' + Service._table + '" s '
-                'INNER JOIN "' + Fraction._table + '" f '
-                'ON f.id = s.fraction '
-            'WHERE f.sample = %s',
-            (self.id,))
-        res['report_date'] = cursor.fetchone()[0] or None
+        report_clause, report_params = id_set_clause('f.sample', sample_ids)
+        samples_clause, samples_params = id_set_clause('f.sample', sample_ids)
+        cursor.execute('SELECT f.sample, '
+                'MIN(s.confirmation_date), '
+                'MIN(s.confirmation_datetime), '
+                'MAX(s.laboratory_date), '
+                'MAX(s.report_date), '
+                'COUNT(DISTINCT s.id), '
+                'COUNT(DISTINCT s.id) FILTER (WHERE s.annulled = TRUE), '
+                'MIN(nl.start_date), '
+                'MAX(nl.end_date), '
+                'MAX(nl.acceptance_date::date), '
+                'COUNT(nl.id), '
+                'COUNT(nl.id) FILTER (WHERE nl.annulled = TRUE), '
+                'COUNT(nl.id) FILTER (WHERE nl.report = FALSE '
+                    'AND nl.annulled = FALSE '
+                    'AND nl.end_date IS NOT NULL), '
+                'COUNT(nl.id) FILTER (WHERE nl.report = TRUE '
+                    'AND nl.annulled = FALSE '
+                    'AND nl.end_date IS NOT NULL), '
+                'COUNT(nl.id) FILTER (WHERE nl.report = TRUE '
+                    'AND nl.annulled = FALSE '
+                    'AND nl.end_date IS NULL), '
+                'COUNT(nl.id) FILTER (WHERE nl.report = TRUE '
+                    'AND nl.annulled = FALSE '
+                    'AND nl.end_date IS NOT NULL '
+                    'AND nl.acceptance_date IS NULL), '
+                'COUNT(nl.id) FILTER (WHERE nl.report = TRUE '
+                    'AND nl.annulled = FALSE '
+                    'AND nl.acceptance_date IS NULL), '
+                'COUNT(nl.id) FILTER (WHERE nl.report = TRUE '
+                    'AND nl.annulled = FALSE '
+                    'AND nl.results_report IS NULL), '
+                'MIN(rep.create_date), '
+                'MAX(rep.release_date) '
+            'FROM "' + Fraction._table + '" f '
+                'LEFT JOIN "' + Service._table + '" s '
+                'ON s.fraction = f.id '
+                'LEFT JOIN "' + NotebookLine._table + '" nl '
+                'ON nl.service = s.id '
+                'LEFT JOIN ('
+                    'SELECT f.sample, '
+                        'MIN(r.create_date::date) AS create_date, '
+                        'MAX(rd.release_date::date) FILTER ('
+                            'WHERE rd.valid) AS release_date '
+                    'FROM "' + ResultsReport._table + '" r '
+                        'INNER JOIN "' + ResultsVersion._table + '" rv '
+                        'ON rv.results_report = r.id '
+                        'INNER JOIN "' + ResultsDetail._table + '" rd '
+                        'ON rd.report_version = rv.id '
+                        'INNER JOIN "' + ResultsSample._table + '" rs '
+                        'ON rs.version_detail = rd.id '
+                        'INNER JOIN "' + Notebook._table + '" n '
+                        'ON n.id = rs.notebook '
+                        'INNER JOIN "' + Fraction._table + '" f '
+                        'ON f.id = n.fraction '
+                    'WHERE ' + report_clause + ' '
+                        'AND rd.type != \'preliminary\' '
+                    'GROUP BY f.sample'
+                ') rep ON rep.sample = f.sample '
+            'WHERE ' + samples_clause + ' '
+            'GROUP BY f.sample',
+            report_params + samples_params)
+        return dict((row[0], dict(zip(names, row[1:])))
+            for row in cursor.fetchall())
 
-        # Laboratory start date
-        cursor.execute('SELECT MIN(nl.start_date) '
-            'FROM "' + NotebookLine._table + '" nl '
-                'INNER JOIN "' + Service._table + '" s '
-                'ON s.id = nl.service '
-                'INNER JOIN "' + Fraction._table + '" f '
-                'ON f.id = s.fraction '
-            'WHERE f.sample = %s',
-            (self.id,))
-        res['laboratory_start_date'] = cursor.fetchone()[0] or None
+    @classmethod
+    def _get_sample_dates(cls, counts):
+        res = {}
+        for field in ('confirmation_date', 'confirmation_datetime',
+                'laboratory_date', 'report_date', 'laboratory_start_date',
+                'results_report_create_date', 'results_report_release_date'):
+            res[field] = counts.get(field) or None
 
-        # Laboratory end date
-        laboratory_end_date = None
-        cursor.execute('SELECT COUNT(*) '
-            'FROM "' + NotebookLine._table + '" nl '
-                'INNER JOIN "' + Service._table + '" s '
-                'ON s.id = nl.service '
-                'INNER JOIN "' + Fraction._table + '" f '
-                'ON f.id = s.fraction '
-            'WHERE f.sample = %s '
-                'AND nl.report = TRUE '
-                'AND nl.annulled = FALSE '
-                'AND nl.end_date IS NULL',
-            (self.id,))
         # also works for finished samples without report
-        if cursor.fetchone()[0] == 0:
-            cursor.execute('SELECT MAX(nl.end_date) '
-                'FROM "' + NotebookLine._table + '" nl '
-                    'INNER JOIN "' + Service._table + '" s '
-                    'ON s.id = nl.service '
-                    'INNER JOIN "' + Fraction._table + '" f '
-                    'ON f.id = s.fraction '
-                'WHERE f.sample = %s',
-                (self.id,))
-            laboratory_end_date = cursor.fetchone()[0] or None
-        res['laboratory_end_date'] = laboratory_end_date
-
-        # Laboratory acceptance date
-        laboratory_acceptance_date = None
-        cursor.execute('SELECT COUNT(*) '
-            'FROM "' + NotebookLine._table + '" nl '
-                'INNER JOIN "' + Service._table + '" s '
-                'ON s.id = nl.service '
-                'INNER JOIN "' + Fraction._table + '" f '
-                'ON f.id = s.fraction '
-            'WHERE f.sample = %s '
-                'AND nl.report = TRUE '
-                'AND nl.annulled = FALSE '
-                'AND nl.acceptance_date IS NULL',
-            (self.id,))
-        if cursor.fetchone()[0] == 0:
-            cursor.execute('SELECT MAX(nl.acceptance_date::date) '
-                'FROM "' + NotebookLine._table + '" nl '
-                    'INNER JOIN "' + Service._table + '" s '
-                    'ON s.id = nl.service '
-                    'INNER JOIN "' + Fraction._table + '" f '
-                    'ON f.id = s.fraction '
-                'WHERE f.sample = %s',
-                (self.id,))
-            laboratory_acceptance_date = cursor.fetchone()[0] or None
-        res['laboratory_acceptance_date'] = laboratory_acceptance_date
-
-        # Report start date
-        cursor.execute('SELECT MIN(r.create_date::date) '
-            'FROM "' + ResultsReport._table + '" r '
-                'INNER JOIN "' + ResultsVersion._table + '" rv '
-                'ON rv.results_report = r.id '
-                'INNER JOIN "' + ResultsDetail._table + '" rd '
-                'ON rd.report_version = rv.id '
-                'INNER JOIN "' + ResultsSample._table + '" rs '
-                'ON rs.version_detail = rd.id '
-                'INNER JOIN "' + Notebook._table + '" n '
-                'ON n.id = rs.notebook '
-                'INNER JOIN "' + Fraction._table + '" f '
-                'ON f.id = n.fraction '
-            'WHERE f.sample = %s '
-                'AND rd.type != \'preliminary\'',
-            (self.id,))
-        res['results_report_create_date'] = cursor.fetchone()[0] or None
-
-        # Report release date
-        cursor.execute('SELECT MAX(rd.release_date::date) '
-            'FROM "' + ResultsDetail._table + '" rd '
-                'INNER JOIN "' + ResultsSample._table + '" rs '
-                'ON rs.version_detail = rd.id '
-                'INNER JOIN "' + Notebook._table + '" n '
-                'ON n.id = rs.notebook '
-                'INNER JOIN "' + Fraction._table + '" f '
-                'ON f.id = n.fraction '
-            'WHERE f.sample = %s '
-                'AND rd.valid '
-                'AND rd.type != \'preliminary\'',
-            (self.id,))
-        res['results_report_release_date'] = cursor.fetchone()[0] or None
-
+        res['laboratory_end_date'] = None
+        if not counts.get('lines_pending'):
+            res['laboratory_end_date'] = counts.get('max_end_date') or None
+
+        res['laboratory_acceptance_date'] = None
+        if not counts.get('lines_not_accepted'):
+            res['laboratory_acceptance_date'] = (
+                counts.get('max_acceptance_date') or None)
         return res
 
-    def update_sample_state(self):
-        state = self._get_sample_state()
-        if self.state != state:
-            self.state = state
-            self.save()
-
-    def _get_sample_state(self):
-        cursor = Transaction().connection.cursor()
-        pool = Pool()
-        Fraction = pool.get('lims.fraction')
-        Service = pool.get('lims.service')
-        NotebookLine = pool.get('lims.notebook.line')
-
-        if self.results_report_release_date:
+    @classmethod
+    def _get_sample_state(cls, dates, counts):
+        if dates['results_report_release_date']:
             return 'report_released'
 
-        if self.results_report_create_date:
+        if dates['results_report_create_date']:
             return 'in_report'
 
-        cursor.execute('SELECT COUNT(*) '
-            'FROM "' + NotebookLine._table + '" nl '
-                'INNER JOIN "' + Service._table + '" s '
-                'ON s.id = nl.service '
-                'INNER JOIN "' + Fraction._table + '" f '
-                'ON f.id = s.fraction '
-            'WHERE f.sample = %s',
-            (self.id,))
-        all_lines = cursor.fetchone()[0]
+        all_lines = counts.get('all_lines', 0)
         if all_lines == 0:
             return 'draft'
 
-        cursor.execute('SELECT COUNT(*) '
-            'FROM "' + NotebookLine._table + '" nl '
-                'INNER JOIN "' + Service._table + '" s '
-                'ON s.id = nl.service '
-                'INNER JOIN "' + Fraction._table + '" f '
-                'ON f.id = s.fraction '
-            'WHERE f.sample = %s '
-                'AND nl.annulled = TRUE',
-            (self.id,))
-        annulled_lines = cursor.fetchone()[0]
-        if annulled_lines == all_lines:
+        if counts.get('annulled_lines', 0) == all_lines:
             return 'annulled'
 
-        cursor.execute('SELECT COUNT(*) '
-            'FROM "' + NotebookLine._table + '" nl '
-                'INNER JOIN "' + Service._table + '" s '
-                'ON s.id = nl.service '
-                'INNER JOIN "' + Fraction._table + '" f '
-                'ON f.id = s.fraction '
-            'WHERE f.sample = %s '
-                'AND nl.report = FALSE '
-                'AND nl.annulled = FALSE '
-                'AND nl.end_date IS NOT NULL',
-            (self.id,))
-        finished_without_report = cursor.fetchone()[0]
-        if finished_without_report == all_lines:
+        if counts.get('finished_without_report', 0) == all_lines:
             return 'without_report'
 
-        if self.laboratory_acceptance_date:
+        if dates['laboratory_acceptance_date']:
             return 'pending_report'
 
-        if self.laboratory_end_date:
+        if dates['laboratory_end_date']:
             return 'lab_pending_acceptance'
 
-        if self.laboratory_start_date:
-            cursor.execute('SELECT COUNT(*) '
-                'FROM "' + NotebookLine._table + '" nl '
-                    'INNER JOIN "' + Service._table + '" s '
-                    'ON s.id = nl.service '
-                    'INNER JOIN "' + Fraction._table + '" f '
-                    'ON f.id = s.fraction '
-                'WHERE f.sample = %s '
-                    'AND nl.report = TRUE '
-                    'AND nl.annulled = FALSE '
-                    'AND nl.end_date IS NOT NULL',
-                (self.id,))
-            if cursor.fetchone()[0] > 0:
+        if dates['laboratory_start_date']:
+            if counts.get('finished_lines', 0) > 0:
                 return 'in_lab'
             return 'planned'
 
-        if self.confirmation_date:
+        if dates['confirmation_date']:
             return 'pending_planning'
 
-        cursor.execute('SELECT COUNT(*) '
-            'FROM "' + Service._table + '" s '
-                'INNER JOIN "' + Fraction._table + '" f '
-                'ON f.id = s.fraction '
-            'WHERE f.sample = %s '
-                'AND s.annulled = TRUE',
-            (self.id,))
-        annulled_services = cursor.fetchone()[0]
-        if annulled_services > 0:
-            cursor.execute('SELECT COUNT(*) '
-                'FROM "' + Service._table + '" s '
-                    'INNER JOIN "' + Fraction._table + '" f '
-                    'ON f.id = s.fraction '
-                'WHERE f.sample = %s',
-                (self.id,))
-            if cursor.fetchone()[0] == annulled_services:
-                return 'annulled'
+        annulled_services = counts.get('annulled_services', 0)
+        if (annulled_services > 0 and
+                counts.get('all_services', 0) == annulled_services):
+            return 'annulled'
 
         return 'draft'
 
-    def update_qty_lines(self):
-        save = False
-        qty = self._get_qty_lines_pending()
-        if self.qty_lines_pending != qty:
-            self.qty_lines_pending = qty
-            save = True
-        qty = self._get_qty_lines_pending_acceptance()
-        if self.qty_lines_pending_acceptance != qty:
-            self.qty_lines_pending_acceptance = qty
-            save = True
-        if save:
-            self.save()
-
-    def _get_qty_lines_pending(self):
-        cursor = Transaction().connection.cursor()
-        pool = Pool()
-        Fraction = pool.get('lims.fraction')
-        Service = pool.get('lims.service')
-        NotebookLine = pool.get('lims.notebook.line')
-
-        cursor.execute('SELECT COUNT(*) '
-            'FROM "' + NotebookLine._table + '" nl '
-                'INNER JOIN "' + Service._table + '" s '
-                'ON s.id = nl.service '
-                'INNER JOIN "' + Fraction._table + '" f '
-                'ON f.id = s.fraction '
-            'WHERE f.sample = %s '
-                'AND nl.report = TRUE '
-                'AND nl.annulled = FALSE '
-                'AND nl.end_date IS NULL',
-            (self.id,))
-        return cursor.fetchone()[0]
-
-    def _get_qty_lines_pending_acceptance(self):
-        cursor = Transaction().connection.cursor()
-        pool = Pool()
-        Fraction = pool.get('lims.fraction')
-        Service = pool.get('lims.service')
-        NotebookLine = pool.get('lims.notebook.line')
-
-        cursor.execute('SELECT COUNT(*) '
-            'FROM "' + NotebookLine._table + '" nl '
-                'INNER JOIN "' + Service._table + '" s '
-                'ON s.id = nl.service '
-                'INNER JOIN "' + Fraction._table + '" f '
-                'ON f.id = s.fraction '
-            'WHERE f.sample = %s '
-                'AND nl.report = TRUE '
-                'AND nl.annulled = FALSE '
-                'AND nl.end_date IS NOT NULL '
-                'AND nl.acceptance_date IS NULL',
-            (self.id,))
-        return cursor.fetchone()[0]
-
     @classmethod
     def resample(cls, sample, analyses, new_entry=False,
             date=None, label=None):
@@ -7733,86 +7681,80 @@ class CreateSample(Wizard):
     def _get_included_analysis(self, analysis):
         cursor = Transaction().connection.cursor()
         pool = Pool()
+        Analysis = pool.get('lims.analysis')
         Typification = pool.get('lims.typification')
 
         childs = []
-        if analysis.included_analysis:
-            for included in analysis.included_analysis:
-                if included.included_analysis.type == 'analysis':
-
-                    laboratory_id = None
-                    cursor.execute('SELECT laboratory '
-                        'FROM "' + Typification._table + '" '
-                        'WHERE product_type = %s '
-                            'AND matrix = %s '
-                            'AND analysis = %s '
-                            'AND valid IS TRUE '
-                            'AND by_default IS TRUE '
-                            'AND laboratory IS NOT NULL',
-                        (self.start.product_type.id,
-                            self.start.matrix.id,
-                            included.included_analysis.id))
-                    res = cursor.fetchone()
-                    if res:
-                        laboratory_id = res[0]
-                    if not laboratory_id:
-                        for l in included.included_analysis.laboratories:
-                            if l.by_default is True:
-                                laboratory_id = l.laboratory.id
-
-                    method_id = (included.method.id
-                        if included.method else None)
-                    if method_id:
-                        cursor.execute('SELECT id '
-                            'FROM "' + Typification._table + '" '
-                            'WHERE product_type = %s '
-                                'AND matrix = %s '
-                                'AND analysis = %s '
-                                'AND method = %s '
-                                'AND valid IS TRUE',
-                            (self.start.product_type.id,
-                                self.start.matrix.id,
-                                included.included_analysis.id,
-                                method_id))
-                        res = cursor.fetchone()
-                        if not res:
-                            method_id = None
-                    else:
-                        cursor.execute('SELECT method '
-                            'FROM "' + Typification._table + '" '
-                            'WHERE product_type = %s '
-                                'AND matrix = %s '
-                                'AND analysis = %s '
-                                'AND valid IS TRUE '
-                                'AND by_default IS TRUE',
-                            (self.start.product_type.id,
-                                self.start.matrix.id,
-                                included.included_analysis.id))
-                        res = cursor.fetchone()
-                        if res:
-                            method_id = res[0]
-
-                    if not method_id:
-                        raise UserError(gettext(
-                            'lims.msg_included_no_method',
-                            included=included.included_analysis.rec_name,
-                            analysis=analysis.rec_name))
-
-                    device_id = None
-                    if included.included_analysis.devices:
-                        for d in included.included_analysis.devices:
-                            if (d.laboratory.id == laboratory_id and
-                                    d.by_default is True):
-                                device_id = d.device.id
-
-                    childs.append({
-                        'analysis': included.included_analysis.id,
-                        'laboratory': laboratory_id,
-                        'method': method_id,
-                        'device': device_id,
-                        })
-                childs.extend(self._get_included_analysis(
-                    included.included_analysis))
+        for (path, parent_id, parent_type, included_id, included_type,
+                included_code, method_id) in Analysis.get_included_paths(
+                analysis.id, 'analysis'):
+            included_analysis = Analysis(included_id)
+
+            laboratory_id = None
+            cursor.execute('SELECT laboratory '
+                'FROM "' + Typification._table + '" '
+                'WHERE product_type = %s '
+                    'AND matrix = %s '
+                    'AND analysis = %s '
+                    'AND valid IS TRUE '
+                    'AND by_default IS TRUE '
+                    'AND laboratory IS NOT NULL',
+                (self.start.product_type.id, self.start.matrix.id,
+                    included_id))
+            res = cursor.fetchone()
+            if res:
+                laboratory_id = res[0]
+            if not laboratory_id:
+                for l in included_analysis.laboratories:
+                    if l.by_default is True:
+                        laboratory_id = l.laboratory.id
+
+            if method_id:
+                cursor.execute('SELECT id '
+                    'FROM "' + Typification._table + '" '
+                    'WHERE product_type = %s '
+                        'AND matrix = %s '
+                        'AND analysis = %s '
+                        'AND method = %s '
+                        'AND valid IS TRUE',
+                    (self.start.product_type.id, self.start.matrix.id,
+                        included_id, method_id))
+                res = cursor.fetchone()
+                if not res:
+                    method_id = None
+            else:
+                cursor.execute('SELECT method '
+                    'FROM "' + Typification._table + '" '
+                    'WHERE product_type = %s '
+                        'AND matrix = %s '
+                        'AND analysis = %s '
+                        'AND valid IS TRUE '
+                        'AND by_default IS TRUE',
+                    (self.start.product_type.id, self.start.matrix.id,
+                        included_id))
+                res = cursor.fetchone()
+                if res:
+                    method_id = res[0]
+
+            if not method_id:
+                raise UserError(gettext(
+                    'lims.msg_included_no_method',
+                    included=included_analysis.rec_name,
+                    analysis=Analysis(parent_id).rec_name))
+
+            device_id = None
+            if included_analysis.devices:
+                for d in included_analysis.devices:
+                    if (d.laboratory.id == laboratory_id and
+                            d.by_default is True):
+                        device_id = d.device.id
+
+            childs.append({
+                'analysis': included_id,
+                'laboratory': laboratory_id,
+                'method': method_id,
+                'device': device_id,
+                })
         return childs
 
     def _get_labels_list(self, labels=None):
@@ -3,7 +3,10 @@
 # the full copyright notices and license terms.
 import unittest
 import doctest
+import os
+import smtplib
 from datetime import date
+from unittest import mock
 
 import trytond.tests.test_tryton
 from trytond.pool import Pool
@@ -113,6 +116,350 @@ class LimsTestCase(ModuleTestCase):
         result = dec.get_target_date(date(2026, 12, 28), 5)
         self.assertEqual(result, date(2027, 1, 5))
 
+    @with_transaction()
+    def test_id_set_clause(self):
+        "Id sets are bound as params or filtered with joins"
+        from trytond.modules.lims.tools import id_set_clause
+
+        self.assertEqual(id_set_clause('nl.id', []), ('FALSE', []))
+        self.assertEqual(id_set_clause('nl.id', [], exclude=True),
+            ('TRUE', []))
+        self.assertEqual(id_set_clause('nl.id', [1, 2]),
+            ('nl.id = ANY(%s::integer[])', [[1, 2]]))
+        self.assertEqual(id_set_clause('nl.id', [1, 2], exclude=True),
+            ('nl.id != ALL(%s::integer[])', [[1, 2]]))
+
+        clause, params = id_set_clause('nl.id',
+            ('SELECT id FROM foo WHERE bar = %s', [3]), exclude=True)
+        self.assertTrue(clause.startswith('NOT EXISTS ('))
+        self.assertEqual(params, [3])
+
+        clause, params = id_set_clause(('nb.fraction', 'srv.analysis'),
+            [(1, 10), (2, 20)])
+        self.assertIn('UNNEST(%s::integer[], %s::integer[])', clause)
+        self.assertEqual(params, [[1, 2], [10, 20]])
+
+        cursor = Transaction().connection.cursor()
+        clause, params = id_set_clause('t.id', range(20000))
+        cursor.execute('SELECT COUNT(*) FROM '
+            '(SELECT generate_series(0, 29999) AS id) t '
+            'WHERE ' + clause, params)
+        self.assertEqual(cursor.fetchone()[0], 20000)
+
+    @with_transaction()
+    def test_included_analysis_closure(self):
+        "Included analysis are resolved from the closure table"
+        pool = Pool()
+        Analysis = pool.get('lims.analysis')
+        AnalysisIncluded = pool.get('lims.analysis.included')
+
+        def create(code, type_):
+            analysis, = Analysis.create([{
+                'code': code,
+                'description': code,
+                'type': type_,
+                'behavior': 'normal',
+                }])
+            return analysis.id
+
+        group = create('G', 'group')
+        set_ = create('S', 'set')
+        analysis1 = create('A1', 'analysis')
+        analysis2 = create('A2', 'analysis')
+        AnalysisIncluded.create([
+            {'analysis': set_, 'included_analysis': analysis1},
+            {'analysis': group, 'included_analysis': set_},
+            {'analysis': group, 'included_analysis': analysis2},
+            ])
+
+        self.assertEqual(Analysis.get_included_analysis(group),
+            [set_, analysis1, analysis2])
+        self.assertEqual(Analysis.get_included_analysis_analysis(group),
+            [analysis1, analysis2])
+        self.assertEqual([p[5] for p in Analysis.get_included_paths(group)],
+            ['S', 'A1', 'A2'])
+
+        AnalysisIncluded.delete(AnalysisIncluded.search([
+            ('analysis', '=', set_),
+            ]))
+        self.assertEqual(Analysis.get_included_analysis(group),
+            [set_, analysis2])
+
+    def test_smtp_sender(self):
+        "Messages share a connection that is reopened on temporary errors"
+        from trytond.modules.lims.tools import SMTPSender
+
+        class Server:
+            def __init__(self, errors):
+                self.errors = errors
+                self.sent = []
+
+            def sendmail(self, from_addr, to_addrs, msg):
+                if self.errors:
+                    raise self.errors.pop(0)
+                self.sent.append(msg)
+
+            def quit(self):
+                pass
+
+        server = Server([smtplib.SMTPServerDisconnected()])
+        with mock.patch('trytond.modules.lims.tools.get_smtp_server',
+                return_value=server) as get_smtp_server:
+            with SMTPSender(retries=1, backoff=0) as sender:
+                sender.send('a@example.com', ['b@example.com'], 'first')
+                sender.send('a@example.com', ['b@example.com'], 'second')
+        self.assertEqual(server.sent, ['first', 'second'])
+        self.assertEqual(get_smtp_server.call_count, 2)
+
+        server = Server([smtplib.SMTPResponseException(550, b'Rejected')])
+        with mock.patch('trytond.modules.lims.tools.get_smtp_server',
+                return_value=server):
+            with SMTPSender(retries=1, backoff=0) as sender:
+                with self.assertRaises(smtplib.SMTPResponseException):
+                    sender.send('a@example.com', ['b@example.com'], 'mail')
+
+    def test_worker_pool(self):
+        "Functions are run in persistent worker processes"
+        import operator
+        from trytond.modules.lims.tools import WorkerPool
+
+        with WorkerPool(2) as pool:
+            self.assertEqual(list(pool.map(operator.mul, [1, 2], [3, 4])),
+                [3, 8])
+            with self.assertRaises(ValueError):
+                pool.submit(int, 'x').result()
+
+        with WorkerPool(1) as pool:
+            pids = {pool.submit(os.getpid).result() for _ in range(3)}
+            self.assertEqual(len(pids), 1)
+            self.assertNotIn(os.getpid(), pids)
+            with self.assertRaises(RuntimeError):
+                pool.submit(os._exit, 1).result()
+            self.assertNotIn(pool.submit(os.getpid).result(), pids)
+
+    @with_transaction()
+    def test_mail_outbox(self):
+        "Queued messages are retried on temporary errors"
+        from email.mime.text import MIMEText
+        from trytond.modules.lims.tools import SMTPSender
+        pool = Pool()
+        MailOutbox = pool.get('lims.mail.outbox')
+
+        class Sender:
+            is_temporary = staticmethod(SMTPSender.is_temporary)
+
+            def __init__(self, errors):
+                self.errors = errors
+                self.sent = []
+
+            def send(self, from_addr, to_addrs, msg):
+                if self.errors:
+                    raise self.errors.pop(0)
+                self.sent.append((to_addrs, msg))
+
+        msg = MIMEText('Body')
+        msg['Subject'] = 'Report'
+        mail = MailOutbox.enqueue('a@example.com',
+            ['c@example.com', 'b@example.com', 'c@example.com'], msg)
+        self.assertEqual(mail.state, 'pending')
+        self.assertEqual(mail.subject, 'Report')
+        self.assertEqual(mail.to_addrs, 'b@example.com\nc@example.com')
+
+        sender = Sender([smtplib.SMTPResponseException(451, b'Busy')])
+        self.assertTrue(mail._send(sender))
+        self.assertEqual(mail.state, 'pending')
+        self.assertEqual(mail.attempts, 1)
+        self.assertIsNotNone(mail.next_attempt)
+
+        self.assertTrue(mail._send(sender))
+        self.assertEqual(mail.state, 'sent')
+        self.assertEqual(sender.sent[0][0],
+            ['b@example.com', 'c@example.com'])
+
+        sender = Sender([smtplib.SMTPServerDisconnected()])
+        self.assertFalse(mail._send(sender))
+
+        sender = Sender([smtplib.SMTPResponseException(550, b'Rejected')])
+        mail.state = 'pending'
+        self.assertTrue(mail._send(sender))
+        self.assertEqual(mail.state, 'failed')
+
+    @with_transaction()
+    def test_mail_outbox_origins(self):
+        "The origins are notified when their mails are sent or failed"
+        pool = Pool()
+        MailOutbox = pool.get('lims.mail.outbox')
+        User = pool.get('res.user')
+
+        user = User(Transaction().user)
+        with mock.patch.object(MailOutbox, '_get_origin',
+                return_value=['res.user']):
+            mails = [MailOutbox.enqueue('a@example.com', ['b@example.com'],
+                    'mail', [user]) for _ in range(3)]
+        self.assertEqual([o.origin for o in mails[0].origins], [user])
+
+        mails[0].state = 'sent'
+        mails[1].state = 'failed'
+        with mock.patch.object(User, 'mail_sent', create=True) as sent, \
+                mock.patch.object(User, 'mail_failed', create=True) as failed:
+            MailOutbox._update_origins(mails)
+        sent.assert_called_once_with([user])
+        failed.assert_called_once_with([user])
+
+    @with_transaction()
+    def test_samples_state_deferred(self):
+        "Deferred samples state is recomputed once per flush or commit"
+        from trytond.modules.lims.sample import SamplesStateDataManager
+        pool = Pool()
+        Sample = pool.get('lims.sample')
+        transaction = Transaction()
+
+        update_samples_state = Sample.update_samples_state
+        updates = []
+
+        def update(sample_ids):
+            if transaction.context.get('defer_samples_state'):
+                return update_samples_state(sample_ids)
+            updates.append(sorted(sample_ids))
+
+        with mock.patch.object(Sample, 'update_samples_state',
+                side_effect=update):
+            with transaction.set_context(defer_samples_state=True):
+                Sample.update_samples_state([1, 2])
+                Sample.update_samples_state([2, 3, 3])
+            self.assertEqual(updates, [])
+            Sample.flush_samples_state()
+            self.assertEqual(updates, [[1, 2, 3]])
+            Sample.flush_samples_state()
+            self.assertEqual(updates, [[1, 2, 3]])
+
+            with transaction.set_context(defer_samples_state=True):
+                Sample.update_samples_state([4])
+                Sample.update_samples_state([4])
+            transaction.join(SamplesStateDataManager()).commit(transaction)
+            self.assertEqual(updates, [[1, 2, 3], [4]])
+
+    def test_tendency_rules(self):
+        "Control rules are evaluated incrementally"
+        from trytond.modules.lims.control_tendency import TendencyRules
+
+        class Tendency:
+            mean = 0.0
+            one_sd_adj = 1.0
+            two_sd_adj = 2.0
+            three_sd_adj = 3.0
+
+        checker = TendencyRules(Tendency())
+        self.assertEqual(checker.add(3.5), ['4'])
+        self.assertEqual(checker.add(0.0), [''])
+        self.assertEqual(checker.add(2.5), [''])
+        self.assertEqual(checker.add(-2.5), [''])
+        self.assertEqual(checker.add(-2.5), ['3'])
+        self.assertEqual(checker.add(0.0), ['3'])
+        self.assertEqual(checker.add(0.0), [''])
+
+        checker = TendencyRules(Tendency())
+        for result in (1.5, 1.5, 1.5, 1.5):
+            self.assertEqual(checker.add(result), [''])
+        self.assertEqual(checker.add(0.5), ['2'])
+        for result in (0.5, 0.5):
+            self.assertEqual(checker.add(result), [''])
+        self.assertEqual(checker.add(0.5), ['1'])
+        self.assertEqual(checker.add(-0.5), [''])
+
+    def test_lru_cache(self):
+        "Values are computed once and the least recently used evicted"
+        from trytond.modules.lims.tools import LRUCache
+
+        computed = []
+
+        def compute(value):
+            computed.append(value)
+            return value
+
+        cache = LRUCache(2)
+        self.assertEqual(cache.compute('a', compute, 1), 1)
+        self.assertEqual(cache.compute('a', compute, 2), 1)
+        self.assertEqual(computed, [1])
+
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    def test_plot_cache(self):
+        "Rendered charts are evicted by count and rendered once"
+        from trytond.modules.lims.control_tendency import PlotCache
+
+        renders = []
+
+        def render(image):
+            renders.append(image)
+            return image
+
+        cache = PlotCache(2)
+        self.assertEqual(cache.compute('a', render, b'aaaa'), b'aaaa')
+        self.assertEqual(cache.compute('a', render, b'xxxx'), b'aaaa')
+        self.assertEqual(renders, [b'aaaa'])
+
+        cache.compute('b', render, b'bbbb')
+        cache.compute('c', render, b'cccc')
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('b'), b'bbbb')
+        self.assertEqual(len(cache), 2)
+
+        cache.submit('d', render, b'dd')
+        self.assertEqual(cache.get('d'), b'dd')
+
+    @with_transaction()
+    def test_global_report_languages(self):
+        "The merged global report is stored for each language"
+        pool = Pool()
+        ResultsReport = pool.get('lims.results_report')
+        Party = pool.get('party.party')
+        Lang = pool.get('ir.lang')
+
+        today = date.today()
+        self._create_workyear(str(today.year), date(today.year, 1, 1),
+            date(today.year, 12, 31), self._create_sequences())
+        english, = Lang.search([('code', '=', 'en')])
+        spanish, = Lang.search([('code', '=', 'es')])
+        party, = Party.create([{'name': 'Customer'}])
+        report, = ResultsReport.create([{
+            'party': party.id,
+            'report_language': english.id,
+            }])
+
+        def merge(reports, output):
+            merges.append(list(reports))
+            output.write(b''.join(reports))
+
+        def get_key(details, language):
+            return keys[language.code], [language.code.encode()]
+
+        merges = []
+        keys = {'en': 'en-1', 'es': 'es-1'}
+        with mock.patch('trytond.modules.lims.results_report.'
+                'merge_pdf_reports', side_effect=merge), \
+                mock.patch.object(ResultsReport, '_get_global_report_key',
+                    side_effect=get_key), \
+                mock.patch.object(ResultsReport,
+                    '_get_cached_reports_content', side_effect=iter):
+            for language in (english, spanish, english, spanish):
+                self.assertEqual(report._get_global_report([], language),
+                    language.code.encode())
+            self.assertEqual(merges, [[b'en'], [b'es']])
+
+            keys['en'] = 'en-2'
+            report._get_global_report([], english)
+            report._get_global_report([], spanish)
+            self.assertEqual(merges, [[b'en'], [b'es'], [b'en']])
+
 
 def suite():
     suite = trytond.tests.test_tryton.suite()
@@ -0,0 +1,309 @@
+# This file is part of lims module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import logging
+import os
+import pickle
+import smtplib
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
+from tempfile import TemporaryFile
+from threading import Lock, local
+from PyPDF2 import PdfFileMerger
+
+from trytond.cache import LRUDict
+from trytond.config import config
+from trytond.tools import get_smtp_server
+from trytond.transaction import Transaction
+
+from .worker import read_message, write_message
+
+# Sets bigger than this are loaded in a temporary table instead of being
+# bound as an array parameter
+ID_SET_TEMP_TABLE_SIZE = 10000
+# Deliveries that fail with a temporary error are retried this many times,
+# waiting the backoff seconds doubled on each attempt
+SMTP_RETRIES = config.getint('lims', 'smtp_retries', default=3)
+SMTP_BACKOFF = config.getfloat('lims', 'smtp_backoff', default=1)
+
+# Script run by the worker processes
+WORKER_SCRIPT = os.path.join(os.path.dirname(__file__), 'worker.py')
+
+logger = logging.getLogger(__name__)
+
+_temp_table_counter = count()
+
+
+def id_set_clause(columns, ids, exclude=False):
+    """
+    Returns a SQL condition and its params that filters columns by a set
+    of ids, to be used in raw queries instead of building 'IN (1, 2, ...)'
+    lists by string concatenation.
+
+    columns is a column expression (i.e. 'nl.id') or a tuple of them to
+    filter by composite keys (then ids are tuples of the same length).
+    ids is an iterable of ids or a (query, params) tuple with a subquery
+    that returns them; a subquery is filtered with a semi or anti join,
+    a list of ids is bound as an array parameter or, if it is big and the
+    transaction allows it, loaded in a session temporary table.
+    If exclude is True the condition selects the rows not in the set.
+    """
+    if isinstance(columns, str):
+        columns = (columns,)
+    if isinstance(ids, tuple) and len(ids) == 2 and isinstance(ids[0], str):
+        sql_query, sql_params = ids
+        return _exists_clause(columns, sql_query, list(sql_params), exclude)
+
+    ids = list(ids)
+    if not ids:
+        return ('TRUE' if exclude else 'FALSE'), []
+
+    if len(columns) == 1:
+        ids = [(i,) for i in ids]
+    arrays = [list(values) for values in zip(*ids)]
+
+    transaction = Transaction()
+    if len(ids) > ID_SET_TEMP_TABLE_SIZE and not transaction.readonly:
+        table = _create_temp_table(arrays)
+        return _exists_clause(columns, 'SELECT * FROM "%s"' % table, [],
+            exclude)
+
+    if len(columns) == 1:
+        if exclude:
+            return '%s != ALL(%%s::integer[])' % columns[0], arrays
+        return '%s = ANY(%%s::integer[])' % columns[0], arrays
+
+    sql_query = 'SELECT * FROM UNNEST(%s)' % ', '.join(
+        ['%s::integer[]'] * len(arrays))
+    return _exists_clause(columns, sql_query, arrays, exclude)
+
+
+def _exists_clause(columns, sql_query, sql_params, exclude):
+    alias = 'ids_set'
+    alias_columns = ['id%s' % i for i in range(len(columns))]
+    condition = ' AND '.join('%s.%s = %s' % (alias, a, c)
+        for a, c in zip(alias_columns, columns))
+    sql_clause = ('EXISTS (SELECT 1 FROM (' + sql_query + ') '
+        'AS ' + alias + '(' + ', '.join(alias_columns) + ') '
+        'WHERE ' + condition + ')')
+    if exclude:
+        sql_clause = 'NOT ' + sql_clause
+    return sql_clause, sql_params
+
+
+def _create_temp_table(arrays):
+    cursor = Transaction().connection.cursor()
+    table = 'lims_id_set_%s' % next(_temp_table_counter)
+    alias_columns = ['id%s' % i for i in range(len(arrays))]
+    cursor.execute('CREATE TEMPORARY TABLE "' + table + '" (' +
+        ', '.join('%s INTEGER' % c for c in alias_columns) + ') '
+        'ON COMMIT DROP')
+    cursor.execute('INSERT INTO "' + table + '" '
+        'SELECT * FROM UNNEST(' + ', '.join(
+            ['%s::integer[]'] * len(arrays)) + ')', arrays)
+    cursor.execute('ANALYZE "' + table + '"')
+    return table
+
+
+def merge_pdf_reports(reports, output):
+    """
+    Merges the PDF reports into output, a file or the path of a file.
+    reports yields the content or the path of the file of each report,
+    the contents are spooled to temporary files one at a time.
+    It only takes bytes and paths, so it can be run in a worker process
+    """
+    merger = PdfFileMerger(strict=False)
+    files = []
+    try:
+        for report in reports:
+            if isinstance(report, str):
+                filedata = open(report, 'rb')
+            else:
+                filedata = TemporaryFile()
+                filedata.write(report)
+                filedata.seek(0)
+            files.append(filedata)
+            merger.append(filedata)
+            del report
+        if isinstance(output, str):
+            with open(output, 'wb') as output:
+                merger.write(output)
+        else:
+            merger.write(output)
+    finally:
+        merger.close()
+        for filedata in files:
+            filedata.close()
+
+
+class LRUCache:
+    """
+    Process-wide cache of values that are expensive to compute, shared
+    between the threads of the process and evicting the least recently
+    used values over size_limit.
+    """
+
+    def __init__(self, size_limit):
+        self._cache = LRUDict(size_limit)
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def get(self, key):
+        with self._lock:
+            value = self._cache.get(key)
+            if value is not None:
+                self._cache.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._cache[key] = value
+
+    def compute(self, key, func, *args):
+        """
+        Returns the cached value of key, computed with func(*args) and
+        cached if it is missing
+        """
+        value = self.get(key)
+        if value is None:
+            value = func(*args)
+            self.set(key, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+
+class WorkerPool:
+    """
+    Runs functions in up to max_workers worker processes at once, with
+    the interface of concurrent.futures executors.
+
+    The workers are started with the first tasks and kept until the pool
+    is shut down; initializer(*initargs) is called once in each of them
+    (i.e. to import the libraries of the tasks). They run lims/worker.py
+    by path so, unlike the spawn and forkserver processes of
+    multiprocessing, they do not import the __main__ module of the server
+    (the trytond and trytond-cron scripts have no main guard and would be
+    started again) and they only import the modules of the functions they
+    run, not the whole Tryton modules.
+    The functions, their arguments and results must be picklable and the
+    functions can not use the database.
+    """
+
+    def __init__(self, max_workers, initializer=None, initargs=()):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+            thread_name_prefix='lims_worker')
+        self._init = pickle.dumps((initializer, initargs))
+        self._local = local()
+        self._processes = []
+        self._lock = Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+    def _get_process(self):
+        "Returns the worker process of the current thread of the pool"
+        process = getattr(self._local, 'process', None)
+        if process is None or process.poll() is not None:
+            env = os.environ.copy()
+            env['PYTHONPATH'] = os.pathsep.join(p for p in sys.path if p)
+            process = subprocess.Popen([sys.executable, WORKER_SCRIPT],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env)
+            write_message(process.stdin, self._init)
+            self._local.process = process
+            with self._lock:
+                self._processes.append(process)
+        return process
+
+    def _run(self, func, args, kwargs):
+        process = self._get_process()
+        try:
+            write_message(process.stdin, pickle.dumps((func, args, kwargs)))
+            data = read_message(process.stdout)
+        except (OSError, EOFError):
+            data = None
+        if data is None:
+            process.kill()
+            raise RuntimeError('Worker process exited with status %s'
+                % process.wait())
+        success, result = pickle.loads(data)
+        if not success:
+            raise result
+        return result
+
+    def submit(self, func, *args, **kwargs):
+        return self._executor.submit(self._run, func, args, kwargs)
+
+    def map(self, func, *iterables):
+        return self._executor.map(
+            lambda *args: self._run(func, args, {}), *iterables)
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+        with self._lock:
+            processes, self._processes = self._processes, []
+        for process in processes:
+            process.stdin.close()
+            if wait:
+                process.wait()
+
+
+class SMTPSender:
+    """
+    Sends messages through one SMTP connection, that is opened with the
+    first message and reopened if the server drops it. Deliveries that
+    fail with a temporary error are retried with an exponential backoff.
+    """
+
+    def __init__(self, retries=SMTP_RETRIES, backoff=SMTP_BACKOFF):
+        self.retries = retries
+        self.backoff = backoff
+        self._server = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def send(self, from_addr, to_addrs, msg):
+        if not isinstance(msg, (str, bytes)):
+            msg = msg.as_string()
+        for attempt in range(self.retries + 1):
+            try:
+                if self._server is None:
+                    self._server = get_smtp_server()
+                return self._server.sendmail(from_addr, to_addrs, msg)
+            except Exception as e:
+                self.close()
+                if attempt == self.retries or not self.is_temporary(e):
+                    raise
+                logger.warning('SMTP delivery failed, retrying: %s', e)
+                time.sleep(self.backoff * 2 ** attempt)
+
+    @staticmethod
+    def is_temporary(error):
+        if isinstance(error, smtplib.SMTPResponseException):
+            return 400 <= error.smtp_code < 500
+        if isinstance(error, smtplib.SMTPRecipientsRefused):
+            return False
+        return isinstance(error, OSError)
+
+    def close(self):
+        if self._server is None:
+            return
+        try:
+            self._server.quit()
+        except Exception:
+            pass
+        self._server = None
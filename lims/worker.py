@@ -0,0 +1,113 @@
+# This file is part of lims module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+"""
+Entry point of the worker processes of lims.tools.WorkerPool. It is run
+by path and only uses the standard library, so a worker does not import
+the lims module nor the __main__ module of the server.
+
+The packages of the Tryton modules are registered without running their
+__init__, which would import and register the whole module: a worker
+only imports the modules of the functions it runs.
+
+Messages are pickles prefixed by their length. The worker reads the
+pickled (initializer, initargs) tuple and then runs each pickled
+(function, args, kwargs) task, writing the pickled (success, result or
+exception) tuple, until its input is closed.
+"""
+import os
+import sys
+
+if __name__ == '__main__':
+    # sys.path[0] is the directory of the script, do not let the modules
+    # of lims shadow other modules
+    del sys.path[0]
+
+import importlib.abc
+import importlib.machinery
+import pickle
+import struct
+import traceback
+
+HEADER = struct.Struct('!Q')
+
+
+def read_message(stream):
+    "Returns the next message of stream or None if it is closed"
+    header = stream.read(HEADER.size)
+    if not header:
+        return None
+    size, = HEADER.unpack(header)
+    data = stream.read(size)
+    if len(data) != size:
+        raise EOFError('Truncated worker message')
+    return data
+
+
+def write_message(stream, data):
+    stream.write(HEADER.pack(len(data)) + data)
+    stream.flush()
+
+
+class ModulePackageFinder(importlib.abc.MetaPathFinder,
+        importlib.abc.Loader):
+    "Creates the packages of the Tryton modules without running __init__"
+
+    def find_spec(self, fullname, path, target=None):
+        parts = fullname.split('.')
+        if len(parts) != 3 or parts[:2] != ['trytond', 'modules']:
+            return None
+        for entry in path or []:
+            directory = os.path.join(entry, parts[2])
+            if os.path.isfile(os.path.join(directory, '__init__.py')):
+                spec = importlib.machinery.ModuleSpec(fullname, self,
+                    is_package=True)
+                spec.submodule_search_locations = [directory]
+                return spec
+        return None
+
+    def create_module(self, spec):
+        return None
+
+    def exec_module(self, module):
+        pass
+
+
+def run(func, args, kwargs):
+    try:
+        return pickle.dumps((True, func(*args, **kwargs)))
+    except Exception as e:
+        try:
+            return pickle.dumps((False, e))
+        except Exception:
+            return pickle.dumps(
+                (False, RuntimeError(traceback.format_exc())))
+
+
+def main():
+    # anything printed by the functions goes to stderr
+    output = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    input_ = sys.stdin.buffer
+    sys.meta_path.insert(0, ModulePackageFinder())
+
+    initializer, initargs = pickle.loads(read_message(input_))
+    if initializer is not None:
+        initializer(*initargs)
+    with output:
+        while True:
+            data = read_message(input_)
+            if data is None:
+                break
+            try:
+                func, args, kwargs = pickle.loads(data)
+            except Exception:
+                result = pickle.dumps(
+                    (False, RuntimeError(traceback.format_exc())))
+            else:
+                result = run(func, args, kwargs)
+            write_message(output, result)
+
+
+if __name__ == '__main__':
+    main()
@@ -21,6 +21,7 @@ def register():
         invoice.InvoiceContact,
         invoice.Invoice,
         invoice.InvoiceLine,
+        invoice.MailOutbox,
         stock.InventoryLine,
         product.Product,
         lims.FractionType,
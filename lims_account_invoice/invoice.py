@@ -19,7 +19,6 @@ from trytond.wizard import Wizard, StateTransition, StateView, StateAction, \
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval, Bool, Or, If, PYSONEncoder
 from trytond.transaction import Transaction
-from trytond.tools import get_smtp_server
 from trytond.config import config
 from trytond.exceptions import UserError
 from trytond.i18n import gettext
@@ -211,17 +210,30 @@ class Invoice(metaclass=PoolMeta):
             msg.attach(attachment)
         return msg
 
+    @classmethod
+    def mail_sent(cls, invoices):
+        cls.write(invoices, {'sent': True, 'sent_date': datetime.now()})
+
+    @classmethod
+    def mail_failed(cls, invoices):
+        '''
+        Marks the invoices as not sent when their email could not be
+        delivered, so they are sent again
+        '''
+        cls.write(invoices, {'sent': False, 'sent_date': None})
+
     def send_msg(self, from_addr, to_addrs, msg):
-        to_addrs = list(set(to_addrs))
-        success = False
-        try:
-            server = get_smtp_server()
-            server.sendmail(from_addr, to_addrs, msg.as_string())
-            server.quit()
-            success = True
-        except Exception:
-            logger.error('Unable to deliver mail for invoice %s', self.number)
-        return success
+        MailOutbox = Pool().get('lims.mail.outbox')
+        MailOutbox.enqueue(from_addr, to_addrs, msg, [self])
+        return True
+
+
+class MailOutbox(metaclass=PoolMeta):
+    __name__ = 'lims.mail.outbox'
+
+    @classmethod
+    def _get_origin(cls):
+        return super()._get_origin() + ['account.invoice']
 
 
 class InvoiceContact(ModelSQL, ModelView):
@@ -532,7 +544,7 @@ class SendOfInvoice(Wizard):
                             'Factura %s:Envio fallido!', invoice.number)
                     continue
                 logger.info('SendOfInvoice:transition_start():'
-                        'Factura %s:Envio exitoso.', invoice.number)
+                        'Factura %s:Envio encolado.', invoice.number)
                 invoice.sent = True
                 invoice.sent_date = datetime.now()
                 invoice.save()
@@ -14,6 +14,7 @@ from trytond.pyson import PYSONEncoder
 from trytond.transaction import Transaction
 from trytond.exceptions import UserError
 from trytond.i18n import gettext
+from trytond.modules.lims.tools import id_set_clause
 
 
 class FractionType(metaclass=PoolMeta):
@@ -45,26 +46,26 @@ class Entry(metaclass=PoolMeta):
         Fraction = pool.get('lims.fraction')
         Sample = pool.get('lims.sample')
 
-        result = {}
-        for e in entries:
-            cursor.execute('SELECT MAX(rd.release_date) '
-                'FROM "' + ResultsVersion._table + '" rv '
-                    'INNER JOIN "' + ResultsDetail._table + '" rd '
-                    'ON rv.id = rd.report_version '
-                    'INNER JOIN "' + NotebookLine._table + '" nl '
-                    'ON nl.results_report = rv.results_report '
-                    'INNER JOIN "' + Notebook._table + '" n '
-                    'ON n.id = nl.notebook '
-                    'INNER JOIN "' + Fraction._table + '" f '
-                    'ON f.id = n.fraction '
-                    'INNER JOIN "' + Sample._table + '" s '
-                    'ON s.id = f.sample '
-                'WHERE s.entry = %s '
-                    'AND rd.state = \'released\' '
-                    'AND rd.type != \'preliminary\'',
-                (str(e.id),))
-            result[e.id] = cursor.fetchone()[0]
-
+        result = dict.fromkeys([e.id for e in entries])
+        entry_clause, entry_params = id_set_clause('s.entry', result.keys())
+        cursor.execute('SELECT s.entry, MAX(rd.release_date) '
+            'FROM "' + ResultsVersion._table + '" rv '
+                'INNER JOIN "' + ResultsDetail._table + '" rd '
+                'ON rv.id = rd.report_version '
+                'INNER JOIN "' + NotebookLine._table + '" nl '
+                'ON nl.results_report = rv.results_report '
+                'INNER JOIN "' + Notebook._table + '" n '
+                'ON n.id = nl.notebook '
+                'INNER JOIN "' + Fraction._table + '" f '
+                'ON f.id = n.fraction '
+                'INNER JOIN "' + Sample._table + '" s '
+                'ON s.id = f.sample '
+            'WHERE ' + entry_clause + ' '
+                'AND rd.state = \'released\' '
+                'AND rd.type != \'preliminary\' '
+            'GROUP BY s.entry',
+            entry_params)
+        result.update(cursor.fetchall())
         return result
 
     @classmethod
@@ -76,30 +77,25 @@ class Entry(metaclass=PoolMeta):
         Service = pool.get('lims.service')
         InvoiceLine = pool.get('account.invoice.line')
 
-        result = {}
-        for e in entries:
-            result[e.id] = 0
-
-            cursor.execute('SELECT srv.id '
-                'FROM "' + Service._table + '" srv '
-                    'INNER JOIN "' + Fraction._table + '" f '
-                    'ON f.id = srv.fraction '
-                    'INNER JOIN "' + Sample._table + '" s '
-                    'ON s.id = f.sample '
-                'WHERE s.entry = %s',
-                (str(e.id),))
-            services_ids = [x[0] for x in cursor.fetchall()]
-            if not services_ids:
-                continue
-
-            origins = '\', \''.join(['lims.service,' + str(s)
-                for s in services_ids])
-            cursor.execute('SELECT COUNT(*) '
-                'FROM "' + InvoiceLine._table + '" '
-                'WHERE origin IN (\'' + origins + '\') '
-                    'AND invoice IS NULL')
-            result[e.id] = cursor.fetchone()[0]
-
+        result = dict.fromkeys([e.id for e in entries], 0)
+        entry_clause, entry_params = id_set_clause('s.entry', result.keys())
+        # Invoice lines are matched by the id of their service origin
+        cursor.execute('SELECT s.entry, COUNT(il.id) '
+            'FROM "' + InvoiceLine._table + '" il '
+                'INNER JOIN "' + Service._table + '" srv '
+                'ON srv.id = CASE WHEN il.origin LIKE \'lims.service,%%\' '
+                    'THEN CAST(SPLIT_PART(il.origin, \',\', 2) '
+                    'AS INTEGER) END '
+                'INNER JOIN "' + Fraction._table + '" f '
+                'ON f.id = srv.fraction '
+                'INNER JOIN "' + Sample._table + '" s '
+                'ON s.id = f.sample '
+            'WHERE ' + entry_clause + ' '
+                'AND il.origin LIKE \'lims.service,%%\' '
+                'AND il.invoice IS NULL '
+            'GROUP BY s.entry',
+            entry_params)
+        result.update(cursor.fetchall())
         return result
 
     @classmethod
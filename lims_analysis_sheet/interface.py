@@ -70,6 +70,12 @@ class Compilation(metaclass=PoolMeta):
             new_lines = False
         super().collect_excel(create_new_lines=new_lines)
 
+    def collect_txt(self, create_new_lines=True):
+        new_lines = create_new_lines
+        if self.analysis_sheet:
+            new_lines = False
+        super().collect_txt(create_new_lines=new_lines)
+
 
 class Column(metaclass=PoolMeta):
     __name__ = 'lims.interface.column'
@@ -37,133 +37,69 @@ class NotebookLine(metaclass=PoolMeta):
     
 
     def get_analysis_sheet_template(self):
+        return self.get_analysis_sheet_templates([self]).get(self.id)
+
+    @classmethod
+    def get_analysis_sheet_templates(cls, lines):
+        '''
+        Returns the analysis sheet template of each notebook line, looking
+        for the template analysis that matches the analysis, method,
+        product type and matrix of the line, from the most to the least
+        specific one
+        '''
         cursor = Transaction().connection.cursor()
         pool = Pool()
         Template = pool.get('lims.template.analysis_sheet')
         TemplateAnalysis = pool.get('lims.template.analysis_sheet.analysis')
 
-        # Analysis + Method + Product type + Matrix
-        cursor.execute('SELECT t.id '
-            'FROM "' + Template._table + '" t '
-                'INNER JOIN "' + TemplateAnalysis._table + '" ta '
-                'ON t.id = ta.template '
-            'WHERE t.active IS TRUE '
-                'AND ta.analysis = %s '
-                'AND ta.method = %s '
-                'AND ta.product_type = %s '
-                'AND ta.matrix = %s',
-            (self.analysis.id, self.method.id, self.product_type.id,
-                self.matrix.id))
-        template = cursor.fetchone()
-        if template:
-            return template[0]
-
-        # Analysis + Method + Product type
-        cursor.execute('SELECT t.id '
-            'FROM "' + Template._table + '" t '
-                'INNER JOIN "' + TemplateAnalysis._table + '" ta '
-                'ON t.id = ta.template '
-            'WHERE t.active IS TRUE '
-                'AND ta.analysis = %s '
-                'AND ta.method = %s '
-                'AND ta.product_type = %s '
-                'AND ta.matrix IS NULL',
-            (self.analysis.id, self.method.id, self.product_type.id))
-        template = cursor.fetchone()
-        if template:
-            return template[0]
-
-        # Analysis + Method + Matrix
-        cursor.execute('SELECT t.id '
-            'FROM "' + Template._table + '" t '
-                'INNER JOIN "' + TemplateAnalysis._table + '" ta '
-                'ON t.id = ta.template '
-            'WHERE t.active IS TRUE '
-                'AND ta.analysis = %s '
-                'AND ta.method = %s '
-                'AND ta.product_type IS NULL '
-                'AND ta.matrix = %s',
-            (self.analysis.id, self.method.id, self.matrix.id))
-        template = cursor.fetchone()
-        if template:
-            return template[0]
-
-        # Analysis + Product type + Matrix
-        cursor.execute('SELECT t.id '
-            'FROM "' + Template._table + '" t '
-                'INNER JOIN "' + TemplateAnalysis._table + '" ta '
-                'ON t.id = ta.template '
-            'WHERE t.active IS TRUE '
-                'AND ta.analysis = %s '
-                'AND ta.method IS NULL '
-                'AND ta.product_type = %s '
-                'AND ta.matrix = %s',
-            (self.analysis.id, self.product_type.id, self.matrix.id))
-        template = cursor.fetchone()
-        if template:
-            return template[0]
-
-        # Analysis + Product type
-        cursor.execute('SELECT t.id '
-            'FROM "' + Template._table + '" t '
-                'INNER JOIN "' + TemplateAnalysis._table + '" ta '
-                'ON t.id = ta.template '
-            'WHERE t.active IS TRUE '
-                'AND ta.analysis = %s '
-                'AND ta.method IS NULL '
-                'AND ta.product_type = %s '
-                'AND ta.matrix IS NULL',
-            (self.analysis.id, self.product_type.id))
-        template = cursor.fetchone()
-        if template:
-            return template[0]
-
-        # Analysis + Matrix
-        cursor.execute('SELECT t.id '
-            'FROM "' + Template._table + '" t '
-                'INNER JOIN "' + TemplateAnalysis._table + '" ta '
-                'ON t.id = ta.template '
-            'WHERE t.active IS TRUE '
-                'AND ta.analysis = %s '
-                'AND ta.method IS NULL '
-                'AND ta.product_type IS NULL '
-                'AND ta.matrix = %s',
-            (self.analysis.id, self.matrix.id))
-        template = cursor.fetchone()
-        if template:
-            return template[0]
-
-        # Analysis + Method
-        cursor.execute('SELECT t.id '
-            'FROM "' + Template._table + '" t '
-                'INNER JOIN "' + TemplateAnalysis._table + '" ta '
-                'ON t.id = ta.template '
-            'WHERE t.active IS TRUE '
-                'AND ta.analysis = %s '
-                'AND ta.method = %s '
-                'AND ta.product_type IS NULL '
-                'AND ta.matrix IS NULL',
-            (self.analysis.id, self.method.id))
-        template = cursor.fetchone()
-        if template:
-            return template[0]
-
-        # Analysis
-        cursor.execute('SELECT t.id '
+        analysis_ids = list(set(nl.analysis.id for nl in lines))
+        if not analysis_ids:
+            return {}
+
+        cursor.execute('SELECT ta.analysis, ta.method, ta.product_type, '
+                'ta.matrix, t.id '
             'FROM "' + Template._table + '" t '
                 'INNER JOIN "' + TemplateAnalysis._table + '" ta '
                 'ON t.id = ta.template '
             'WHERE t.active IS TRUE '
-                'AND ta.analysis = %s '
-                'AND ta.method IS NULL '
-                'AND ta.product_type IS NULL '
-                'AND ta.matrix IS NULL',
-            (self.analysis.id,))
-        template = cursor.fetchone()
-        if template:
-            return template[0]
-
-        return None
+                'AND ta.analysis = ANY(%s) '
+            'ORDER BY ta.id',
+            (analysis_ids,))
+        templates = {}
+        for analysis, method, product_type, matrix, template in (
+                cursor.fetchall()):
+            templates.setdefault((analysis, method, product_type, matrix),
+                template)
+
+        res = {}
+        for nl in lines:
+            analysis = nl.analysis.id
+            method = nl.method and nl.method.id
+            product_type = nl.product_type and nl.product_type.id
+            matrix = nl.matrix and nl.matrix.id
+            # (method, product type, matrix) combinations by precedence,
+            # a combination is only tried if the line has its values
+            for use_method, use_product_type, use_matrix in (
+                    (True, True, True),
+                    (True, True, False),
+                    (True, False, True),
+                    (False, True, True),
+                    (False, True, False),
+                    (False, False, True),
+                    (True, False, False),
+                    (False, False, False)):
+                if ((use_method and not method) or
+                        (use_product_type and not product_type) or
+                        (use_matrix and not matrix)):
+                    continue
+                m = method if use_method else None
+                p = product_type if use_product_type else None
+                x = matrix if use_matrix else None
+                template = templates.get((analysis, m, p, x))
+                if template:
+                    res[nl.id] = template
+                    break
+        return res
 
     @classmethod
     def delete(cls, lines):
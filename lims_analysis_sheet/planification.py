@@ -67,6 +67,7 @@ class Planification(metaclass=PoolMeta):
         pool = Pool()
         PlanificationServiceDetail = pool.get(
             'lims.planification.service_detail')
+        NotebookLine = pool.get('lims.notebook.line')
         AnalysisSheet = pool.get('lims.analysis_sheet')
         PlanificationAnalysisSheet = pool.get(
             'lims.planification.analysis_sheet')
@@ -81,9 +82,11 @@ class Planification(metaclass=PoolMeta):
             ('detail.planification', '=', self.id),
             ('notebook_line', '!=', None),
             ])
+        templates = NotebookLine.get_analysis_sheet_templates(
+            [sd.notebook_line for sd in service_details])
         for service_detail in service_details:
             nl = service_detail.notebook_line
-            template_id = nl.get_analysis_sheet_template()
+            template_id = templates.get(nl.id)
             if not template_id:
                 continue
             key = (template_id, service_detail.staff_responsible[0])
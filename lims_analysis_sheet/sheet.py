@@ -8,9 +8,7 @@ from itertools import chain
 from io import StringIO
 from decimal import Decimal
 from datetime import datetime, date
-from sql import Table, Column, Literal, Null
-from sql.aggregate import Count
-from sql.conditionals import Coalesce
+from sql import Table
 
 from trytond.model import Workflow, ModelView, ModelSQL, DeactivableMixin, \
     fields, Unique
@@ -25,6 +23,7 @@ from trytond.i18n import gettext
 from trytond.modules.lims_interface.interface import str2date, \
     get_model_resource, FIELD_TYPE_PYTHON
 from trytond.modules.lims_interface.data import ALLOWED_RESULT_TYPES
+from trytond.modules.lims.tools import id_set_clause
 
 
 class TemplateAnalysisSheet(DeactivableMixin, ModelSQL, ModelView):
@@ -671,7 +670,7 @@ class AnalysisSheet(Workflow, ModelSQL, ModelView):
         pool = Pool()
         ModelData = pool.get('ir.model.data')
         Field = pool.get('lims.interface.table.field')
-        notebook_line = pool.get('lims.notebook.line').__table__()
+        NotebookLine = pool.get('lims.notebook.line')
 
         _ZERO = Decimal(0)
         digits = cls.completion_percentage.digits[1]
@@ -690,98 +689,102 @@ class AnalysisSheet(Workflow, ModelSQL, ModelView):
             'partial_analysys': {},
             'completion_percentage': {},
             }
+        tables = {}
         for s in sheets:
-            sql_table = Table(s.compilation.table.name)
-            sql_join = sql_table.join(notebook_line,
-                condition=sql_table.notebook_line == notebook_line.id)
-
-            cursor.execute(*sql_table.select(Count(Literal('*')),
-                where=((sql_table.compilation == s.compilation.id) &
-                    (sql_table.notebook_line != Null))))
-            total = cursor.fetchone()[0]
-
-            results = _ZERO
-            if s.state != 'draft':
-                table_id = s.compilation.table.id
-
-                result_field = None
-                result_column = Field.search([
-                    ('table', '=', table_id),
-                    ('transfer_field', '=', True),
-                    ('related_line_field.name', '=', 'result'),
-                    ])
-                if result_column:
-                    result_field = result_column[0].name
-                    result_field_type = result_column[0].type
-
-                literal_result_column = Field.search([
-                    ('table', '=', table_id),
-                    ('transfer_field', '=', True),
-                    ('related_line_field.name', '=', 'literal_result'),
-                    ])
-                literal_result_field = (literal_result_column and
-                    literal_result_column[0].name or None)
-
-                result_modifier_column = Field.search([
-                    ('table', '=', table_id),
-                    ('transfer_field', '=', True),
-                    ('related_line_field.name', '=', 'result_modifier'),
-                    ])
-                result_modifier_field = (result_modifier_column and
-                    result_modifier_column[0].name or None)
-
-                result_clause = Literal(False)
-                if result_field:
-                    if result_field_type == 'char':
-                        result_clause |= (Coalesce(Column(sql_table,
-                            result_field), '') != '')
-                    else:
-                        result_clause |= (Column(sql_table,
-                            result_field) != Null)
-                if literal_result_field:
-                    result_clause |= (Coalesce(Column(sql_table,
-                        literal_result_field), '') != '')
-                if result_modifier_field:
-                    result_clause |= (Column(sql_table,
-                        result_modifier_field).in_(result_modifiers))
-
-                cursor.execute(*sql_join.select(Count(Literal('*')),
-                    where=(sql_table.compilation == s.compilation.id) & (
-                        (notebook_line.end_date != Null) |
-                        (sql_table.annulled == Literal(True)) |
-                        result_clause)))
-                results = cursor.fetchone()[0]
-
             result['urgent'][s.id] = False
-            cursor.execute(*sql_join.select(Count(Literal('*')),
-                where=(sql_table.compilation == s.compilation.id) &
-                    (notebook_line.urgent == Literal(True))))
-            if cursor.fetchone()[0] > 0:
-                result['urgent'][s.id] = True
-
-            samples = {}
-            cursor.execute(*sql_join.select(notebook_line.notebook,
-                notebook_line.analysis,
-                where=sql_table.compilation == s.compilation.id))
-            for x in cursor.fetchall():
-                if x[0] not in samples:
-                    samples[x[0]] = []
-                samples[x[0]].append(x[1])
-            result['samples_qty'][s.id] = len(samples)
-
+            result['samples_qty'][s.id] = 0
             result['partial_analysys'][s.id] = False
-            template_analysis = [ta.analysis.id
-                for ta in s.template.analysis]
-            for k, v in samples.items():
-                if not all(x in v for x in template_analysis):
-                    result['partial_analysys'][s.id] = True
-                    break
-
             result['completion_percentage'][s.id] = _ZERO
-            if total and results:
-                result['completion_percentage'][s.id] = Decimal(
-                    results / Decimal(total)
-                    ).quantize(Decimal(str(10 ** -digits)))
+            tables.setdefault(s.compilation.table, []).append(s)
+
+        transfer_columns = Field.get_transfer_columns(
+            [t.id for t in tables])
+
+        # The KPIs of all the sheets of an interface table are computed
+        # in one query grouped by compilation
+        for table, table_sheets in tables.items():
+            columns = transfer_columns[table.id]
+            result_clause = ['FALSE']
+            if 'result' in columns:
+                name, type_ = columns['result']
+                if type_ == 'char':
+                    result_clause.append(
+                        'COALESCE(t."%s", \'\') != \'\'' % name)
+                else:
+                    result_clause.append('t."%s" IS NOT NULL' % name)
+            if 'literal_result' in columns:
+                result_clause.append(
+                    'COALESCE(t."%s", \'\') != \'\'' %
+                    columns['literal_result'][0])
+            if 'result_modifier' in columns:
+                result_clause.append(
+                    't."%s" = ANY(%%s::integer[])' %
+                    columns['result_modifier'][0])
+            result_clause = ' OR '.join(result_clause)
+
+            compilations = {s.compilation.id: s for s in table_sheets}
+            template_compilations, template_analysis = [], []
+            for s in table_sheets:
+                for ta in s.template.analysis:
+                    template_compilations.append(s.compilation.id)
+                    template_analysis.append(ta.analysis.id)
+
+            params = [template_compilations, template_analysis]
+            if 'result_modifier' in columns:
+                params.append(result_modifiers)
+            params.append(list(compilations.keys()))
+            cursor.execute('WITH tpl AS ('
+                    'SELECT * FROM UNNEST(%s::integer[], %s::integer[]) '
+                    'AS tpl(compilation, analysis)), '
+                'tpl_qty AS ('
+                    'SELECT compilation, COUNT(DISTINCT analysis) AS qty '
+                    'FROM tpl GROUP BY compilation), '
+                'lines AS ('
+                    'SELECT t.compilation, t.notebook_line, '
+                        'nl.id AS line, nl.notebook, nl.analysis, '
+                        'nl.urgent, (nl.end_date IS NOT NULL '
+                        'OR t.annulled = TRUE OR ' + result_clause + ') '
+                        'AS has_result '
+                    'FROM "' + table.name + '" t '
+                        'LEFT JOIN "' + NotebookLine._table + '" nl '
+                        'ON nl.id = t.notebook_line '
+                    'WHERE t.compilation = ANY(%s::integer[])), '
+                'notebooks AS ('
+                    'SELECT l.compilation, l.notebook, '
+                        'COUNT(DISTINCT tpl.analysis) AS qty '
+                    'FROM lines l '
+                        'LEFT JOIN tpl ON tpl.compilation = l.compilation '
+                        'AND tpl.analysis = l.analysis '
+                    'WHERE l.line IS NOT NULL '
+                    'GROUP BY l.compilation, l.notebook), '
+                'samples AS ('
+                    'SELECT n.compilation, COUNT(*) AS qty, '
+                        'BOOL_OR(n.qty < COALESCE(tq.qty, 0)) AS partial '
+                    'FROM notebooks n '
+                        'LEFT JOIN tpl_qty tq '
+                        'ON tq.compilation = n.compilation '
+                    'GROUP BY n.compilation) '
+                'SELECT l.compilation, COUNT(l.notebook_line), '
+                    'COUNT(l.line) FILTER (WHERE l.has_result), '
+                    'COALESCE(BOOL_OR(l.urgent), FALSE), '
+                    'COALESCE(MAX(sm.qty), 0), '
+                    'COALESCE(BOOL_OR(sm.partial), FALSE) '
+                'FROM lines l '
+                    'LEFT JOIN samples sm ON sm.compilation = l.compilation '
+                'GROUP BY l.compilation',
+                params)
+            for (compilation, total, results, urgent, samples_qty,
+                    partial) in cursor.fetchall():
+                s = compilations[compilation]
+                result['urgent'][s.id] = urgent
+                result['samples_qty'][s.id] = samples_qty
+                result['partial_analysys'][s.id] = partial
+                if s.state == 'draft':
+                    results = 0
+                if total and results:
+                    result['completion_percentage'][s.id] = Decimal(
+                        results / Decimal(total)
+                        ).quantize(Decimal(str(10 ** -digits)))
 
         return result
 
@@ -789,30 +792,41 @@ class AnalysisSheet(Workflow, ModelSQL, ModelView):
         return self.compilation.interface.id
 
     def get_out_of_ranges(self, name):
-        # TODO: improve perf
-        res = False
-        Column = Pool().get('lims.interface.column')
-        Data = Pool().get('lims.interface.data')
+        cursor = Transaction().connection.cursor()
+        pool = Pool()
+        Column = pool.get('lims.interface.column')
+        Field = pool.get('lims.interface.table.field')
+
         validation_column = Column.search([
-                                        ('interface','=',self.interface),
-                                        ('validation_column','=',True)
-                                        ])
-        if not len(validation_column):
+            ('interface', '=', self.interface),
+            ('validation_column', '=', True),
+            ], limit=1)
+        if not validation_column:
             return False
-        validation_column = validation_column[0].alias
-        with Transaction().set_context(
-                    lims_interface_table=self.compilation.table.id):
-                clause = [('compilation', '=', self.compilation.id)]
-                lines = Data.search(clause)
-                for line in lines:
-                    try:
-                        if getattr(line, validation_column):
-                            res = True
-                            break
-                    except AttributeError:
-                        pass
-                    
-        return res
+        table = self.compilation.table
+        field = Field.search([
+            ('table', '=', table.id),
+            ('name', '=', validation_column[0].alias),
+            ], limit=1)
+        if not field:
+            return False
+        name, type_ = field[0].name, field[0].type
+        if type_ == 'boolean':
+            clause = 'd."%s" = TRUE' % name
+        elif type_ in ('integer', 'float', 'numeric', 'many2one'):
+            clause = 'd."%s" != 0' % name
+        elif type_ in ('char', 'multiline', 'icon', 'reference',
+                'selection'):
+            clause = 'COALESCE(d."%s", \'\') != \'\'' % name
+        else:
+            clause = 'd."%s" IS NOT NULL' % name
+
+        cursor.execute('SELECT EXISTS ('
+                'SELECT 1 FROM "' + table.name + '" d '
+                'WHERE d.compilation = %s '
+                    'AND ' + clause + ')',
+            (self.compilation.id,))
+        return cursor.fetchone()[0]
 
     @classmethod
     def get_notebook_lines(cls, records):
@@ -1137,9 +1151,9 @@ class AnalysisSheet(Workflow, ModelSQL, ModelView):
         today = Date.today()
 
         for s in sheets:
-            sample_ids = set()
             with Transaction().set_context(
-                    lims_interface_table=s.compilation.table.id):
+                    lims_interface_table=s.compilation.table.id,
+                    defer_samples_state=True):
                 lines = Data.search([('compilation', '=', s.compilation.id)])
                 for line in lines:
                     if not Compilation._allow_confirm_line(line):
@@ -1165,10 +1179,8 @@ class AnalysisSheet(Workflow, ModelSQL, ModelView):
                         #data['end_date'] = today
                         data['accepted'] = True
                         data['acceptance_date'] = now
-                    with Transaction().set_context(update_samples_state=False):
-                        NotebookLine.write([nb_line], data)
-                    sample_ids.add(nb_line.sample.id)
-            Sample.update_samples_state(list(sample_ids))
+                    NotebookLine.write([nb_line], data)
+            Sample.flush_samples_state()
 
     @classmethod
     @ModelView.button
@@ -1224,25 +1236,53 @@ class AnalysisSheet(Workflow, ModelSQL, ModelView):
             setattr(compilation, field, value)
         return compilation
 
-    def _find_annulled_interface_line(self, nl):
-        pool = Pool()
-        NbLine = pool.get('lims.notebook.line')
-        Data = pool.get('lims.interface.data')
+    def _find_existing_interface_lines(self, lines):
+        """
+        Returns the ids of the notebook lines that already have a row in
+        the compilation
+        """
+        cursor = Transaction().connection.cursor()
 
-        annulled_nls = NbLine.search([
-            ('notebook', '=', nl.notebook.id),
-            ('analysis', '=', nl.analysis.id),
-            ('annulled', '=', True),
-            ])
-        if not annulled_nls:
-            return None
+        line_clause, line_params = id_set_clause('d.notebook_line',
+            [nl.id for nl in lines])
+        cursor.execute('SELECT DISTINCT d.notebook_line '
+            'FROM "' + self.compilation.table.name + '" d '
+            'WHERE d.compilation = %s '
+                'AND ' + line_clause,
+            [self.compilation.id] + line_params)
+        return set(x[0] for x in cursor.fetchall())
+
+    def _find_annulled_interface_lines(self, lines):
+        """
+        Returns for each notebook line the id of an annulled row of the
+        compilation that belongs to an annulled line of the same notebook
+        and analysis. Each row is assigned to only one notebook line
+        """
+        cursor = Transaction().connection.cursor()
+        NotebookLine = Pool().get('lims.notebook.line')
 
-        rows = Data.search([
-            ('compilation', '=', self.compilation.id),
-            ('notebook_line', 'in', [x.id for x in annulled_nls]),
-            ('annulled', '=', True),
-            ], limit=1)
-        return rows[0] if rows else None
+        line_clause, line_params = id_set_clause('nl.id',
+            [nl.id for nl in lines])
+        cursor.execute('SELECT nl.id, d.id '
+            'FROM "' + NotebookLine._table + '" nl '
+                'INNER JOIN "' + NotebookLine._table + '" anl '
+                'ON anl.notebook = nl.notebook '
+                    'AND anl.analysis = nl.analysis '
+                    'AND anl.annulled = TRUE '
+                'INNER JOIN "' + self.compilation.table.name + '" d '
+                'ON d.notebook_line = anl.id '
+            'WHERE ' + line_clause + ' '
+                'AND d.compilation = %s '
+                'AND d.annulled = TRUE '
+            'ORDER BY nl.id, d.id',
+            line_params + [self.compilation.id])
+        rows, used = {}, set()
+        for line_id, row_id in cursor.fetchall():
+            if line_id in rows or row_id in used:
+                continue
+            rows[line_id] = row_id
+            used.add(row_id)
+        return rows
 
     def _relink_annulled_interface_line(self, row, nl):
         pool = Pool()
@@ -1290,27 +1330,43 @@ class AnalysisSheet(Workflow, ModelSQL, ModelView):
         overrides = self._get_template_default_value_overrides()
         language = self.compilation.interface.language
 
+        existing = self._find_existing_interface_lines(lines)
+        lines = [nl for nl in lines if nl.id not in existing]
+        annulled_rows = self._find_annulled_interface_lines(lines)
+
+        expressions = set()
+        for k in schema:
+            default_value = schema[k]['default_value']
+            if default_value and default_value.startswith('='):
+                expressions.add(default_value)
+        for override_for_line in overrides.values():
+            expressions.update(str(raw).strip()
+                for raw in override_for_line.values())
+        for field, path in ((interface.fraction_field, 'fraction.number'),
+                (interface.analysis_field, 'analysis.rec_name'),
+                (interface.method_field, 'method.rec_name')):
+            if field and field.type_ != 'many2one':
+                expressions.add('=' + path)
+        values = self._read_notebook_lines_values(
+            [nl for nl in lines if nl.id not in annulled_rows], expressions)
+        compiled = {}
+
         with Transaction().set_context(
                 lims_interface_table=self.compilation.table.id):
             data = []
             for nl in lines:
-                if Data.search([
-                        ('compilation', '=', self.compilation.id),
-                        ('notebook_line', '=', nl.id),
-                        ], limit=1):
-                    continue
-
-                annulled_row = self._find_annulled_interface_line(nl)
-                if annulled_row:
-                    self._relink_annulled_interface_line(annulled_row, nl)
+                if nl.id in annulled_rows:
+                    self._relink_annulled_interface_line(
+                        Data(annulled_rows[nl.id]), nl)
                     continue
+                nl_values = values[nl.id]
 
                 line = {
                     'compilation': self.compilation.id,
                     'notebook_line': nl.id,
                     }
                 d = defaults.copy()
-                override_for_line = overrides.get(nl.analysis.id, {})
+                override_for_line = overrides.get(nl_values['analysis'], {})
                 for alias in override_for_line:
                     if alias not in schema:
                         continue
@@ -1326,7 +1382,8 @@ class AnalysisSheet(Workflow, ModelSQL, ModelView):
                         continue
                     raw = str(raw).strip()
                     if raw.startswith('='):
-                        value = self._resolve_default_formula_with_nl(raw, nl)
+                        value = self._resolve_default_formula_with_nl(raw,
+                            nl, compiled, nl_values)
                     else:
                         value = self._resolve_literal_schema_default(
                             schema[alias], raw, language)
@@ -1342,49 +1399,35 @@ class AnalysisSheet(Workflow, ModelSQL, ModelView):
                         continue
                     if default_value.startswith('=REFERENCE_VALUE('):
                         continue
-                    if default_value.startswith('=VAR('):
-                        parser = formulas.Parser()
-                        ast = parser.ast(default_value)[1].compile()
-                        inputs = [nl]
-                        try:
-                            value = ast(*inputs)
-                        except schedula.utils.exc.DispatcherError:
-                            value = None
-                        value = self._normalize_formula_value(value)
-                    else:
-                        path = default_value[1:].split('.')
-                        field = path.pop(0)
-                        try:
-                            value = getattr(nl, field)
-                            while path:
-                                field = path.pop(0)
-                                value = getattr(value, field)
-                        except AttributeError:
-                            value = None
-
+                    value = self._resolve_default_formula_with_nl(
+                        default_value, nl, compiled, nl_values)
                     self._apply_default_to_mapping(
                         line, k, schema[k], value)
 
                 if interface.fraction_field:
                     if interface.fraction_field.type_ == 'many2one':
-                        line[interface.fraction_field.alias] = nl.fraction.id
+                        line[interface.fraction_field.alias] = (
+                            nl_values['fraction'])
                     else:
                         line[interface.fraction_field.alias] = (
-                            nl.fraction.number)
+                            nl_values['fraction.number'])
                 if interface.analysis_field:
                     if interface.analysis_field.type_ == 'many2one':
-                        line[interface.analysis_field.alias] = nl.analysis.id
+                        line[interface.analysis_field.alias] = (
+                            nl_values['analysis'])
                     else:
                         line[interface.analysis_field.alias] = (
-                            nl.analysis.rec_name)
+                            nl_values['analysis.rec_name'])
                 if interface.method_field:
                     if interface.method_field.type_ == 'many2one':
-                        line[interface.method_field.alias] = nl.method.id
+                        line[interface.method_field.alias] = (
+                            nl_values['method'])
                     else:
                         line[interface.method_field.alias] = (
-                            nl.method.rec_name)
+                            nl_values['method.rec_name'])
                 if interface.repetition_field:
-                    line[interface.repetition_field.alias] = nl.repetition
+                    line[interface.repetition_field.alias] = (
+                        nl_values['repetition'])
                 data.append(line)
 
             if data:
@@ -1393,6 +1436,56 @@ class AnalysisSheet(Workflow, ModelSQL, ModelView):
         if update_samples_list:
             self._update_samples_list()
 
+    @classmethod
+    def _read_notebook_lines_values(cls, lines, expressions):
+        """
+        Reads in one call the notebook line fields used by the default
+        expressions that are field paths. Returns the values of each line
+        by field path
+        """
+        NotebookLine = Pool().get('lims.notebook.line')
+
+        paths = set()
+        for raw in expressions:
+            if (not raw.startswith('=') or raw.startswith('=VAR(') or
+                    raw.startswith('=REFERENCE_VALUE(')):
+                continue
+            if cls._is_readable_path(NotebookLine, raw[1:]):
+                paths.add(raw[1:])
+        field_names = paths | {'analysis', 'fraction', 'method',
+            'repetition'}
+
+        result = {}
+        if not lines:
+            return result
+        for row in NotebookLine.read([nl.id for nl in lines],
+                sorted(field_names)):
+            for path in paths:
+                if '.' in path:
+                    row[path] = cls._get_path_value(row, path)
+            result[row['id']] = row
+        return result
+
+    @staticmethod
+    def _is_readable_path(Model, path):
+        pool = Pool()
+        names = path.split('.')
+        for name in names[:-1]:
+            field = Model._fields.get(name)
+            if not field or field._type != 'many2one':
+                return False
+            Model = pool.get(field.model_name)
+        return names[-1] in Model._fields
+
+    @staticmethod
+    def _get_path_value(values, path):
+        names = path.split('.')
+        for name in names[:-1]:
+            values = values.get(name + '.')
+            if not isinstance(values, dict):
+                return None
+        return values.get(names[-1])
+
     def _update_samples_list(self):
         pool = Pool()
         Notebook = pool.get('lims.notebook')
@@ -1533,24 +1626,27 @@ class AnalysisSheet(Workflow, ModelSQL, ModelView):
             return resource and resource[0].id
         return str(raw)
 
-    def _resolve_default_formula_with_nl(self, raw, nl):
+    def _resolve_default_formula_with_nl(self, raw, nl, compiled=None,
+            nl_values=None):
+        if compiled is None:
+            compiled = {}
         if raw.startswith('=REFERENCE_VALUE('):
-            parser = formulas.Parser()
-            ast = parser.ast(raw)[1].compile()
+            ast = self._compile_default_formula(raw, compiled)
             try:
                 value = ast()
             except schedula.utils.exc.DispatcherError as e:
                 raise UserError(e.args[0] % e.args[1:])
             return self._normalize_formula_value(value)
         if raw.startswith('=VAR('):
-            parser = formulas.Parser()
-            ast = parser.ast(raw)[1].compile()
+            ast = self._compile_default_formula(raw, compiled)
             inputs = [nl]
             try:
                 value = ast(*inputs)
             except schedula.utils.exc.DispatcherError:
                 value = None
             return self._normalize_formula_value(value)
+        if nl_values is not None and raw[1:] in nl_values:
+            return nl_values[raw[1:]]
         path = raw[1:].split('.')
         field = path.pop(0)
         try:
@@ -1562,6 +1658,13 @@ class AnalysisSheet(Workflow, ModelSQL, ModelView):
             value = None
         return value
 
+    @staticmethod
+    def _compile_default_formula(raw, compiled):
+        if raw not in compiled:
+            parser = formulas.Parser()
+            compiled[raw] = parser.ast(raw)[1].compile()
+        return compiled[raw]
+
     def get_data_defaults(self):
         defaults = {}
         schema, _ = self.compilation._get_schema()
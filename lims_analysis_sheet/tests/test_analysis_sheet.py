@@ -2,15 +2,144 @@
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
 import unittest
+from decimal import Decimal
 
 import trytond.tests.test_tryton
-from trytond.tests.test_tryton import ModuleTestCase
+from trytond import backend
+from trytond.pool import Pool
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.transaction import Transaction
+from trytond.modules.lims_analysis_sheet.tests.tools import (
+    create_base_tables, create_analysis, create_notebook_lines,
+    create_analysis_sheet_template, create_analysis_sheet)
 
 
 class LimsTestCase(ModuleTestCase):
     'Test lims_analysis_sheet module'
     module = 'lims_analysis_sheet'
 
+    def _insert_rows(self, sheet, rows):
+        cursor = Transaction().connection.cursor()
+        for line, annulled, result, out_of_range in rows:
+            cursor.execute('INSERT INTO "' + sheet.compilation.table.name +
+                '" (compilation, notebook_line, annulled, result, '
+                'out_of_range) VALUES (%s, %s, %s, %s, %s)',
+                (sheet.compilation.id, line and line.id, annulled, result,
+                    out_of_range))
+
+    def _read_rows(self, sheet):
+        cursor = Transaction().connection.cursor()
+        cursor.execute('SELECT notebook_line, annulled, result, out_of_range '
+            'FROM "' + sheet.compilation.table.name + '" '
+            'WHERE compilation = %s '
+            'ORDER BY id',
+            (sheet.compilation.id,))
+        return cursor.fetchall()
+
+    def _get_fields_per_line(self, sheet):
+        "Computes the KPIs of the sheet reading its rows one by one"
+        NotebookLine = Pool().get('lims.notebook.line')
+
+        rows = [r for r in self._read_rows(sheet) if r[0]]
+        total, results = len(rows), 0
+        urgent = False
+        samples = {}
+        for line_id, annulled, result, _ in rows:
+            nl = NotebookLine(line_id)
+            if nl.end_date or annulled or result:
+                results += 1
+            urgent = urgent or nl.urgent
+            samples.setdefault(nl.notebook.id, set()).add(nl.analysis.id)
+
+        template_analysis = set(ta.analysis.id
+            for ta in sheet.template.analysis)
+        completion_percentage = Decimal(0)
+        if sheet.state != 'draft' and total and results:
+            completion_percentage = Decimal(
+                results / Decimal(total)).quantize(Decimal('0.0001'))
+        return {
+            'urgent': urgent,
+            'samples_qty': len(samples),
+            'partial_analysys': any(not template_analysis <= a
+                for a in samples.values()),
+            'completion_percentage': completion_percentage,
+            }
+
+    def _create_sheets(self):
+        base = create_base_tables()
+        a1, a2 = [create_analysis(base, code) for code in ('A1', 'A2')]
+        complete = create_notebook_lines(base, [a1, a2], urgent=[a1])
+        partial = create_notebook_lines(base, [a1])
+        template = create_analysis_sheet_template([a1, a2], [
+            {'alias': 'result', 'type_': 'char',
+                'related_line_field': 'result'},
+            {'alias': 'out_of_range', 'type_': 'boolean',
+                'validation_column': True},
+            ])
+
+        active = create_analysis_sheet(base, template)
+        lines = complete + partial
+        self._insert_rows(active, [
+            (lines[0], False, '7.1', False),
+            (lines[1], False, None, False),
+            (lines[2], True, None, False),
+            (None, False, '8', False),
+            ])
+        draft = create_analysis_sheet(base, template, state='draft')
+        self._insert_rows(draft, [
+            (partial[0], False, '7.3', False),
+            ])
+        empty = create_analysis_sheet(base, template)
+        return active, draft, empty
+
+    @unittest.skipIf(backend.name != 'postgresql', 'requires PostgreSQL')
+    @with_transaction()
+    def test_get_fields(self):
+        "The KPIs are the ones computed line by line"
+        AnalysisSheet = Pool().get('lims.analysis_sheet')
+
+        sheets = self._create_sheets()
+        names = ['urgent', 'samples_qty', 'partial_analysys',
+            'completion_percentage']
+        result = AnalysisSheet.get_fields(sheets, names)
+        for sheet in sheets:
+            self.assertEqual(
+                {n: result[n][sheet.id] for n in names},
+                self._get_fields_per_line(sheet))
+
+        active, draft, empty = sheets
+        self.assertEqual(
+            {n: result[n][active.id] for n in names}, {
+                'urgent': True,
+                'samples_qty': 2,
+                'partial_analysys': True,
+                'completion_percentage': Decimal('0.6667'),
+                })
+        self.assertEqual(result['samples_qty'][draft.id], 1)
+        self.assertEqual(result['completion_percentage'][draft.id],
+            Decimal(0))
+        self.assertEqual(result['samples_qty'][empty.id], 0)
+        self.assertFalse(result['partial_analysys'][empty.id])
+
+    @unittest.skipIf(backend.name != 'postgresql', 'requires PostgreSQL')
+    @with_transaction()
+    def test_get_out_of_ranges(self):
+        "A sheet is out of ranges when any row sets the validation column"
+        cursor = Transaction().connection.cursor()
+
+        active, draft, empty = self._create_sheets()
+        for sheet in (active, draft, empty):
+            self.assertEqual(sheet.get_out_of_ranges('out_of_ranges'),
+                any(r[3] for r in self._read_rows(sheet)))
+        self.assertFalse(active.get_out_of_ranges('out_of_ranges'))
+
+        cursor.execute('UPDATE "' + active.compilation.table.name + '" '
+            'SET out_of_range = TRUE '
+            'WHERE compilation = %s AND result = %s',
+            (active.compilation.id, '8'))
+        self.assertTrue(active.get_out_of_ranges('out_of_ranges'))
+        self.assertFalse(draft.get_out_of_ranges('out_of_ranges'))
+
 
 def suite():
     suite = trytond.tests.test_tryton.suite()
@@ -8,6 +8,9 @@ import trytond.tests.test_tryton
 from trytond.pool import Pool
 from trytond.tests.test_tryton import ModuleTestCase, with_transaction
 from trytond.transaction import Transaction
+from trytond.modules.lims_analysis_sheet.tests.tools import (
+    create_base_tables, create_analysis, create_notebook_lines,
+    create_analysis_sheet_template, create_analysis_sheet)
 
 
 class InterfaceIntegrityTestCase(ModuleTestCase):
@@ -163,6 +166,74 @@ class InterfaceIntegrityTestCase(ModuleTestCase):
                 ])
             self.assertEqual(len(duplicates), 1)
 
+    def _read_sheet_rows(self, sheet, names):
+        cursor = Transaction().connection.cursor()
+        cursor.execute('SELECT ' + ', '.join('"%s"' % n for n in names) + ' '
+            'FROM "' + sheet.compilation.table.name + '" '
+            'WHERE compilation = %s '
+            'ORDER BY id',
+            (sheet.compilation.id,))
+        return cursor.fetchall()
+
+    @with_transaction()
+    def test_read_notebook_lines_values(self):
+        pool = Pool()
+        AnalysisSheet = pool.get('lims.analysis_sheet')
+        NotebookLine = pool.get('lims.notebook.line')
+
+        self.assertTrue(AnalysisSheet._is_readable_path(
+            NotebookLine, 'analysis.code'))
+        self.assertFalse(AnalysisSheet._is_readable_path(
+            NotebookLine, 'analysis.missing'))
+        self.assertFalse(AnalysisSheet._is_readable_path(
+            NotebookLine, 'repetition.code'))
+
+        base = create_base_tables()
+        analyses = [create_analysis(base, code) for code in ('A1', 'A2')]
+        lines = create_notebook_lines(base, analyses)
+        self.assertEqual(len(lines), 2)
+
+        values = AnalysisSheet._read_notebook_lines_values(lines,
+            {'=analysis.code', '=fraction.number', '=VAR(A1)',
+                '=missing.path'})
+        for nl in lines:
+            self.assertEqual(values[nl.id]['analysis.code'],
+                nl.analysis.code)
+            self.assertEqual(values[nl.id]['fraction.number'],
+                nl.fraction.number)
+            self.assertEqual(values[nl.id]['analysis'], nl.analysis.id)
+            self.assertEqual(values[nl.id]['fraction'], nl.fraction.id)
+            self.assertEqual(values[nl.id]['method'], nl.method.id)
+            self.assertEqual(values[nl.id]['repetition'], 0)
+            self.assertNotIn('VAR(A1)', values[nl.id])
+            self.assertNotIn('missing.path', values[nl.id])
+
+    @with_transaction()
+    def test_create_lines(self):
+        "One row is created for each notebook line with its defaults"
+        base = create_base_tables()
+        analyses = [create_analysis(base, code) for code in ('A1', 'A2')]
+        lines = create_notebook_lines(base, analyses)
+        template = create_analysis_sheet_template(analyses, [
+            {'alias': 'fraction', 'type_': 'char'},
+            {'alias': 'analysis', 'type_': 'char'},
+            {'alias': 'code', 'type_': 'char',
+                'default_value': '=analysis.code'},
+            {'alias': 'result', 'type_': 'char',
+                'related_line_field': 'result'},
+            ])
+        sheet = create_analysis_sheet(base, template)
+
+        sheet.create_lines(lines, update_samples_list=False)
+        # lines that already have a row are skipped
+        sheet.create_lines(lines, update_samples_list=False)
+
+        rows = self._read_sheet_rows(sheet,
+            ['notebook_line', 'fraction', 'analysis', 'code', 'result'])
+        self.assertEqual(sorted(rows), sorted((nl.id, nl.fraction.number,
+                    nl.analysis.rec_name, nl.analysis.code, None)
+                for nl in lines))
+
     @with_transaction()
     def test_sync_after_service_change(self):
         pool = Pool()
@@ -0,0 +1,247 @@
+# This file is part of lims_analysis_sheet module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import datetime
+
+from trytond.pool import Pool
+
+__all__ = ['create_base_tables', 'create_analysis', 'create_notebook_lines',
+    'create_analysis_sheet_template', 'create_analysis_sheet']
+
+
+def create_base_tables():
+    "Create the work year and base tables needed to load samples"
+    pool = Pool()
+    ModelData = pool.get('ir.model.data')
+    Sequence = pool.get('ir.sequence')
+    LabWorkYear = pool.get('lims.lab.workyear')
+    Lang = pool.get('ir.lang')
+    Party = pool.get('party.party')
+    LaboratoryProfessional = pool.get('lims.laboratory.professional')
+    Laboratory = pool.get('lims.laboratory')
+    LabMethod = pool.get('lims.lab.method')
+    ProductType = pool.get('lims.product.type')
+    Matrix = pool.get('lims.matrix')
+    Zone = pool.get('lims.zone')
+    FractionType = pool.get('lims.fraction.type')
+
+    today = datetime.date.today()
+    sequences = {}
+    for name in ('entry', 'sample', 'service', 'results_report'):
+        sequences[name], = Sequence.create([{
+            'name': '%s Sequence Test' % name,
+            'sequence_type': ModelData.get_id('lims', 'seq_type_%s' % name),
+            }])
+    LabWorkYear.create([{
+        'code': str(today.year),
+        'start_date': datetime.date(today.year, 1, 1),
+        'end_date': datetime.date(today.year, 12, 31),
+        'entry_sequence': sequences['entry'].id,
+        'sample_sequence': sequences['sample'].id,
+        'service_sequence': sequences['service'].id,
+        'results_report_sequence': sequences['results_report'].id,
+        }])
+
+    language, = Lang.search([('code', '=', 'en')])
+    Lang.write([language], {'translatable': True})
+
+    customer, professional_party = Party.create([{
+        'name': 'Customer',
+        }, {
+        'name': 'Laboratory Professional',
+        'is_lab_professional': True,
+        'lims_user': ModelData.get_id('res', 'user_admin'),
+        }])
+    professional, = LaboratoryProfessional.create([{
+        'party': professional_party.id,
+        'code': 'LP',
+        }])
+    laboratory, = Laboratory.create([{
+        'code': 'SQ',
+        'description': 'Chemistry Laboratory',
+        'default_signer': professional.id,
+        'related_location': ModelData.get_id('stock', 'location_stock'),
+        }])
+    method, = LabMethod.create([{
+        'code': '002',
+        'name': 'By potentiometry',
+        'determination': 'pH measurement by potentiometry',
+        'requalification_months': 12,
+        }])
+    product_type, = ProductType.create([{
+        'code': 'WINE',
+        'description': 'Wine',
+        }])
+    matrix, = Matrix.create([{
+        'code': 'GRAPE',
+        'description': 'Grape',
+        }])
+    zone, = Zone.create([{
+        'code': 'N',
+        'description': 'North',
+        }])
+    fraction_type, = FractionType.create([{
+        'code': 'MCL',
+        'description': 'Customer',
+        }])
+    return {
+        'language': language,
+        'customer': customer,
+        'professional': professional,
+        'laboratory': laboratory,
+        'method': method,
+        'product_type': product_type,
+        'matrix': matrix,
+        'zone': zone,
+        'fraction_type': fraction_type,
+        }
+
+
+def create_analysis(base, code):
+    "Create an analysis done by the laboratory and method of the base tables"
+    Analysis = Pool().get('lims.analysis')
+
+    analysis, = Analysis.create([{
+        'code': code,
+        'description': 'Analysis %s' % code,
+        'type': 'analysis',
+        'behavior': 'normal',
+        'laboratories': [('create', [{
+            'laboratory': base['laboratory'].id,
+            }])],
+        'methods': [('add', [base['method'].id])],
+        }])
+    return analysis
+
+
+def create_notebook_lines(base, analyses, urgent=None):
+    """
+    Create an entry with one sample that has a service for each analysis
+    and generate its notebook lines, as the confirmation of the fraction
+    does. Returns the notebook lines
+    """
+    pool = Pool()
+    ModelData = pool.get('ir.model.data')
+    Entry = pool.get('lims.entry')
+    Sample = pool.get('lims.sample')
+    Fraction = pool.get('lims.fraction')
+    Service = pool.get('lims.service')
+    EntryDetailAnalysis = pool.get('lims.entry.detail.analysis')
+
+    entry, = Entry.create([{
+        'party': base['customer'].id,
+        'invoice_party': base['customer'].id,
+        'report_language': base['language'].id,
+        }])
+    sample, = Sample.create([{
+        'entry': entry.id,
+        'party': base['customer'].id,
+        'product_type': base['product_type'].id,
+        'matrix': base['matrix'].id,
+        'zone': base['zone'].id,
+        }])
+    fraction, = Fraction.create([{
+        'sample': sample.id,
+        'type': base['fraction_type'].id,
+        'storage_location': ModelData.get_id('stock', 'location_stock'),
+        }])
+    Service.create([{
+        'fraction': fraction.id,
+        'analysis': analysis.id,
+        'laboratory': base['laboratory'].id,
+        'method': base['method'].id,
+        'urgent': analysis in (urgent or []),
+        } for analysis in analyses])
+
+    fraction.create_laboratory_notebook()
+    details = EntryDetailAnalysis.search([
+        ('fraction', '=', fraction.id),
+        ])
+    return EntryDetailAnalysis.create_notebook_lines(details, fraction)
+
+
+def create_analysis_sheet_template(analyses, columns):
+    """
+    Create an active interface with the columns, its data table and an
+    analysis sheet template for the analyses
+    """
+    pool = Pool()
+    ModelField = pool.get('ir.model.field')
+    Interface = pool.get('lims.interface')
+    Table = pool.get('lims.interface.table')
+    Template = pool.get('lims.template.analysis_sheet')
+
+    line_fields = {}
+    for c in columns:
+        if c.get('related_line_field'):
+            field, = ModelField.search([
+                ('model.model', '=', 'lims.notebook.line'),
+                ('name', '=', c['related_line_field']),
+                ])
+            line_fields[c['alias']] = field.id
+
+    interface, = Interface.create([{
+        'name': 'Analysis Sheet Test',
+        'kind': 'template',
+        'template_type': 'csv',
+        'first_row': 1,
+        'state': 'active',
+        'revision': 1,
+        'columns': [('create', [{
+            'name': c['alias'],
+            'alias': c['alias'],
+            'type_': c['type_'],
+            'default_value': c.get('default_value'),
+            'transfer_field': c['alias'] in line_fields,
+            'related_line_field': line_fields.get(c['alias']),
+            'validation_column': c.get('validation_column', False),
+            } for c in columns])],
+        }])
+
+    table, = Table.create([{
+        'name': interface.data_table_name,
+        'fields_': [('create', [{
+            'name': c['alias'],
+            'string': c['alias'],
+            'type': c['type_'],
+            'transfer_field': c['alias'] in line_fields,
+            'related_line_field': line_fields.get(c['alias']),
+            } for c in columns])],
+        }])
+    table.create_table()
+
+    aliases = {c.alias: c.id for c in interface.columns}
+    Interface.write([interface], {
+        'table': table.id,
+        'fraction_field': aliases.get('fraction'),
+        'analysis_field': aliases.get('analysis'),
+        })
+
+    template, = Template.create([{
+        'interface': interface.id,
+        'name': 'Analysis Sheet Test',
+        'analysis': [('create', [{
+            'analysis': a.id,
+            } for a in analyses])],
+        }])
+    return template
+
+
+def create_analysis_sheet(base, template, state='active'):
+    "Create an analysis sheet of the template with a new compilation"
+    pool = Pool()
+    Compilation = pool.get('lims.interface.compilation')
+    AnalysisSheet = pool.get('lims.analysis_sheet')
+
+    compilation, = Compilation.create([{
+        'interface': template.interface.id,
+        'revision': template.interface.revision,
+        'table': template.interface.table.id,
+        }])
+    sheet, = AnalysisSheet.create([{
+        'template': template.id,
+        'compilation': compilation.id,
+        'professional': base['professional'].id,
+        'state': state,
+        }])
+    return sheet
@@ -1,11 +1,14 @@
 # This file is part of lims_board module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
+from datetime import timedelta
 from dateutil.relativedelta import relativedelta
 
 from trytond.model import ModelSQL, ModelView, fields
 from trytond.pool import Pool
 from trytond.transaction import Transaction
+from trytond.cache import Cache
+from trytond.config import config
 from trytond.i18n import gettext
 
 DEPARTMENTS_LIMIT = 30
@@ -14,9 +17,162 @@ SAMPLES_IN_PROGRESS = ['pending_planning', 'planned',
     'pending_report', 'in_report']
 SAMPLES_IN_LABORATORY = ['pending_planning', 'planned',
     'in_lab', 'lab_pending_acceptance']
+# Seconds the panels of a board are reused for the same filters
+CACHE_DURATION = config.getint('lims_board', 'cache_duration', default=60)
 
 
-class BoardGeneral(ModelSQL, ModelView):
+class BoardMixin:
+    'Dashboard'
+
+    _samples_states = []
+    _board_cache = Cache('lims.board', context=False,
+        duration=timedelta(seconds=CACHE_DURATION))
+
+    def _get_samples_clause(self):
+        clause = [('state', 'in', self._samples_states)]
+        if self.date_from:
+            clause.append(('date2', '>=', self.date_from))
+        if self.date_to:
+            clause.append(('date2', '<=', self.date_to))
+        if self.parties:
+            clause.append(('party', 'in', [p.id for p in self.parties]))
+        if self.departments:
+            clause.append(('department', 'in',
+                [d.id for d in self.departments]))
+        if self.analysis:
+            clause.append(('fractions.services.analysis', 'in',
+                [a.id for a in self.analysis]))
+        return clause
+
+    def _get_cached(self, name, func):
+        '''
+        Returns the result of func for the current filters, computing it
+        only if it is not cached yet. Results are cached per user as the
+        samples are searched with the record rules of the user
+        '''
+        Date = Pool().get('ir.date')
+
+        key = (self.__name__, name, self.date_from, self.date_to,
+            tuple(sorted(p.id for p in self.parties or [])),
+            tuple(sorted(d.id for d in self.departments or [])),
+            tuple(sorted(a.id for a in self.analysis or [])),
+            Transaction().context.get('company'), Transaction().user,
+            Date.today())
+        result = self._board_cache.get(key)
+        if result is None:
+            result = func()
+            self._board_cache.set(key, result)
+        return result
+
+    def _get_samples_query(self):
+        Sample = Pool().get('lims.sample')
+        return tuple(Sample.search(self._get_samples_clause(), query=True))
+
+    def get_samples(self, name=None):
+        return self._get_cached('samples', self._search_samples)
+
+    def _search_samples(self):
+        cursor = Transaction().connection.cursor()
+        pool = Pool()
+        Sample = pool.get('lims.sample')
+        Fraction = pool.get('lims.fraction')
+        Service = pool.get('lims.service')
+
+        samples_query, samples_params = self._get_samples_query()
+        # Samples with urgent services first
+        cursor.execute('SELECT s.id '
+            'FROM "' + Sample._table + '" s '
+                'INNER JOIN "' + Fraction._table + '" f '
+                'ON f.sample = s.id '
+                'INNER JOIN "' + Service._table + '" srv '
+                'ON srv.fraction = f.id '
+            'WHERE s.id IN (' + samples_query + ') '
+            'GROUP BY s.id, s.number '
+            'ORDER BY BOOL_OR(srv.urgent) DESC, s.number DESC',
+            samples_params)
+        return [x[0] for x in cursor.fetchall()]
+
+    def _count_samples_state(self):
+        cursor = Transaction().connection.cursor()
+        Sample = Pool().get('lims.sample')
+
+        samples_query, samples_params = self._get_samples_query()
+        cursor.execute('SELECT s.state, COUNT(*) '
+            'FROM "' + Sample._table + '" s '
+            'WHERE s.id IN (' + samples_query + ') '
+            'GROUP BY s.state', samples_params)
+        return dict(cursor.fetchall())
+
+    def _count_samples_department(self):
+        cursor = Transaction().connection.cursor()
+        pool = Pool()
+        Sample = pool.get('lims.sample')
+        ProductType = pool.get('lims.product.type')
+
+        samples_query, samples_params = self._get_samples_query()
+        cursor.execute('SELECT pt.department, COUNT(*) '
+            'FROM "' + Sample._table + '" s '
+                'INNER JOIN "' + ProductType._table + '" pt '
+                'ON pt.id = s.product_type '
+            'WHERE s.id IN (' + samples_query + ') '
+            'GROUP BY pt.department', samples_params)
+        return dict(cursor.fetchall())
+
+    def _count_samples_date(self, field_name):
+        cursor = Transaction().connection.cursor()
+        pool = Pool()
+        Sample = pool.get('lims.sample')
+        ProductType = pool.get('lims.product.type')
+        Date = pool.get('ir.date')
+
+        today = Date.today()
+        dates = [today + relativedelta(days=d) for d in range(-4, 4)]
+        column = 's.' + field_name
+        buckets = ['WHEN ' + column + ' <= %s THEN 0 ']
+        buckets.extend('WHEN ' + column + ' = %s THEN ' + str(i) + ' '
+            for i in range(1, len(dates)))
+
+        samples_query, samples_params = self._get_samples_query()
+        cursor.execute('SELECT pt.department, '
+                'CASE ' + ''.join(buckets) +
+                'ELSE ' + str(len(dates)) + ' END, '
+                'COUNT(*) '
+            'FROM "' + Sample._table + '" s '
+                'INNER JOIN "' + ProductType._table + '" pt '
+                'ON pt.id = s.product_type '
+            'WHERE s.id IN (' + samples_query + ') '
+            'GROUP BY 1, 2', dates + list(samples_params))
+        return {(x[0], x[1]): x[2] for x in cursor.fetchall()}
+
+    def _get_samples_date(self, field_name):
+        Department = Pool().get('company.department')
+
+        i = 0
+        dep = {None: ''}
+        departments = Department.search([], order=[('id', 'ASC')],
+            limit=DEPARTMENTS_LIMIT)
+        for d in departments:
+            i += 1
+            dep[d.id] = i
+
+        counts = self._get_cached(field_name,
+            lambda: self._count_samples_date(field_name))
+
+        records = []
+        buckets = ['< -4 d', '-3 d', '-2 d',
+            gettext('lims_board.msg_yesterday'),
+            gettext('lims_board.msg_today'),
+            gettext('lims_board.msg_tomorrow'),
+            '+2 d', '+3 d', '> +4 d']
+        for bucket, t in enumerate(buckets):
+            record = {'t': t}
+            for d_id, d_it in dep.items():
+                record['q%s' % d_it] = counts.get((d_id, bucket), 0)
+            records.append(record)
+        return records
+
+
+class BoardGeneral(BoardMixin, ModelSQL, ModelView):
     'General Dashboard'
     __name__ = 'lims.board.general'
 
@@ -44,6 +200,8 @@ class BoardGeneral(ModelSQL, ModelView):
         'lims.board.laboratory.sample_report_date',
         None, 'Samples per Date agreed for result', states={'readonly': True})
 
+    _samples_states = SAMPLES_IN_PROGRESS
+
     @classmethod
     def __setup__(cls):
         super().__setup__()
@@ -70,222 +228,31 @@ class BoardGeneral(ModelSQL, ModelView):
         self.samples_department = self.get_samples_department()
         self.samples_report_date = self.get_samples_report_date()
 
-    def get_samples(self, name=None):
-        pool = Pool()
-        Sample = pool.get('lims.sample')
-
-        clause = [('state', 'in', SAMPLES_IN_PROGRESS)]
-        if self.date_from:
-            clause.append(('date2', '>=', self.date_from))
-        if self.date_to:
-            clause.append(('date2', '<=', self.date_to))
-        if self.parties:
-            clause.append(('party', 'in', [p.id for p in self.parties]))
-        if self.departments:
-            clause.append(('department', 'in',
-                [d.id for d in self.departments]))
-        if self.analysis:
-            clause.append(('fractions.services.analysis', 'in',
-                [a.id for a in self.analysis]))
-
-        samples = Sample.search(clause + [
-            ('fractions.services.urgent', '=', True),
-            ])
-        records = [s.id for s in samples]
-
-        samples = Sample.search(clause + [
-            ('fractions.services.urgent', '=', False),
-            ])
-        records.extend([s.id for s in samples])
-
-        return records
-
     def get_samples_state(self):
-        pool = Pool()
-        Sample = pool.get('lims.sample')
-
-        clause = []
-        if self.date_from:
-            clause.append(('date2', '>=', self.date_from))
-        if self.date_to:
-            clause.append(('date2', '<=', self.date_to))
-        if self.parties:
-            clause.append(('party', 'in', [p.id for p in self.parties]))
-        if self.departments:
-            clause.append(('department', 'in',
-                [d.id for d in self.departments]))
-        if self.analysis:
-            clause.append(('fractions.services.analysis', 'in',
-                [a.id for a in self.analysis]))
+        counts = self._get_cached('state', self._count_samples_state)
 
         records = []
-
         for state in SAMPLES_IN_PROGRESS:
-            record = {
+            records.append({
                 's': gettext('lims_board.msg_sample_state_%s' % state),
-                }
-            record['q'] = Sample.search_count(clause + [
-                ('state', '=', state),
-                ])
-            records.append(record)
-
+                'q': counts.get(state, 0),
+                })
         return records
 
     def get_samples_department(self):
-        pool = Pool()
-        Sample = pool.get('lims.sample')
-        Department = pool.get('company.department')
+        Department = Pool().get('company.department')
 
-        clause = [('state', 'in', SAMPLES_IN_PROGRESS)]
-        if self.date_from:
-            clause.append(('date2', '>=', self.date_from))
-        if self.date_to:
-            clause.append(('date2', '<=', self.date_to))
-        if self.parties:
-            clause.append(('party', 'in', [p.id for p in self.parties]))
-        if self.departments:
-            clause.append(('department', 'in',
-                [d.id for d in self.departments]))
-        if self.analysis:
-            clause.append(('fractions.services.analysis', 'in',
-                [a.id for a in self.analysis]))
+        counts = self._get_cached('department',
+            self._count_samples_department)
 
         records = []
-
         departments = Department.search([], order=[('id', 'ASC')])
         for d in departments:
-            record = {'d': d.name}
-            record['q'] = Sample.search_count(clause + [
-                ('department', '=', d.id),
-                ])
-            records.append(record)
-
+            records.append({'d': d.name, 'q': counts.get(d.id, 0)})
         return records
 
     def get_samples_report_date(self):
-        pool = Pool()
-        Sample = pool.get('lims.sample')
-        Department = pool.get('company.department')
-        Date = pool.get('ir.date')
-
-        i = 0
-        dep = {None: ''}
-        departments = Department.search([], order=[('id', 'ASC')],
-            limit=DEPARTMENTS_LIMIT)
-        for d in departments:
-            i += 1
-            dep[d.id] = i
-
-        clause = [('state', 'in', SAMPLES_IN_PROGRESS)]
-        if self.date_from:
-            clause.append(('date2', '>=', self.date_from))
-        if self.date_to:
-            clause.append(('date2', '<=', self.date_to))
-        if self.parties:
-            clause.append(('party', 'in', [p.id for p in self.parties]))
-        if self.departments:
-            clause.append(('department', 'in',
-                [d.id for d in self.departments]))
-        if self.analysis:
-            clause.append(('fractions.services.analysis', 'in',
-                [a.id for a in self.analysis]))
-
-        records = []
-        today = Date.today()
-
-        # < -4 d
-        report_date = today - relativedelta(days=4)
-        record = {'t': '< -4 d'}
-        for d_id, d_it in dep.items():
-            record['q%s' % d_it] = Sample.search_count(clause + [
-                ('report_date', '<=', report_date),
-                ('department', '=', d_id),
-                ])
-        records.append(record)
-
-        # -3 d
-        report_date = today - relativedelta(days=3)
-        record = {'t': '-3 d'}
-        for d_id, d_it in dep.items():
-            record['q%s' % d_it] = Sample.search_count(clause + [
-                ('report_date', '=', report_date),
-                ('department', '=', d_id),
-                ])
-        records.append(record)
-
-        # -2 d
-        report_date = today - relativedelta(days=2)
-        record = {'t': '-2 d'}
-        for d_id, d_it in dep.items():
-            record['q%s' % d_it] = Sample.search_count(clause + [
-                ('report_date', '=', report_date),
-                ('department', '=', d_id),
-                ])
-        records.append(record)
-
-        # -1 d
-        report_date = today - relativedelta(days=1)
-        record = {'t': gettext('lims_board.msg_yesterday')}
-        for d_id, d_it in dep.items():
-            record['q%s' % d_it] = Sample.search_count(clause + [
-                ('report_date', '=', report_date),
-                ('department', '=', d_id),
-                ])
-        records.append(record)
-
-        # t
-        record = {'t': gettext('lims_board.msg_today')}
-        for d_id, d_it in dep.items():
-            record['q%s' % d_it] = Sample.search_count(clause + [
-                ('report_date', '=', today),
-                ('department', '=', d_id),
-                ])
-        records.append(record)
-
-        # +1 d
-        report_date = today + relativedelta(days=1)
-        record = {'t': gettext('lims_board.msg_tomorrow')}
-        for d_id, d_it in dep.items():
-            record['q%s' % d_it] = Sample.search_count(clause + [
-                ('report_date', '=', report_date),
-                ('department', '=', d_id),
-                ])
-        records.append(record)
-
-        # +2 d
-        report_date = today + relativedelta(days=2)
-        record = {'t': '+2 d'}
-        for d_id, d_it in dep.items():
-            record['q%s' % d_it] = Sample.search_count(clause + [
-                ('report_date', '=', report_date),
-                ('department', '=', d_id),
-                ])
-        records.append(record)
-
-        # +3 d
-        report_date = today + relativedelta(days=3)
-        record = {'t': '+3 d'}
-        for d_id, d_it in dep.items():
-            record['q%s' % d_it] = Sample.search_count(clause + [
-                ('report_date', '=', report_date),
-                ('department', '=', d_id),
-                ])
-        records.append(record)
-
-        # > +4 d
-        report_date = today + relativedelta(days=4)
-        record = {'t': '> +4 d'}
-        for d_id, d_it in dep.items():
-            record['q%s' % d_it] = Sample.search_count(clause + [
-                ['OR',
-                    ('report_date', '=', None),
-                    ('report_date', '>=', report_date),
-                    ],
-                ('department', '=', d_id),
-                ])
-        records.append(record)
-
-        return records
+        return self._get_samples_date('report_date')
 
 
 class BoardGeneralSampleState(ModelView):
@@ -445,7 +412,7 @@ class BoardLaboratorySampleReportDate(ModelView):
         return res
 
 
-class BoardLaboratory(ModelSQL, ModelView):
+class BoardLaboratory(BoardMixin, ModelSQL, ModelView):
     'Laboratory Dashboard'
     __name__ = 'lims.board.laboratory'
 
@@ -468,6 +435,8 @@ class BoardLaboratory(ModelSQL, ModelView):
         'lims.board.laboratory.sample_laboratory_date',
         None, 'Samples per Laboratory deadline', states={'readonly': True})
 
+    _samples_states = SAMPLES_IN_LABORATORY
+
     @classmethod
     def __setup__(cls):
         super().__setup__()
@@ -491,160 +460,8 @@ class BoardLaboratory(ModelSQL, ModelView):
         self.samples = self.get_samples()
         self.samples_laboratory_date = self.get_samples_laboratory_date()
 
-    def get_samples(self, name=None):
-        pool = Pool()
-        Sample = pool.get('lims.sample')
-
-        clause = [('state', 'in', SAMPLES_IN_LABORATORY)]
-        if self.date_from:
-            clause.append(('date2', '>=', self.date_from))
-        if self.date_to:
-            clause.append(('date2', '<=', self.date_to))
-        if self.parties:
-            clause.append(('party', 'in', [p.id for p in self.parties]))
-        if self.departments:
-            clause.append(('department', 'in',
-                [d.id for d in self.departments]))
-        if self.analysis:
-            clause.append(('fractions.services.analysis', 'in',
-                [a.id for a in self.analysis]))
-
-        samples = Sample.search(clause + [
-            ('fractions.services.urgent', '=', True),
-            ])
-        records = [s.id for s in samples]
-
-        samples = Sample.search(clause + [
-            ('fractions.services.urgent', '=', False),
-            ])
-        records.extend([s.id for s in samples])
-
-        return records
-
     def get_samples_laboratory_date(self):
-        pool = Pool()
-        Sample = pool.get('lims.sample')
-        Department = pool.get('company.department')
-        Date = pool.get('ir.date')
-
-        i = 0
-        dep = {None: ''}
-        departments = Department.search([], order=[('id', 'ASC')],
-            limit=DEPARTMENTS_LIMIT)
-        for d in departments:
-            i += 1
-            dep[d.id] = i
-
-        clause = [('state', 'in', SAMPLES_IN_LABORATORY)]
-        if self.date_from:
-            clause.append(('date2', '>=', self.date_from))
-        if self.date_to:
-            clause.append(('date2', '<=', self.date_to))
-        if self.parties:
-            clause.append(('party', 'in', [p.id for p in self.parties]))
-        if self.departments:
-            clause.append(('department', 'in',
-                [d.id for d in self.departments]))
-        if self.analysis:
-            clause.append(('fractions.services.analysis', 'in',
-                [a.id for a in self.analysis]))
-
-        records = []
-        today = Date.today()
-
-        # < -4 d
-        laboratory_date = today - relativedelta(days=4)
-        record = {'t': '< -4 d'}
-        for d_id, d_it in dep.items():
-            record['q%s' % d_it] = Sample.search_count(clause + [
-                ('laboratory_date', '<=', laboratory_date),
-                ('department', '=', d_id),
-                ])
-        records.append(record)
-
-        # -3 d
-        laboratory_date = today - relativedelta(days=3)
-        record = {'t': '-3 d'}
-        for d_id, d_it in dep.items():
-            record['q%s' % d_it] = Sample.search_count(clause + [
-                ('laboratory_date', '=', laboratory_date),
-                ('department', '=', d_id),
-                ])
-        records.append(record)
-
-        # -2 d
-        laboratory_date = today - relativedelta(days=2)
-        record = {'t': '-2 d'}
-        for d_id, d_it in dep.items():
-            record['q%s' % d_it] = Sample.search_count(clause + [
-                ('laboratory_date', '=', laboratory_date),
-                ('department', '=', d_id),
-                ])
-        records.append(record)
-
-        # -1 d
-        laboratory_date = today - relativedelta(days=1)
-        record = {'t': gettext('lims_board.msg_yesterday')}
-        for d_id, d_it in dep.items():
-            record['q%s' % d_it] = Sample.search_count(clause + [
-                ('laboratory_date', '=', laboratory_date),
-                ('department', '=', d_id),
-                ])
-        records.append(record)
-
-        # t
-        record = {'t': gettext('lims_board.msg_today')}
-        for d_id, d_it in dep.items():
-            record['q%s' % d_it] = Sample.search_count(clause + [
-                ('laboratory_date', '=', today),
-                ('department', '=', d_id),
-                ])
-        records.append(record)
-
-        # +1 d
-        laboratory_date = today + relativedelta(days=1)
-        record = {'t': gettext('lims_board.msg_tomorrow')}
-        for d_id, d_it in dep.items():
-            record['q%s' % d_it] = Sample.search_count(clause + [
-                ('laboratory_date', '=', laboratory_date),
-                ('department', '=', d_id),
-                ])
-        records.append(record)
-
-        # +2 d
-        laboratory_date = today + relativedelta(days=2)
-        record = {'t': '+2 d'}
-        for d_id, d_it in dep.items():
-            record['q%s' % d_it] = Sample.search_count(clause + [
-                ('laboratory_date', '=', laboratory_date),
-                ('department', '=', d_id),
-                ])
-        records.append(record)
-
-        # +3 d
-        laboratory_date = today + relativedelta(days=3)
-        record = {'t': '+3 d'}
-        for d_id, d_it in dep.items():
-            record['q%s' % d_it] = Sample.search_count(clause + [
-                ('laboratory_date', '=', laboratory_date),
-                ('department', '=', d_id),
-                ])
-        records.append(record)
-
-        # > +4 d
-        laboratory_date = today + relativedelta(days=4)
-        record = {'t': '> +4 d'}
-        for d_id, d_it in dep.items():
-            record['q%s' % d_it] = Sample.search_count(clause + [
-                ['OR',
-                    ('laboratory_date', '=', None),
-                    ('laboratory_date', '>=', laboratory_date),
-                    ],
-                ('department', '=', d_id),
-                ])
-        records.append(record)
-
-        return records
+        return self._get_samples_date('laboratory_date')
 
 
 class BoardLaboratorySampleLaboratoryDate(ModelView):
@@ -60,6 +60,16 @@ class ResultsReport(metaclass=PoolMeta):
 
     def build_report(self, language):
         cache = super().build_report(language)
+        return self._sign_global_report(cache)
+
+    def submit_report(self, language, executor=None):
+        result = super().submit_report(language, executor)
+        if executor is None:
+            # already signed by build_report
+            return result
+        return lambda: self._sign_global_report(result())
+
+    def _sign_global_report(self, cache):
         cache = self.sign_report(cache)
         self.signed = True
         self.signed_date = datetime.now()
@@ -18,6 +18,7 @@ def register():
         results_report.ResultsReport,
         results_report.ResultsReportAttachment,
         results_report.ResultsReportMailing,
+        results_report.MailOutbox,
         results_report.SendResultsReportStart,
         results_report.SendResultsReportSucceed,
         results_report.SendResultsReportFailed,
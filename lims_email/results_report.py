@@ -8,19 +8,37 @@ from email.mime.base import MIMEBase
 from email.mime.multipart import MIMEMultipart
 from email.mime.application import MIMEApplication
 from string import Template
+from tempfile import NamedTemporaryFile
+from threading import Lock
 
 from trytond.model import ModelSQL, ModelView, fields
 from trytond.wizard import Wizard, StateView, StateTransition, Button
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval, Bool
 from trytond.transaction import Transaction
-from trytond.tools import get_smtp_server
 from trytond.config import config as tconfig
 from trytond.exceptions import UserError
 from trytond.i18n import gettext
+from trytond.modules.lims.tools import WorkerPool, merge_pdf_reports
 
 logger = logging.getLogger(__name__)
 
+# Number of worker processes that merge the global reports, 0 merges them
+# in the thread of the request
+BUILD_WORKERS = tconfig.getint('lims_email', 'build_workers', default=0)
+
+_build_workers = None
+_build_workers_lock = Lock()
+
+
+def get_build_workers():
+    "Returns the pool of workers that merge the global reports"
+    global _build_workers
+    with _build_workers_lock:
+        if _build_workers is None:
+            _build_workers = WorkerPool(BUILD_WORKERS)
+    return _build_workers
+
 
 class ResultsReportVersionDetail(metaclass=PoolMeta):
     __name__ = 'lims.results_report.version.detail'
@@ -201,6 +219,20 @@ class ResultsReport(metaclass=PoolMeta):
             ])
         return fields
 
+    @classmethod
+    def mail_sent(cls, reports):
+        cls.write(reports, {'sent': True, 'sent_date': datetime.now()})
+
+    @classmethod
+    def mail_failed(cls, reports):
+        '''
+        Marks the reports as not sent when their email could not be
+        delivered, so they are sent again
+        '''
+        reports = [r for r in reports if not r.sent_manually]
+        if reports:
+            cls.write(reports, {'sent': False, 'sent_date': None})
+
     @classmethod
     def cron_send_results_report(cls):
         '''
@@ -222,6 +254,59 @@ class ResultsReport(metaclass=PoolMeta):
         logger.info('Cron - Send Results Report: END')
         return True
 
+    def submit_report(self, language, executor=None):
+        '''
+        Starts building the global report of the language, merging it in
+        executor if given. Returns a function that waits for the report
+        and returns it
+        '''
+        if executor is None:
+            report_cache = self.build_report(language)
+            return lambda: report_cache
+
+        details = self.details_cached(language)
+        key, cached_reports_ids = self._get_global_report_key(details,
+            language)
+        if not key:
+            raise UserError(gettext('lims.msg_global_report_cache',
+                    language=language.name))
+        report_cache = self._get_stored_global_report(key, language)
+        if report_cache is not None:
+            return lambda: report_cache
+
+        # the workers read the cached reports from temporary files, so
+        # only one of them is in memory at a time
+        files = []
+        try:
+            for content in self._get_cached_reports_content(
+                    cached_reports_ids):
+                filedata = NamedTemporaryFile(suffix='.pdf')
+                files.append(filedata)
+                filedata.write(content)
+                filedata.flush()
+                del content
+            output = NamedTemporaryFile(suffix='.pdf')
+            files.append(output)
+        except Exception:
+            for filedata in files:
+                filedata.close()
+            raise
+        future = executor.submit(merge_pdf_reports,
+            [f.name for f in files[:-1]], output.name)
+
+        def result():
+            try:
+                future.result()
+                report_cache = output.read()
+            finally:
+                for filedata in files:
+                    filedata.close()
+            if not report_cache:
+                raise UserError(gettext('lims.msg_global_report_build'))
+            self._store_global_report(key, language, report_cache)
+            return report_cache
+        return result
+
     def attach_report(self, report_cache, language):
         '''
         Attach Report file from provided cache
@@ -373,6 +458,14 @@ class ResultsReportMailing(ModelSQL, ModelView):
         return cls.create_date.convert_order('create_date', tables, cls)
 
 
+class MailOutbox(metaclass=PoolMeta):
+    __name__ = 'lims.mail.outbox'
+
+    @classmethod
+    def _get_origin(cls):
+        return super()._get_origin() + ['lims.results_report']
+
+
 class ResultsReportAnnulation(metaclass=PoolMeta):
     __name__ = 'lims.results_report_annulation'
 
@@ -513,127 +606,163 @@ class SendResultsReport(Wizard):
             logger.info('Send Results Report: '
                 'Processing context Results Reports')
 
-        reports_not_ready = []
-        reports_not_sent = []
-        for group in self.get_grouped_reports(active_ids).values():
-            group['reports_ready'] = []
-            group['to_addrs'] = {}
-            group['attachments_data'] = []
+        langs = Lang.search([('translatable', '=', True)])
+        groups = list(self.get_grouped_reports(active_ids).values())
 
-            for report in group['reports']:
-                logger.info('Send Results Report: %s', report.number)
+        # The global reports of some groups are built in the workers while
+        # the previous ones are queued in the mail outbox
+        executor = get_build_workers() if BUILD_WORKERS else None
+        chunk_size = max(BUILD_WORKERS, 1) * 2
 
-                if (report.single_sending_report and not
-                        report.single_sending_report_ready):
-                    logger.warning('Send Results Report: %s: '
-                        'IGNORED: NOT READY TO SINGLE SENDING',
-                        report.number)
+        reports_not_ready = []
+        reports_not_sent = []
+        for i in range(0, len(groups), chunk_size):
+            chunk = groups[i:i + chunk_size]
+            for group in chunk:
+                self._build_group(group, langs, executor)
+            for group in chunk:
+                self._attach_group(group, email_qa, reports_not_ready)
+                if not group['reports_ready']:
                     continue
-
-                if (report.entry_single_sending_report and not
-                        report.entry_single_sending_report_ready):
-                    logger.warning('Send Results Report: %s: '
-                        'IGNORED: NOT READY TO SINGLE SENDING',
-                        report.number)
+                if not self._send_group(group, from_addr,
+                        hide_recipients):
+                    reports_not_sent.extend(group['reports_ready'])
                     continue
+                Transaction().commit()
 
-                report_cache = {}
-                for lang in Lang.search([('translatable', '=', True)]):
-                    if not report.has_report_cached(lang):
-                        continue
-                    report_cache[lang] = None
-
-                    try:
-                        report_cache[lang] = report.build_report(lang)
-                    except Exception as e:
-                        break
-
-                if not report_cache:
-                    logger.warning('Send Results Report: %s: '
-                        'IGNORED: HAS NO CACHED REPORTS',
-                        report.number)
-                    continue
+        if reports_not_ready or reports_not_sent:
+            logger.warning('Send Results Report: FAILED')
+            self.failed.reports_not_ready = reports_not_ready
+            self.failed.reports_not_sent = reports_not_sent
+            return 'failed'
 
-                if None in report_cache.values():
-                    reports_not_ready.append(report)
-                    logger.warning('Send Results Report: %s: '
-                        'IGNORED: GLOBAL REPORT BUILD FAILED',
-                        report.number)
-                    continue
+        logger.info('Send Results Report: SUCCEED')
+        return 'succeed'
 
-                logger.info('Send Results Report: %s: Build',
+    def _build_group(self, group, langs, executor=None):
+        '''
+        Starts building the global reports of the group
+        '''
+        group['builds'] = []
+        for report in group['reports']:
+            logger.info('Send Results Report: %s', report.number)
+
+            if (report.single_sending_report and not
+                    report.single_sending_report_ready):
+                logger.warning('Send Results Report: %s: '
+                    'IGNORED: NOT READY TO SINGLE SENDING',
                     report.number)
+                continue
 
-                for lang, cache in report_cache.items():
-                    report.attach_report(cache, lang)
-                    logger.info('Send Results Report: %s: Attached (%s)' % (
-                        report.number, lang.name))
-                    group['attachments_data'].append(
-                        report.get_attached_report(cache, lang))
+            if (report.entry_single_sending_report and not
+                    report.entry_single_sending_report_ready):
+                logger.warning('Send Results Report: %s: '
+                    'IGNORED: NOT READY TO SINGLE SENDING',
+                    report.number)
+                continue
 
-                try:
-                    for attachment in report.mail_attachments:
-                        data = attachment.get_attachment_data()
-                        if not data:
-                            continue
-                        logger.info(
-                            'Send Results Report: %s: Extra attachment (%s)' %
-                            (report.number, attachment.name))
-                        group['attachments_data'].append(data)
-                except Exception as e:
-                    reports_not_ready.append(report)
-                    logger.warning('Send Results Report: %s: '
-                        'IGNORED: EXTRA ATTACHMENT FAILED',
-                        report.number)
+            report_cache = {}
+            for lang in langs:
+                if not report.has_report_cached(lang):
                     continue
+                report_cache[lang] = None
 
-                group['reports_ready'].append(report)
+                try:
+                    report_cache[lang] = report.submit_report(lang,
+                        executor)
+                except Exception:
+                    break
+
+            if not report_cache:
+                logger.warning('Send Results Report: %s: '
+                    'IGNORED: HAS NO CACHED REPORTS',
+                    report.number)
+                continue
+            group['builds'].append((report, report_cache))
 
-                if group['cie_fraction_type']:
-                    group['to_addrs'][email_qa] = 'QA'
-                else:
-                    group['to_addrs'].update(self.get_report_addrs(
-                        report))
+    def _attach_group(self, group, email_qa, reports_not_ready):
+        '''
+        Waits for the global reports of the group and attaches them
+        '''
+        group['reports_ready'] = []
+        group['to_addrs'] = {}
+        group['attachments_data'] = []
 
-            if not group['reports_ready']:
+        for report, report_cache in group['builds']:
+            for lang, result in report_cache.items():
+                try:
+                    report_cache[lang] = result and result()
+                except Exception:
+                    report_cache[lang] = None
+            if None in report_cache.values():
+                reports_not_ready.append(report)
+                logger.warning('Send Results Report: %s: '
+                    'IGNORED: GLOBAL REPORT BUILD FAILED',
+                    report.number)
                 continue
 
-            # Email sending
-            to_addrs = list(group['to_addrs'].keys())
-            if not to_addrs:
-                reports_not_sent.extend(group['reports_ready'])
-                logger.warning('Send Results Report: Missing addresses')
-                continue
-            logger.info('Send Results Report: To addresses: %s',
-                ', '.join(to_addrs))
+            logger.info('Send Results Report: %s: Build',
+                report.number)
 
-            subject, body = self._get_subject_body(group['reports_ready'])
+            for lang, cache in report_cache.items():
+                report.attach_report(cache, lang)
+                logger.info('Send Results Report: %s: Attached (%s)' % (
+                    report.number, lang.name))
+                group['attachments_data'].append(
+                    report.get_attached_report(cache, lang))
 
-            msg = self._create_msg(from_addr, to_addrs, subject,
-                body, hide_recipients, group['attachments_data'])
-            sent = self._send_msg(from_addr, to_addrs, msg)
-            if not sent:
-                reports_not_sent.extend(group['reports_ready'])
-                logger.warning('Send Results Report: Not sent')
+            try:
+                for attachment in report.mail_attachments:
+                    data = attachment.get_attachment_data()
+                    if not data:
+                        continue
+                    logger.info(
+                        'Send Results Report: %s: Extra attachment (%s)' %
+                        (report.number, attachment.name))
+                    group['attachments_data'].append(data)
+            except Exception:
+                reports_not_ready.append(report)
+                logger.warning('Send Results Report: %s: '
+                    'IGNORED: EXTRA ATTACHMENT FAILED',
+                    report.number)
                 continue
-            logger.info('Send Results Report: Sent')
 
-            addresses = ', '.join(['"%s" <%s>' % (v, k)
-                    for k, v in group['to_addrs'].items()])
-            ResultsReport.write(group['reports_ready'], {
-                'sent': True, 'sent_date': datetime.now(),
-                'mailings': [('create', [{'addresses': addresses}])],
-                })
-            Transaction().commit()
+            group['reports_ready'].append(report)
 
-        if reports_not_ready or reports_not_sent:
-            logger.warning('Send Results Report: FAILED')
-            self.failed.reports_not_ready = reports_not_ready
-            self.failed.reports_not_sent = reports_not_sent
-            return 'failed'
+            if group['cie_fraction_type']:
+                group['to_addrs'][email_qa] = 'QA'
+            else:
+                group['to_addrs'].update(self.get_report_addrs(
+                    report))
 
-        logger.info('Send Results Report: SUCCEED')
-        return 'succeed'
+    def _send_group(self, group, from_addr, hide_recipients):
+        '''
+        Queues the email of the group in the mail outbox and marks its
+        reports as sent
+        '''
+        ResultsReport = Pool().get('lims.results_report')
+
+        to_addrs = list(group['to_addrs'].keys())
+        if not to_addrs:
+            logger.warning('Send Results Report: Missing addresses')
+            return False
+        logger.info('Send Results Report: To addresses: %s',
+            ', '.join(to_addrs))
+
+        subject, body = self._get_subject_body(group['reports_ready'])
+
+        msg = self._create_msg(from_addr, to_addrs, subject,
+            body, hide_recipients, group['attachments_data'])
+        self._send_msg(from_addr, to_addrs, msg, group['reports_ready'])
+        logger.info('Send Results Report: Queued')
+
+        addresses = ', '.join(['"%s" <%s>' % (v, k)
+                for k, v in group['to_addrs'].items()])
+        ResultsReport.write(group['reports_ready'], {
+            'sent': True, 'sent_date': datetime.now(),
+            'mailings': [('create', [{'addresses': addresses}])],
+            })
+        return True
 
     def get_grouped_reports(self, report_ids):
         pool = Pool()
@@ -779,21 +908,10 @@ class SendResultsReport(Wizard):
             msg.attach(attachment)
         return msg
 
-    def _send_msg(self, from_addr, to_addrs, msg):
-        to_addrs = list(set(to_addrs))
-        success = False
-        server = None
-        try:
-            server = get_smtp_server()
-            server.sendmail(from_addr, to_addrs, msg.as_string())
-            server.quit()
-            success = True
-        except Exception as e:
-            logger.error('Send Results Report: Unable to deliver mail')
-            logger.error(str(e))
-            if server is not None:
-                server.quit()
-        return success
+    def _send_msg(self, from_addr, to_addrs, msg, origins=None):
+        MailOutbox = Pool().get('lims.mail.outbox')
+        MailOutbox.enqueue(from_addr, to_addrs, msg, origins)
+        return True
 
     def default_failed(self, fields):
         default = {
@@ -0,0 +1,55 @@
+# This file is part of lims_instrument module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import io
+import csv
+from openpyxl import load_workbook
+
+READERS = {}
+
+
+def register_reader(format_, reader):
+    '''
+    Registers a function that yields the (sheet name, row values) tuples
+    of a file of the format
+    '''
+    READERS[format_] = reader
+
+
+def get_format(infile):
+    if infile[:4] == b'PK\x03\x04':
+        return 'xlsx'
+    return 'csv'
+
+
+def iter_rows(infile, format_=None, **kwargs):
+    '''
+    Yields the (sheet name, row values) tuples of the file, reading
+    one row at a time
+    '''
+    if isinstance(infile, str):
+        infile = infile.encode('utf-8')
+    format_ = format_ or get_format(infile)
+    return READERS[format_](infile, **kwargs)
+
+
+def iter_xlsx_rows(infile):
+    workbook = load_workbook(io.BytesIO(infile), read_only=True,
+        data_only=True)
+    try:
+        for worksheet in workbook.worksheets:
+            for row in worksheet.iter_rows(values_only=True):
+                yield worksheet.title, row
+    finally:
+        workbook.close()
+
+
+def iter_csv_rows(infile, delimiter=',', encoding='utf-8'):
+    with io.TextIOWrapper(io.BytesIO(infile), encoding=encoding,
+            newline='') as filedata:
+        for row in csv.reader(filedata, delimiter=delimiter):
+            yield None, tuple(row)
+
+
+register_reader('xlsx', iter_xlsx_rows)
+register_reader('csv', iter_csv_rows)
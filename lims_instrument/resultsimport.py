@@ -7,14 +7,105 @@ import traceback
 import xlrd
 from xlutils.copy import copy
 from datetime import datetime
+from itertools import islice, repeat
+from threading import Lock
 from sql import Null, Literal
 
+from trytond.config import config
 from trytond.model import ModelView, ModelSQL, fields, Unique
 from trytond.wizard import Wizard, StateView, StateTransition, Button
 from trytond.pool import Pool, PoolMeta
 from trytond.transaction import Transaction
 from trytond.exceptions import UserError
 from trytond.i18n import gettext
+from trytond.modules.lims.tools import WorkerPool
+
+# Maximum number of worker processes used to parse the results files,
+# 0 or 1 parse them in the server process
+PARSE_WORKERS = config.getint('lims_instrument', 'parse_workers', default=0)
+
+# Number of parsed results resolved and written at once
+COLLECT_CHUNK_SIZE = 1000
+
+CONTROLLERS = {}
+
+
+def register_controller(name, description, controller):
+    '''
+    Registers a controller to be selectable in the results importers.
+    Controllers with a parseRecords(self, infile) generator, that yields
+    (fraction, analysis, repetition, values) tuples, are imported in
+    chunks while the files are parsed. The reader module provides
+    row-streaming readers for them.
+    '''
+    CONTROLLERS[name] = (description, controller)
+
+
+def get_sample_paddings():
+    """
+    Returns the padding of the sample numbers of each work year code,
+    to be used by the parsers to build the fraction numbers
+    """
+    LabWorkYear = Pool().get('lims.lab.workyear')
+    res = {}
+    for workyear in LabWorkYear.search([]):
+        if workyear.sample_sequence:
+            res.setdefault(workyear.code, workyear.sample_sequence.padding)
+    return res
+
+
+_parse_workers = None
+_parse_workers_lock = Lock()
+
+
+def get_parse_workers():
+    "Returns the pool of workers that parse the results files"
+    global _parse_workers
+    with _parse_workers_lock:
+        if _parse_workers is None:
+            _parse_workers = WorkerPool(PARSE_WORKERS,
+                initializer=init_parse_worker)
+    return _parse_workers
+
+
+class WorkerMessage(str):
+    "Id and variables of a message to be translated by the server process"
+
+    def __new__(cls, message_id, *args, **variables):
+        message = super().__new__(cls, message_id)
+        message.message_id = message_id
+        message.variables = variables
+        return message
+
+
+def init_parse_worker():
+    '''
+    Initializes a parse worker. Out of a transaction the messages can not
+    be translated, so gettext keeps their id and variables instead
+    '''
+    import trytond.i18n
+    trytond.i18n.gettext = WorkerMessage
+
+
+def parse_file_in_worker(parse_file, infile, *args):
+    '''
+    Parses the file in a parse worker. Returns the results and the
+    (message id, variables) of the error that prevented to parse the file
+    '''
+    try:
+        return parse_file(infile, *args), None
+    except UserError as e:
+        message = e.message
+        return None, (str(getattr(message, 'message_id', message)),
+            dict(getattr(message, 'variables', {})))
+
+
+def merge_rawresults(rawresults, other):
+    for fraction, analyses in other.items():
+        for analysis, repetitions in analyses.items():
+            rawresults.setdefault(fraction, {}).setdefault(
+                analysis, {}).update(repetitions)
+    return rawresults
 
 
 class NotebookLine(metaclass=PoolMeta):
@@ -64,6 +155,61 @@ class BaseImport(object):
             raise UserError(gettext('lims_instrument.msg_not_implemented',
                 function='parse'))
 
+    def parse_files(self, infiles):
+        '''
+        Parses the files and returns their results merged in the order
+        of the files.
+        Controllers with a parseFile(infile, *args) function, that does
+        not use the database, and a getParseArgs(self) function, that
+        returns the rest of its arguments, parse them in the parse workers
+        when parse_workers is set. The workers only import the modules of
+        the parsers and their errors are raised by the server process.
+        '''
+        if not self.controller:
+            self.loadController()
+        parse_file = getattr(self.controller, 'parseFile', None)
+
+        if parse_file and PARSE_WORKERS > 1 and len(infiles) > 1:
+            args = self.controller.getParseArgs(self)
+            results = []
+            for rawresults, error in get_parse_workers().map(
+                    parse_file_in_worker, repeat(parse_file), infiles,
+                    *[repeat(a) for a in args]):
+                if error:
+                    message_id, variables = error
+                    raise UserError(gettext(message_id, **variables))
+                results.append(rawresults)
+        else:
+            results = []
+            for infile in infiles:
+                self.parse(infile)
+                results.append(self.rawresults)
+
+        self.rawresults = {}
+        for rawresults in results:
+            merge_rawresults(self.rawresults, rawresults)
+        return self.rawresults
+
+    def iter_results(self, infiles):
+        '''
+        Yields the (fraction, analysis, repetition, values) results of the
+        files, as they are parsed if the controller supports it
+        '''
+        if not self.controller:
+            self.loadController()
+        parse_records = getattr(self.controller, 'parseRecords', None)
+        if parse_records:
+            self.rawresults = {}
+            for infile in infiles:
+                yield from parse_records(self, infile)
+            return
+
+        rawresults = self.parse_files(infiles)
+        for fraction, analyses in rawresults.items():
+            for analysis, repetitions in analyses.items():
+                for repetition, values in repetitions.items():
+                    yield fraction, analysis, repetition, values
+
     def exportResults(self):
         '''
         This function defines whether the importer
@@ -95,6 +241,9 @@ class ResultsImport(BaseImport, ModelSQL, ModelView):
             ('name_uniq', Unique(t, t.name),
                 'lims_instrument.msg_results_importer_unique_id'),
             ]
+        for name, (description, _) in CONTROLLERS.items():
+            if (name, description) not in cls.name.selection:
+                cls.name.selection.append((name, description))
 
     @fields.depends('name')
     def on_change_with_description(self, name=None):
@@ -110,6 +259,9 @@ class ResultsImport(BaseImport, ModelSQL, ModelView):
         return description
 
     def loadController(self):
+        if self.name in CONTROLLERS:
+            self.controller = CONTROLLERS[self.name][1]
+            return
         raise UserError(gettext('lims_instrument.msg_not_module',
             module=self.name))
 
@@ -301,6 +453,61 @@ class NotebookLoadResultsFile(Wizard):
             ])
 
     def transition_collect(self):
+        infiles = []
+        for fline in [str(item).zfill(2) for item in range(1, 61)]:
+            file_ = getattr(self.start, 'infile_%s' % fline)
+            if file_:
+                infiles.append(file_)
+        if not infiles:
+            return 'empty'
+
+        lines = {}
+        results = self.start.results_importer.iter_results(infiles)
+        while True:
+            raw_results = {}
+            for fraction, analysis, rep, data in islice(
+                    results, COLLECT_CHUNK_SIZE):
+                raw_results[(str(fraction), analysis, rep)] = data
+            if not raw_results:
+                break
+            for line in self._collect_results(raw_results):
+                lines[line.id] = line
+
+        if lines:
+            self.result.result_lines = list(lines.keys())
+            return 'result'
+        return 'empty'
+
+    def _collect_results(self, raw_results):
+        NotebookLine = Pool().get('lims.notebook.line')
+
+        notebook_lines = self._get_notebook_lines(raw_results.keys())
+        devices = self._get_devices(raw_results.values())
+
+        lines = []
+        to_write = {}
+        for key, data in raw_results.items():
+            line = notebook_lines.get(key)
+            if not line:
+                continue
+            res = self.get_results(line, data, devices)
+            if not res:
+                continue
+            to_write.setdefault(tuple(sorted(res.items())), []).append(line)
+            lines.append(line)
+
+        if to_write:
+            args = []
+            for values, records in to_write.items():
+                args.extend((records, dict(values)))
+            NotebookLine.write(*args)
+        return lines
+
+    def _get_notebook_lines(self, keys):
+        '''
+        Returns a dict with the notebook line to import the results of each
+        (fraction number, analysis code, repetition) key
+        '''
         cursor = Transaction().connection.cursor()
         pool = Pool()
         Fraction = pool.get('lims.fraction')
@@ -308,74 +515,66 @@ class NotebookLoadResultsFile(Wizard):
         NotebookLine = pool.get('lims.notebook.line')
         Analysis = pool.get('lims.analysis')
 
-        lines = []
-        for fline in [str(item).zfill(2) for item in range(1, 61)]:
-            file_ = getattr(self.start, 'infile_%s' % fline)
-            if not file_:
-                continue
-            self.start.results_importer.parse(file_)
-            raw_results = self.start.results_importer.rawresults
-            fractions_numbers = list(raw_results.keys())
-            if not fractions_numbers:
-                continue
-
-            numbers = '\', \''.join(str(n) for n in fractions_numbers)
-            cursor.execute('SELECT id, number '
-                'FROM "' + Fraction._table + '" '
-                'WHERE number IN (\'' + numbers + '\') '
-                'ORDER BY number ASC')
-
-            for f in cursor.fetchall():
-                cursor.execute('SELECT id '
-                    'FROM "' + Notebook._table + '" '
-                    'WHERE fraction = %s '
-                    'LIMIT 1', (f[0],))
-                notebook = cursor.fetchone()
-                if not notebook:
-                    continue
-
-                for analysis in list(raw_results[f[1]].keys()):
-                    cursor.execute('SELECT id '
-                        'FROM "' + Analysis._table + '" '
-                        'WHERE code = %s '
-                            'AND automatic_acquisition = TRUE '
-                        'LIMIT 1', (analysis,))
-                    if not cursor.fetchone():
-                        continue
-
-                    for rep in list(raw_results[f[1]][analysis].keys()):
-                        clause = [
-                            ('notebook', '=', notebook[0]),
-                            ('analysis', '=', analysis),
-                            ('repetition', '=', rep),
-                            ('start_date', '!=', None),
-                            ('result', 'in', [None, '']),
-                            ('converted_result', 'in', [None, '']),
-                            ('literal_result', 'in', [None, '']),
-                            ['OR', ('result_modifier', '=', None),
-                                ('result_modifier.code', 'not in',
-                                ['d', 'nd', 'pos', 'neg', 'ni', 'abs',
-                                    'pre', 'na'])],
-                            ['OR', ('converted_result_modifier', '=', None),
-                                ('converted_result_modifier.code', 'not in',
-                                ['d', 'nd', 'pos', 'neg', 'ni', 'abs',
-                                    'pre'])],
-                            ]
-                        line = NotebookLine.search(clause, limit=1)
-                        if not line:
-                            continue
-                        data = raw_results[f[1]][analysis][rep]
-                        res = self.get_results(line[0], data)
-                        if res:
-                            NotebookLine.write([line[0]], res)
-                            lines.append(line[0])
+        numbers = list(set(k[0] for k in keys))
+        codes = list(set(k[1] for k in keys))
+        repetitions = list(set(k[2] for k in keys))
+
+        cursor.execute('SELECT f.number, MIN(n.id) '
+            'FROM "' + Fraction._table + '" f '
+                'INNER JOIN "' + Notebook._table + '" n '
+                'ON n.fraction = f.id '
+            'WHERE f.number = ANY(%s) '
+            'GROUP BY f.number',
+            (numbers,))
+        notebooks = dict(cursor.fetchall())
+        if not notebooks:
+            return {}
+
+        cursor.execute('SELECT id, code '
+            'FROM "' + Analysis._table + '" '
+            'WHERE code = ANY(%s) '
+                'AND automatic_acquisition = TRUE',
+            (codes,))
+        analyses = dict(cursor.fetchall())
+        if not analyses:
+            return {}
+
+        clause = [
+            ('notebook', 'in', list(notebooks.values())),
+            ('analysis', 'in', list(analyses.keys())),
+            ('repetition', 'in', repetitions),
+            ('start_date', '!=', None),
+            ('result', 'in', [None, '']),
+            ('converted_result', 'in', [None, '']),
+            ('literal_result', 'in', [None, '']),
+            ['OR', ('result_modifier', '=', None),
+                ('result_modifier.code', 'not in',
+                ['d', 'nd', 'pos', 'neg', 'ni', 'abs', 'pre', 'na'])],
+            ['OR', ('converted_result_modifier', '=', None),
+                ('converted_result_modifier.code', 'not in',
+                ['d', 'nd', 'pos', 'neg', 'ni', 'abs', 'pre'])],
+            ]
+        notebook_numbers = dict((v, k) for k, v in notebooks.items())
+        res = {}
+        for line in NotebookLine.search(clause):
+            key = (notebook_numbers[line.notebook.id],
+                analyses[line.analysis.id], line.repetition)
+            # keep the first line of each key, in the default order
+            res.setdefault(key, line)
+        return res
 
-        if lines:
-            self.result.result_lines = [l.id for l in lines]
-            return 'result'
-        return 'empty'
+    def _get_devices(self, results):
+        Device = Pool().get('lims.lab.device')
+        codes = set(data['device'] for data in results
+            if data.get('device'))
+        if not codes:
+            return {}
+        res = {}
+        for device in Device.search([('code', 'in', list(codes))]):
+            res.setdefault(device.code, device.id)
+        return res
 
-    def get_results(self, line, data):
+    def get_results(self, line, data, devices=None):
         pool = Pool()
         Device = pool.get('lims.lab.device')
 
@@ -395,9 +594,13 @@ class NotebookLoadResultsFile(Wizard):
                 res['imported_chromatogram'] = data['chromatogram']
             device = data['device'] if 'device' in data else None
             if device:
-                dev = Device.search([('code', '=', device)])
-                if dev:
-                    res['imported_device'] = dev[0].id
+                if devices is not None:
+                    if device in devices:
+                        res['imported_device'] = devices[device]
+                else:
+                    dev = Device.search([('code', '=', device)])
+                    if dev:
+                        res['imported_device'] = dev[0].id
             if 'dilution_factor' in data:
                 res['imported_dilution_factor'] = data['dilution_factor']
             if 'rm_correction_formula' in data:
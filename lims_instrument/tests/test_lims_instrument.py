@@ -11,6 +11,67 @@ class LimsTestCase(ModuleTestCase):
     'Test lims_instrument module'
     module = 'lims_instrument'
 
+    def test_merge_rawresults(self):
+        "Results of several files are merged in order"
+        from trytond.modules.lims_instrument.resultsimport import (
+            merge_rawresults)
+
+        rawresults = merge_rawresults({}, {
+            '21/001-1': {'A1': {0: {'result': 1}}},
+            })
+        merge_rawresults(rawresults, {
+            '21/001-1': {'A1': {0: {'result': 2}, 1: {'result': 3}}},
+            '21/002-1': {'A2': {0: {'result': 4}}},
+            })
+        self.assertEqual(rawresults, {
+            '21/001-1': {'A1': {0: {'result': 2}, 1: {'result': 3}}},
+            '21/002-1': {'A2': {0: {'result': 4}}},
+            })
+
+    def test_parse_file_in_worker(self):
+        "Parse errors of the workers are returned as plain data"
+        from trytond.exceptions import UserError
+        from trytond.i18n import gettext
+        from trytond.modules.lims.tools import WorkerPool
+        from trytond.modules.lims_instrument.resultsimport import (
+            WorkerMessage, init_parse_worker, parse_file_in_worker)
+
+        def parse_file(infile, paddings):
+            if not infile:
+                raise UserError(WorkerMessage('lims.msg_closing_parenthesis',
+                        index='2'))
+            return {infile: paddings}
+
+        self.assertEqual(parse_file_in_worker(parse_file, 'A', {'21': 3}),
+            ({'A': {'21': 3}}, None))
+        self.assertEqual(parse_file_in_worker(parse_file, '', {'21': 3}),
+            (None, ('lims.msg_closing_parenthesis', {'index': '2'})))
+
+        with WorkerPool(1, initializer=init_parse_worker) as pool:
+            message = pool.submit(gettext, 'lims.msg_closing_parenthesis',
+                index='2').result()
+        self.assertEqual(message.message_id, 'lims.msg_closing_parenthesis')
+        self.assertEqual(message.variables, {'index': '2'})
+
+    def test_iter_rows(self):
+        "Rows of CSV and XLSX files are streamed"
+        from io import BytesIO
+        from openpyxl import Workbook
+        from trytond.modules.lims_instrument.reader import iter_rows
+
+        self.assertEqual(list(iter_rows('A1;1.5\nA2;2\n', delimiter=';')),
+            [(None, ('A1', '1.5')), (None, ('A2', '2'))])
+
+        workbook = Workbook()
+        worksheet = workbook.active
+        worksheet.title = 'Results'
+        worksheet.append(['A1', 1.5])
+        worksheet.append(['A2', 2])
+        infile = BytesIO()
+        workbook.save(infile)
+        self.assertEqual(list(iter_rows(infile.getvalue())),
+            [('Results', ('A1', 1.5)), ('Results', ('A2', 2))])
+
 
 def suite():
     suite = trytond.tests.test_tryton.suite()
@@ -4,10 +4,12 @@
 # the full copyright notices and license terms.
 import io
 import xlrd
+from functools import partial
+from types import SimpleNamespace
 
-from trytond.pool import Pool
 from trytond.transaction import Transaction
 from trytond.modules.lims.formula_parser import FormulaParser
+from trytond.modules.lims_instrument.resultsimport import get_sample_paddings
 
 IGNORE_SHEET = '###'
 ANALYSIS_CODE = 'Analysis Code'
@@ -22,8 +24,22 @@ def getControllerName():
         return 'Custom Set - XLS'
 
 
+def getParseArgs(self):
+    return (get_sample_paddings(),)
+
+
 def parse(self, infile):
-    LabWorkYear = Pool().get('lims.lab.workyear')
+    self.rawresults = parseFile(infile, *getParseArgs(self))
+
+
+def parseFile(infile, paddings):
+    # the parsing state is kept in a namespace with the same attributes
+    # of the results importer so it can be run out of a transaction
+    self = SimpleNamespace(analysis_code=None, formula=None, header=[],
+        rawresults={})
+    self.getAnalysisCode = partial(getAnalysisCode, self)
+    self.getDataHeader = partial(getDataHeader, self)
+    self.getFormula = partial(getFormula, self)
 
     filedata = io.StringIO(infile)
     workbook = xlrd.open_workbook(file_contents=filedata.getvalue())
@@ -69,12 +85,7 @@ def parse(self, infile):
                     header_found = False
                     continue
 
-                workyear = LabWorkYear.search(
-                    ['code', '=', str(int(row[1]))
-                    ])
-                padding = None
-                if workyear and workyear[0] and workyear[0].sample_sequence:
-                    padding = workyear[0].sample_sequence.padding
+                padding = paddings.get(str(int(row[1])))
                 if padding:
                     sample = '%%0%sd' % padding % int(row[0])
                     fraction = str(int(row[1])) + '/' + sample + \
@@ -106,6 +117,7 @@ def parse(self, infile):
                                 repetition: values,
                                 },
                             }
+    return self.rawresults
 
 
 def getAnalysisCode(self, row):
@@ -6,8 +6,8 @@ import xlrd
 from io import BytesIO
 from datetime import date
 
-from trytond.pool import Pool
 from trytond.transaction import Transaction
+from trytond.modules.lims_instrument.resultsimport import get_sample_paddings
 
 
 COL = {'A': 0, 'B': 1, 'C': 2, 'D': 3, 'E': 4, 'F': 5, 'G': 6, 'H': 7, 'I': 8,
@@ -21,9 +21,16 @@ def getControllerName():
         return 'Generic Service Form - XLS'
 
 
+def getParseArgs(self):
+    return (get_sample_paddings(),)
+
+
 def parse(self, infile):
-    LabWorkYear = Pool().get('lims.lab.workyear')
+    self.rawresults = parseFile(infile, *getParseArgs(self))
+
 
+def parseFile(infile, paddings):
+    rawresults = {}
     filedata = BytesIO(infile)
     workbook = xlrd.open_workbook(file_contents=filedata.getvalue())
     worksheets = workbook.sheet_names()
@@ -70,11 +77,7 @@ def parse(self, infile):
             row4th[COL['E']].ctype == xlrd.XL_CELL_NUMBER) else None
         year = int(row4th[COL['F']].value) if (
             row4th[COL['F']].ctype == xlrd.XL_CELL_NUMBER) else None
-        workyear = LabWorkYear.search(
-            ['code', '=', str(year)])
-        padding = None
-        if workyear and workyear[0] and workyear[0].sample_sequence:
-            padding = workyear[0].sample_sequence.padding
+        padding = paddings.get(str(year))
         if padding and sample:
             sample = '%%0%sd' % padding % sample
         else:
@@ -149,17 +152,18 @@ def parse(self, infile):
                 values['trace_report'] = True
             values['row_number'] = curr_row + 1
 
-            if fraction in self.rawresults:
-                if analysis_code in self.rawresults[fraction]:
-                    self.rawresults[fraction][analysis_code][
+            if fraction in rawresults:
+                if analysis_code in rawresults[fraction]:
+                    rawresults[fraction][analysis_code][
                         repetition] = values
                 else:
-                    self.rawresults[fraction][analysis_code] = {
+                    rawresults[fraction][analysis_code] = {
                         repetition: values,
                         }
             else:
-                self.rawresults[fraction] = {
+                rawresults[fraction] = {
                     analysis_code: {
                         repetition: values,
                         },
                     }
+    return rawresults
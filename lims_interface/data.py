@@ -3,6 +3,7 @@
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
 import collections.abc
+import logging
 from sql import (Table as SqlTable, Column as SqlColumn, Literal,
     Desc, Asc, NullsFirst, NullsLast)
 from sql.aggregate import Count
@@ -29,6 +30,11 @@ from .interface import FIELD_TYPE_TRYTON, FIELD_TYPE_CAST
 
 ALLOWED_RESULT_TYPES = (str, int, float, Decimal, datetime.time,
                         datetime.date, datetime.timedelta, type(None))
+FORMULAS_CHUNK_SIZE = 1000
+# Rows inserted or updated with a single statement
+WRITE_CHUNK_SIZE = 1000
+
+logger = logging.getLogger('lims_interface')
 
 
 def data_record(name, field_names):
@@ -710,18 +716,23 @@ class Data(ModelSQL, ModelView):
         sql_table = cls.get_sql_table()
         cursor = Transaction().connection.cursor()
 
-        ids = []
-        for record in vlist:
-            fields = []
-            values = []
-            for key, value in record.items():
-                fields.append(SqlColumn(sql_table, key))
-                values.append(value)
-
-            query = sql_table.insert(fields, values=[values],
-                returning=[sql_table.id])
-            cursor.execute(*query)
-            ids.append(cursor.fetchone()[0])
+        # rows with the same fields are inserted with a single statement
+        by_fields = defaultdict(list)
+        for i, record in enumerate(vlist):
+            by_fields[tuple(record.keys())].append(i)
+
+        ids = [None] * len(vlist)
+        for keys, indexes in by_fields.items():
+            fields = [SqlColumn(sql_table, key) for key in keys]
+            for sub_indexes in grouped_slice(indexes, WRITE_CHUNK_SIZE):
+                sub_indexes = list(sub_indexes)
+                values = [[vlist[i][key] for key in keys]
+                    for i in sub_indexes]
+                query = sql_table.insert(fields, values=values,
+                    returning=[sql_table.id])
+                cursor.execute(*query)
+                for i, (id_,) in zip(sub_indexes, cursor.fetchall()):
+                    ids[i] = id_
         records = cls.browse(ids)
         cls.update_formulas(records)
         return records
@@ -747,12 +758,37 @@ class Data(ModelSQL, ModelView):
         cls.update_formulas(all_records)
 
     @classmethod
-    def update_formulas(cls, records=None):
+    def write_values(cls, updates):
+        """
+        Writes a different dict of values to each record.
+        updates is a list of (record, values) tuples, records that receive
+        the same fields are updated with a single statement.
+        """
+        table = cls.get_table()
         cursor = Transaction().connection.cursor()
-        pool = Pool()
+
+        columns = cls._get_column_types(table)
+        by_fields = defaultdict(list)
+        for record, values in updates:
+            by_fields[tuple(sorted(values.keys()))].append(
+                (record.id, values))
+        for field_names, sub_updates in by_fields.items():
+            for sub_slice in grouped_slice(sub_updates, WRITE_CHUNK_SIZE):
+                cursor.execute(*cls._get_update_values_query(table,
+                    field_names, list(sub_slice), columns))
+        cls.update_formulas([record for record, _ in updates])
+
+    @classmethod
+    def update_formulas(cls, records=None):
+        """
+        Recalculates the formula fields of the records (all the records of
+        the table if None). Records are processed in chunks: the input
+        columns of a chunk are fetched in a single query, formulas are
+        evaluated column by column following the evaluation order and the
+        results are written back with one UPDATE per chunk. Only the chunks
+        whose update fails are written again record by record.
+        """
         Compilation = Pool().get('lims.interface.compilation')
-        TableField = pool.get('lims.interface.table.field')
-        Column = pool.get('lims.interface.column')
 
         compilation_id = Transaction().context.get(
             'lims_interface_compilation')
@@ -760,75 +796,200 @@ class Data(ModelSQL, ModelView):
             compilation = Compilation(compilation_id)
             table = compilation.table
             interface = compilation.interface
-            sql_table = SqlTable(table.name)
         else:
             table = cls.get_table()
-            sql_table = cls.get_sql_table()
             interface = cls.get_interface()
 
-        formula_fields = []
-        fields = TableField.search([
-            ('table', '=', table),
-            ('formula', 'not in', [None, '']),
-            ])
-        for field in fields:
-            col = Column.search([
-                ('interface', '=', interface),
-                ('alias', '=', field.name),
-                ])
-            order = col and col[0].evaluation_order or 0
-            formula_fields.append({
-                'order': order,
-                'field': field,
-                })
+        formula_fields = cls._get_formula_fields(table, interface)
         if not formula_fields:
             return
-        formula_fields = sorted(formula_fields, key=lambda x: x['order'])
 
         if not records:
             records = cls.search([])
-        for record in records:
-            vals = {}
-            fields = []
-            values = []
+
+        columns = cls._get_column_types(table)
+        for sub_records in grouped_slice(records, FORMULAS_CHUNK_SIZE):
+            sub_records = list(sub_records)
+            rows = cls._get_formula_rows(table, sub_records, formula_fields,
+                columns)
+
+            updated = {r.id: {} for r in sub_records}
             for field in formula_fields:
-                for x in (field['field'].inputs or '').split():
-                    if x not in vals:
-                        vals[x] = getattr(record, x)
-                field_name = field['field'].name
-                value = record.get_formula_value(field['field'], vals)
+                field_name = field.name
+                for record in sub_records:
+                    vals = rows[record.id]
+                    for x in (field.inputs or '').split():
+                        if x not in vals:
+                            vals[x] = getattr(record, x)
+                    value = record.get_formula_value(field, vals)
+                    if value is None:
+                        continue
+                    vals[field_name] = value
+                    updated[record.id][field_name] = value
+            updates = [(record.id, updated[record.id])
+                for record in sub_records if updated[record.id]]
+            if updates:
+                cls._write_formula_values(table, updates, columns)
+
+    @classmethod
+    def _get_formula_fields(cls, table, interface):
+        pool = Pool()
+        TableField = pool.get('lims.interface.table.field')
+        Column = pool.get('lims.interface.column')
+
+        fields = TableField.search([
+            ('table', '=', table),
+            ('formula', 'not in', [None, '']),
+            ])
+        if not fields:
+            return []
+        evaluation_order = {}
+        for col in Column.search([
+                ('interface', '=', interface),
+                ('alias', 'in', [f.name for f in fields]),
+                ]):
+            evaluation_order[col.alias] = col.evaluation_order or 0
+        return sorted(fields, key=lambda f: evaluation_order.get(f.name, 0))
+
+    @classmethod
+    def _get_column_types(cls, table):
+        """
+        Returns a dict column name: SQL type of the columns of the table
+        """
+        cursor = Transaction().connection.cursor()
+        cursor.execute('SELECT a.attname, '
+                'format_type(a.atttypid, a.atttypmod) '
+            'FROM pg_attribute a '
+            'WHERE a.attrelid = %s::regclass '
+                'AND a.attnum > 0 '
+                'AND NOT a.attisdropped',
+            ('"%s"' % table.name,))
+        return dict(cursor.fetchall())
+
+    @classmethod
+    def _get_formula_rows(cls, table, records, formula_fields, columns):
+        """
+        Returns a dict record id: {input name: value} with the stored
+        values of every input of the formula fields, fetched in a single
+        query and typed as they are returned by read()
+        """
+        pool = Pool()
+        cursor = Transaction().connection.cursor()
+
+        related_models = {
+            'compilation': 'lims.interface.compilation',
+            'notebook_line': 'lims.notebook.line',
+            }
+        references = set()
+        casts = {}
+        for field in table.fields_:
+            if field.type == 'many2one' and field.related_model:
+                related_models[field.name] = field.related_model.model
+            elif field.type == 'reference':
+                references.add(field.name)
+            cast = FIELD_TYPE_CAST[field.type]
+            if cast:
+                casts[field.name] = cast
+
+        names = set()
+        for field in formula_fields:
+            names.update((field.inputs or '').split())
+        names = sorted(n for n in names if n in columns)
+
+        result = {r.id: {} for r in records}
+        if not names:
+            return result
+        cursor.execute('SELECT id, ' +
+                ', '.join('"%s"' % n for n in names) + ' '
+            'FROM "' + table.name + '" '
+            'WHERE id = ANY(%s::integer[])',
+            ([r.id for r in records],))
+        for row in cursor_dict(cursor):
+            vals = result[row.pop('id')]
+            for name, value in row.items():
                 if value is None:
-                    continue
-                fields.append(SqlColumn(sql_table, field_name))
-                values.append(value)
-                vals[field_name] = value
+                    pass
+                elif name in related_models:
+                    value = pool.get(related_models[name])(value)
+                elif name in references and ',' in value:
+                    model, ref_id = value.split(',', 1)
+                    value = pool.get(model)(int(ref_id))
+                elif name in casts:
+                    value = casts[name](value)
+                vals[name] = value
+        return result
 
-            if not values:
-                continue
-            query = sql_table.update(fields, values,
-                where=(sql_table.id == record.id))
-            savepoint = 'update_formulas_%d' % record.id
+    @classmethod
+    def _write_formula_values(cls, table, updates, columns):
+        cursor = Transaction().connection.cursor()
+        sql_table = SqlTable(table.name)
+
+        by_fields = defaultdict(list)
+        for record_id, values in updates:
+            by_fields[tuple(sorted(values.keys()))].append(
+                (record_id, values))
+
+        for field_names, sub_updates in by_fields.items():
+            query, params = cls._get_update_values_query(table,
+                field_names, sub_updates, columns)
+
+            savepoint = 'update_formulas_%d' % sub_updates[0][0]
             cursor.execute('SAVEPOINT "%s"' % savepoint)
             try:
-                cursor.execute(*query)
+                cursor.execute(query, params)
                 cursor.execute('RELEASE SAVEPOINT "%s"' % savepoint)
             except Exception:
                 cursor.execute('ROLLBACK TO SAVEPOINT "%s"' % savepoint)
-                import logging
-                _logger = logging.getLogger('lims_interface')
-                for f, v in zip(fields, values):
-                    sp = 'update_formula_field_%d_%s' % (record.id, f.name)
-                    cursor.execute('SAVEPOINT "%s"' % sp)
-                    try:
-                        q = sql_table.update([f], [v],
-                            where=(sql_table.id == record.id))
-                        cursor.execute(*q)
-                        cursor.execute('RELEASE SAVEPOINT "%s"' % sp)
-                    except Exception as field_err:
-                        cursor.execute('ROLLBACK TO SAVEPOINT "%s"' % sp)
-                        _logger.warning(
-                            'Formula field "%s" skipped for record %s: %s',
-                            f.name, record.id, field_err)
+                for record_id, values in sub_updates:
+                    cls._write_formula_values_by_record(sql_table,
+                        record_id, values)
+
+    @classmethod
+    def _get_update_values_query(cls, table, field_names, updates, columns):
+        query = ('UPDATE "' + table.name + '" AS t SET ' +
+            ', '.join('"%s" = v."%s"::%s' % (f, f, columns[f])
+                for f in field_names) + ' '
+            'FROM (VALUES ' +
+            ', '.join(['(' + ', '.join(
+                ['%s'] * (len(field_names) + 1)) + ')'] *
+                len(updates)) + ') '
+            'AS v(id, ' + ', '.join('"%s"' % f for f in field_names) +
+            ') '
+            'WHERE t.id = v.id')
+        params = []
+        for record_id, values in updates:
+            params.append(record_id)
+            params.extend(values[f] for f in field_names)
+        return query, params
+
+    @classmethod
+    def _write_formula_values_by_record(cls, sql_table, record_id, values):
+        cursor = Transaction().connection.cursor()
+
+        fields = [SqlColumn(sql_table, f) for f in values.keys()]
+        values = list(values.values())
+        query = sql_table.update(fields, values,
+            where=(sql_table.id == record_id))
+        savepoint = 'update_formulas_%d' % record_id
+        cursor.execute('SAVEPOINT "%s"' % savepoint)
+        try:
+            cursor.execute(*query)
+            cursor.execute('RELEASE SAVEPOINT "%s"' % savepoint)
+        except Exception:
+            cursor.execute('ROLLBACK TO SAVEPOINT "%s"' % savepoint)
+            for f, v in zip(fields, values):
+                sp = 'update_formula_field_%d_%s' % (record_id, f.name)
+                cursor.execute('SAVEPOINT "%s"' % sp)
+                try:
+                    q = sql_table.update([f], [v],
+                        where=(sql_table.id == record_id))
+                    cursor.execute(*q)
+                    cursor.execute('RELEASE SAVEPOINT "%s"' % sp)
+                except Exception as field_err:
+                    cursor.execute('ROLLBACK TO SAVEPOINT "%s"' % sp)
+                    logger.warning(
+                        'Formula field "%s" skipped for record %s: %s',
+                        f.name, record_id, field_err)
 
     def get_formula_value(self, field, vals={}):
         ast = field.get_ast()
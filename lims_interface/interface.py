@@ -16,7 +16,7 @@ from openpyxl import load_workbook
 from decimal import Decimal
 from datetime import datetime, date, time
 from dateutil import relativedelta
-from itertools import chain
+from itertools import chain, islice
 from collections import defaultdict
 
 from trytond.config import config
@@ -34,6 +34,9 @@ from .function import custom_functions
 
 FUNCTIONS.update(custom_functions)
 
+# Number of rows of an origin file imported at once
+COLLECT_CHUNK_SIZE = 1000
+
 FIELD_TYPES = [
     ('char', 'char', 'Text (single-line)', 'fields.Char', 'VARCHAR', str,
         None),
@@ -413,6 +416,11 @@ class Interface(Workflow, ModelSQL, ModelView):
             # interface.check_formulas()
             # interface.check_icons()
 
+            if interface.table:
+                Field.invalidate_formula_cache(interface.table.fields_)
+                GroupedField.invalidate_formula_cache(
+                    interface.table.grouped_fields_)
+
             interface.revision += 1
             table = Table()
             table.name = interface.data_table_name
@@ -1715,16 +1723,6 @@ class Compilation(Workflow, ModelSQL, ModelView):
                 getattr(c, 'collect_%s' % c.interface.template_type)()
 
     def collect_csv(self, create_new_lines=True):
-        pool = Pool()
-        Origin = pool.get('lims.interface.compilation.origin')
-        Data = pool.get('lims.interface.data')
-        NotebookLine = pool.get('lims.notebook.line')
-
-        data_create = []
-        data_write = []
-
-        schema, formula_fields = self._get_schema()
-        schema_keys = list(schema.keys())
         separator = {
             'comma': ',',
             'colon': ':',
@@ -1736,230 +1734,235 @@ class Compilation(Workflow, ModelSQL, ModelView):
         delimiter = separator[self.interface.field_separator]
         first_row = self.interface.first_row - 1
         encoding = self.interface.charset
-        with Transaction().set_context(
-                lims_interface_table=self.table):
-            imported_files = []
-            for origin in self.origins:
-                if origin.imported:
-                    continue
-                filedata = io.BytesIO(origin.origin_file)
-                wrapper = io.TextIOWrapper(filedata, encoding=encoding)
-                try:
-                    str_data = io.StringIO(wrapper.read())
-                except UnicodeDecodeError:
-                    raise UserError(gettext(
-                        'lims_interface.invalid_interface_charset'))
-                reader = csv.reader(str_data, delimiter=delimiter)
-                count = 0
+
+        def read_rows(origin, columns):
+            filedata = io.TextIOWrapper(io.BytesIO(origin.origin_file),
+                encoding=encoding, newline='')
+            reader = csv.reader(filedata, delimiter=delimiter)
+            count = 0
+            try:
                 for row in reader:
                     if count < first_row:
                         count += 1
                         continue
                     if len(row) == 0:
                         continue
-                    line = {'compilation': self.id}
-                    for k in schema_keys:
-                        value = None
-                        default_value = schema[k]['default_value']
-                        if default_value not in (None, ''):
-                            if not create_new_lines:
-                                continue
-                            if default_value.startswith('='):
-                                continue
-                            value = default_value
-                        else:
-                            col = schema[k]['col']
-                            if (not row[col - 1] or
-                                    not str(row[col - 1]).strip()):
-                                line[k] = None
-                                continue
-                            value = row[col - 1]
-
-                        if schema[k]['type'] == 'integer':
-                            line[k] = int(value)
-                        elif schema[k]['type'] == 'float':
-                            line[k] = float(value)
-                        elif schema[k]['type'] == 'numeric':
-                            line[k] = Decimal(str(value))
-                        elif schema[k]['type'] == 'boolean':
-                            line[k] = bool(value)
-                        elif schema[k]['type'] == 'date':
-                            line[k] = str2date(value, self.interface.language)
-                        elif (schema[k]['type'] == 'many2one' and
-                                default_value):
-                            resource = get_model_resource(
-                                schema[k]['model_name'], value,
-                                schema[k]['field_name'])
-                            line[k] = resource[0].id
-                        else:
-                            line[k] = str(value)
-
-                    f_fields = sorted(formula_fields.items(),
-                        key=lambda x: x[1]['evaluation_order'])
-                    for field in f_fields:
-                        line[field[0]] = self._get_formula_value(field, line)
-
-                    line['notebook_line'] = self._get_notebook_line(line)
-                    if (line['notebook_line']):
-                        nl = NotebookLine(line['notebook_line'])
-                        for k in schema_keys:
-                            default_value = schema[k]['default_value']
-                            if (default_value not in (None, '') and
-                                    default_value.startswith('=')):
-                                path = default_value[1:].split('.')
-                                field = path.pop(0)
-                                try:
-                                    value = getattr(nl, field)
-                                    while path:
-                                        field = path.pop(0)
-                                        value = getattr(value, field)
-                                except AttributeError:
-                                    value = None
-                                line[k] = value
-                    line_id = self._get_compilation_line_id(line)
-                    if line_id:
-                        line['id'] = line_id
-                        data_write.append(line)
-                    else:
-                        data_create.append(line)
+                    values = {}
+                    for k, field in columns.items():
+                        col = field['col']
+                        value = row[col - 1] if col <= len(row) else None
+                        if not value or not str(value).strip():
+                            value = None
+                        values[k] = value
+                    yield values
                     count += 1
-                imported_files.append(origin)
-
-            if imported_files:
-                Origin.write(imported_files, {'imported': True})
+            except UnicodeDecodeError:
+                raise UserError(gettext(
+                    'lims_interface.invalid_interface_charset'))
 
-            if data_create and create_new_lines:
-                Data.create(data_create)
-            for data in data_write:
-                data_line = Data(data['id'])
-                del data['id']
-                del data['notebook_line']
-                del data['compilation']
-                Data.write([data_line], data)
+        self._collect(read_rows, create_new_lines, position='col')
 
     def collect_excel(self, create_new_lines=True):
+        first_row = self.interface.first_row
+
+        def read_rows(origin, columns):
+            filedata = io.BytesIO(origin.origin_file)
+            book = load_workbook(filename=filedata, read_only=True,
+                data_only=True)
+            try:
+                sheet = book.active
+                singletons = {}
+                for k, field in columns.items():
+                    if field['singleton']:
+                        singletons[k] = sheet.cell(row=field['row'],
+                            column=field['col']).value
+                for row in sheet.iter_rows(min_row=first_row,
+                        values_only=True):
+                    values = singletons.copy()
+                    for k, field in columns.items():
+                        if k in singletons:
+                            continue
+                        col = field['col']
+                        values[k] = row[col - 1] if col <= len(row) else None
+                    yield values
+            finally:
+                book.close()
+
+        self._collect(read_rows, create_new_lines, parse_dates=False,
+            position='col')
+
+    def collect_txt(self, create_new_lines=True):
+        first_row = self.interface.first_row - 1
+        encoding = self.interface.charset
+
+        def read_rows(origin, columns):
+            filedata = io.TextIOWrapper(io.BytesIO(origin.origin_file),
+                encoding=encoding)
+            count = 0
+            try:
+                for text in filedata:
+                    if count < first_row:
+                        count += 1
+                        continue
+                    text = text.rstrip('\r\n')
+                    if not text.strip():
+                        continue
+                    values = {}
+                    for k, field in columns.items():
+                        value = text[field['start'] - 1:field['end']]
+                        values[k] = value.strip() or None
+                    yield values
+                    count += 1
+            except UnicodeDecodeError:
+                raise UserError(gettext(
+                    'lims_interface.invalid_interface_charset'))
+
+        self._collect(read_rows, create_new_lines, position='start')
+
+    def _collect(self, read_rows, create_new_lines=True, parse_dates=True,
+            position='col'):
+        """
+        Imports the origins not imported yet. read_rows(origin, columns)
+        must yield, for each row of the origin file, a dict with the raw
+        value of the given source columns (None when empty); only the
+        columns with a source position ('col' or 'start' key of the
+        schema) of the kind of file are passed to it. The rows are
+        processed in chunks of COLLECT_CHUNK_SIZE: notebook lines and
+        existing data lines are searched once per chunk and the chunk is
+        inserted and updated with a few statements.
+        """
         pool = Pool()
         Origin = pool.get('lims.interface.compilation.origin')
-        Data = pool.get('lims.interface.data')
-        NotebookLine = pool.get('lims.notebook.line')
 
-        data_create = []
-        data_write = []
+        origins = [o for o in self.origins if not o.imported]
+        if not origins:
+            return
 
         schema, formula_fields = self._get_schema()
-        schema_keys = list(schema.keys())
-        first_row = self.interface.first_row
+        columns = dict((k, v) for k, v in schema.items()
+            if v['default_value'] in (None, '') and v[position])
+        defaults = {}
+        if create_new_lines:
+            for k, field in schema.items():
+                default_value = field['default_value']
+                if (default_value not in (None, '') and
+                        not default_value.startswith('=')):
+                    defaults[k] = self._get_collect_value(field,
+                        default_value, default=True)
+        f_fields = sorted(formula_fields.items(),
+            key=lambda x: x[1]['evaluation_order'])
+        parser = formulas.Parser()
+        asts = dict((f[0], parser.ast(f[1]['formula'])[1].compile())
+            for f in f_fields)
+
         with Transaction().set_context(
                 lims_interface_table=self.table):
-            imported_files = []
-            for origin in self.origins:
-                if origin.imported:
-                    continue
-                filedata = io.BytesIO(origin.origin_file)
-                book = load_workbook(filename=filedata, data_only=True)
-                sheet = book.active
-                max_row = sheet.max_row + 1
-                if first_row <= max_row:
-                    for i in range(first_row, max_row):
-                        line = {'compilation': self.id}
-                        for k in schema_keys:
-                            value = None
-                            default_value = schema[k]['default_value']
-                            if default_value not in (None, ''):
-                                if not create_new_lines:
-                                    continue
-                                if default_value.startswith('='):
-                                    continue
-                                value = default_value
-                            else:
-                                col = schema[k]['col']
-                                row = i
-                                if schema[k]['singleton']:
-                                    row = schema[k]['row']
-                                value = sheet.cell(row=row, column=col).value
-                                if value is None:
-                                    line[k] = None
-                                    continue
-
-                            if schema[k]['type'] == 'integer':
-                                line[k] = int(value)
-                            elif schema[k]['type'] == 'float':
-                                line[k] = float(value)
-                            elif schema[k]['type'] == 'numeric':
-                                line[k] = Decimal(str(value))
-                            elif schema[k]['type'] == 'boolean':
-                                line[k] = bool(value)
-                            elif schema[k]['type'] == 'date':
-                                if default_value:
-                                    line[k] = str2date(
-                                        value, self.interface.language)
-                                else:
-                                    if isinstance(value, datetime):
-                                        line[k] = value
-                                    else:
-                                        line[k] = None
-                            elif (schema[k]['type'] == 'many2one' and
-                                    default_value):
-                                resource = get_model_resource(
-                                    schema[k]['model_name'], value,
-                                    schema[k]['field_name'])
-                                line[k] = resource[0].id
-                            else:
-                                line[k] = str(value)
-
-                        f_fields = sorted(formula_fields.items(),
-                            key=lambda x: x[1]['evaluation_order'])
-                        for field in f_fields:
-                            line[field[0]] = self._get_formula_value(
-                                field, line)
-
-                        line['notebook_line'] = self._get_notebook_line(line)
-                        if (line['notebook_line']):
-                            nl = NotebookLine(line['notebook_line'])
-                            for k in schema_keys:
-                                default_value = schema[k]['default_value']
-                                if (default_value not in (None, '') and
-                                        default_value.startswith('=')):
-                                    path = default_value[1:].split('.')
-                                    field = path.pop(0)
-                                    try:
-                                        value = getattr(nl, field)
-                                        while path:
-                                            field = path.pop(0)
-                                            value = getattr(value, field)
-                                    except AttributeError:
-                                        value = None
-                                    line[k] = value
-                        line_id = self._get_compilation_line_id(line)
-                        if line_id:
-                            line['id'] = line_id
-                            data_write.append(line)
-                        else:
-                            data_create.append(line)
-                imported_files.append(origin)
-
-            if imported_files:
-                Origin.write(imported_files, {'imported': True})
-
-            if data_create and create_new_lines:
-                Data.create(data_create)
-            for data in data_write:
-                data_line = Data(data['id'])
-                del data['id']
-                del data['notebook_line']
-                del data['compilation']
-                Data.write([data_line], data)
+            created_ids = set()
+            rows = chain.from_iterable(read_rows(o, columns)
+                for o in origins)
+            while True:
+                chunk = list(islice(rows, COLLECT_CHUNK_SIZE))
+                if not chunk:
+                    break
+                lines = []
+                for values in chunk:
+                    line = {'compilation': self.id}
+                    for k in schema:
+                        if k in defaults:
+                            line[k] = defaults[k]
+                        elif k in columns:
+                            value = values.get(k)
+                            line[k] = (None if value is None else
+                                self._get_collect_value(schema[k], value,
+                                    parse_dates=parse_dates))
+                    for field in f_fields:
+                        line[field[0]] = self._get_formula_value(field,
+                            line, ast=asts[field[0]])
+                    lines.append(line)
+                self._collect_lines(lines, schema, created_ids,
+                    create_new_lines)
+            Origin.write(origins, {'imported': True})
+
+    def _get_collect_value(self, field, value, parse_dates=True,
+            default=False):
+        type_ = field['type']
+        if type_ == 'integer':
+            return int(value)
+        elif type_ == 'float':
+            return float(value)
+        elif type_ == 'numeric':
+            return Decimal(str(value))
+        elif type_ == 'boolean':
+            return bool(value)
+        elif type_ == 'date':
+            if parse_dates or default:
+                return str2date(value, self.interface.language)
+            if isinstance(value, datetime):
+                return value
+            return None
+        elif type_ == 'many2one' and default:
+            resource = get_model_resource(field['model_name'], value,
+                field['field_name'])
+            return resource[0].id
+        return str(value)
+
+    def _collect_lines(self, lines, schema, created_ids,
+            create_new_lines=True):
+        pool = Pool()
+        Data = pool.get('lims.interface.data')
+        NotebookLine = pool.get('lims.notebook.line')
 
-    def collect_txt(self, create_new_lines=True):
-        return
+        nl_ids = self._get_notebook_lines(lines)
+        nb_lines = dict((nl.id, nl) for nl in NotebookLine.browse(
+            list(set(i for i in nl_ids if i))))
+        nl_fields = [k for k, v in schema.items()
+            if v['default_value'] not in (None, '') and
+            v['default_value'].startswith('=')]
+        for line, nl_id in zip(lines, nl_ids):
+            line['notebook_line'] = nl_id
+            if not nl_id:
+                continue
+            nl = nb_lines[nl_id]
+            for k in nl_fields:
+                path = schema[k]['default_value'][1:].split('.')
+                field = path.pop(0)
+                try:
+                    value = getattr(nl, field)
+                    while path:
+                        field = path.pop(0)
+                        value = getattr(value, field)
+                except AttributeError:
+                    value = None
+                line[k] = value
+
+        data_create = []
+        data_write = {}
+        line_ids = self._get_compilation_lines_ids(lines, created_ids)
+        for line, line_id in zip(lines, line_ids):
+            if line_id:
+                values = line.copy()
+                del values['notebook_line']
+                del values['compilation']
+                data_write[line_id] = values
+            else:
+                data_create.append(line)
+
+        if data_create and create_new_lines:
+            created_ids.update(d.id for d in Data.create(data_create))
+        if data_write:
+            Data.write_values([(Data(line_id), values)
+                for line_id, values in data_write.items()])
 
     def _get_schema(self):
         schema = {}
         formula_fields = {}
         for column in self.interface.columns:
-            if column.source_column or column.default_value:
+            if (column.source_column or column.source_start or
+                    column.default_value):
                 schema[column.alias] = {
                     'col': column.source_column,
+                    'start': column.source_start,
+                    'end': column.source_end,
                     'type': column.type_,
                     'singleton': False,
                     'default_value': None,
@@ -1993,9 +1996,10 @@ class Compilation(Workflow, ModelSQL, ModelView):
                     }
         return schema, formula_fields
 
-    def _get_formula_value(self, field, line):
-        parser = formulas.Parser()
-        ast = parser.ast(field[1]['formula'])[1].compile()
+    def _get_formula_value(self, field, line, ast=None):
+        if ast is None:
+            parser = formulas.Parser()
+            ast = parser.ast(field[1]['formula'])[1].compile()
         inputs = (' '.join([x for x in ast.inputs])).lower().split()
         inputs = [line[x] for x in inputs]
         try:
@@ -2015,80 +2019,160 @@ class Compilation(Workflow, ModelSQL, ModelView):
                     value = None
         return value
 
-    def _get_notebook_line(self, line):
+    def _get_notebook_lines(self, lines):
+        """
+        Returns the notebook line id of each line (None if not found)
+        searching all of them with a single query
+        """
         pool = Pool()
         NotebookLine = pool.get('lims.notebook.line')
+        Notebook = pool.get('lims.notebook')
+        Fraction = pool.get('lims.fraction')
+        Analysis = pool.get('lims.analysis')
+        Method = pool.get('lims.lab.method')
+        cursor = Transaction().connection.cursor()
 
         fraction_field = self.interface.fraction_field
         analysis_field = self.interface.analysis_field
         repetition_field = self.interface.repetition_field
         if not fraction_field or not analysis_field or not repetition_field:
-            return None
+            return [None] * len(lines)
+        method_field = self.interface.method_field
 
-        fraction_value = line.get(fraction_field.alias)
-        analysis_value = line.get(analysis_field.alias)
-        repetition_value = line.get(repetition_field.alias)
-        if (fraction_value is None or
-                analysis_value is None or
-                repetition_value is None):
-            return None
+        keys = []
+        for line in lines:
+            fraction_value = line.get(fraction_field.alias)
+            analysis_value = line.get(analysis_field.alias)
+            repetition_value = line.get(repetition_field.alias)
+            if (fraction_value is None or
+                    analysis_value is None or
+                    repetition_value is None):
+                keys.append(None)
+                continue
+            try:
+                repetition_value = int(repetition_value)
+            except (TypeError, ValueError):
+                keys.append(None)
+                continue
+            method_value = None
+            if method_field:
+                method_value = line.get(method_field.alias)
+                if method_value is not None:
+                    method_value = str(method_value).split(' - ')[0]
+            keys.append((str(fraction_value),
+                str(analysis_value).split(' - ')[0],
+                repetition_value, method_value))
+
+        found = defaultdict(list)
+        fractions = list(set(k[0] for k in keys if k))
+        if fractions:
+            cursor.execute('SELECT f.number, a.code, nl.repetition, '
+                    'm.code, nl.id '
+                'FROM "' + NotebookLine._table + '" nl '
+                    'INNER JOIN "' + Notebook._table + '" n '
+                    'ON n.id = nl.notebook '
+                    'INNER JOIN "' + Fraction._table + '" f '
+                    'ON f.id = n.fraction '
+                    'INNER JOIN "' + Analysis._table + '" a '
+                    'ON a.id = nl.analysis '
+                    'LEFT JOIN "' + Method._table + '" m '
+                    'ON m.id = nl.method '
+                'WHERE f.number = ANY(%s) '
+                    'AND a.code = ANY(%s) '
+                    'AND a.automatic_acquisition = TRUE '
+                    'AND nl.annulled = FALSE '
+                'ORDER BY nl.id',
+                (fractions, list(set(k[1] for k in keys if k))))
+            for number, code, repetition, method, nl_id in cursor.fetchall():
+                found[(number, code, repetition)].append((method, nl_id))
 
-        clause = [
-            ('notebook.fraction.number', '=', fraction_value),
-            ('analysis.code', '=', analysis_value.split(' - ')[0]),
-            ('analysis.automatic_acquisition', '=', True),
-            ('repetition', '=', repetition_value),
-            ('annulled', '=', False),
-            ]
-        method_field = self.interface.method_field
-        if method_field:
-            method_value = line.get(method_field.alias)
-            if method_value is not None:
-                clause.append(
-                    ('method.code', '=', method_value.split(' - ')[0]))
-
-        nb_line = NotebookLine.search(clause)
-        if nb_line:
-            return nb_line[0].id
-        return None
+        res = []
+        for key in keys:
+            nb_lines = key and found.get(key[:3]) or []
+            if key and key[3] is not None:
+                nb_lines = [x for x in nb_lines if x[0] == key[3]]
+            res.append(nb_lines and nb_lines[0][1] or None)
+        return res
 
-    def _get_compilation_line_id(self, line):
+    def _get_compilation_lines_ids(self, lines, exclude_ids=None):
+        """
+        Returns the id of the data line of the compilation that matches each
+        line (None if not found) searching all of them with a single query.
+        Data lines in exclude_ids are never matched.
+        """
         pool = Pool()
         Data = pool.get('lims.interface.data')
 
-        clause = [('compilation', '=', line['compilation'])]
-        if line.get('notebook_line'):
-            clause.append(('notebook_line', '=', line['notebook_line']))
+        fraction_field = self.interface.fraction_field
+        analysis_field = self.interface.analysis_field
+        repetition_field = self.interface.repetition_field
+        method_field = self.interface.method_field
+        key_fields = []
+        if fraction_field and analysis_field and repetition_field:
+            key_fields = [fraction_field.alias, analysis_field.alias,
+                repetition_field.alias]
+        method_alias = method_field and method_field.alias or None
+
+        keys = []
+        nl_ids = set()
+        clause = []
+        for line in lines:
+            if line.get('notebook_line'):
+                nl_ids.add(line['notebook_line'])
+                keys.append(('notebook_line', line['notebook_line']))
+                continue
+            key = tuple(line.get(f) for f in key_fields)
+            if not key or None in key:
+                keys.append(None)
+                continue
+            sub_clause = [(f, '=', v) for f, v in zip(key_fields, key)]
+            method_value = method_alias and line.get(method_alias)
+            if method_alias and method_value is not None:
+                sub_clause.append((method_alias, '=', method_value))
+            else:
+                method_value = None
+            clause.append(sub_clause)
+            keys.append(('key', key, method_value))
+        if nl_ids:
+            clause.append([('notebook_line', 'in', list(nl_ids))])
+        if not clause:
+            return [None] * len(lines)
+
+        by_notebook_line = {}
+        by_key = defaultdict(list)
+        records = Data.search([
+            ('compilation', '=', self.id),
+            ['OR'] + clause,
+            ])
+        records = [r for r in records
+            if not exclude_ids or r.id not in exclude_ids]
+        if records:
+            read_fields = ['notebook_line'] + key_fields
+            if method_alias:
+                read_fields.append(method_alias)
+            values = dict((x['id'], x) for x in Data.read(
+                [r.id for r in records], read_fields))
+            for record in records:
+                row = values[record.id]
+                if row['notebook_line']:
+                    by_notebook_line.setdefault(row['notebook_line'],
+                        record.id)
+                if key_fields:
+                    by_key[tuple(row[f] for f in key_fields)].append(
+                        (method_alias and row[method_alias], record.id))
 
-        else:
-            sub_clause = [('id', '=', -1)]
-            fraction_field = self.interface.fraction_field
-            analysis_field = self.interface.analysis_field
-            repetition_field = self.interface.repetition_field
-            if fraction_field and analysis_field and repetition_field:
-
-                fraction_value = line.get(fraction_field.alias)
-                analysis_value = line.get(analysis_field.alias)
-                repetition_value = line.get(repetition_field.alias)
-
-                if (fraction_value is not None and
-                        analysis_value is not None and
-                        repetition_value is not None):
-                    sub_clause = [
-                        (fraction_field.alias, '=', fraction_value),
-                        (analysis_field.alias, '=', analysis_value),
-                        (repetition_field.alias, '=', repetition_value),
-                        ]
-                    method_field = self.interface.method_field
-                    if method_field:
-                        method_value = line.get(method_field.alias)
-                        if method_value is not None:
-                            sub_clause.append(
-                                (method_field.alias, '=', method_value))
-
-            clause.extend(sub_clause)
-        line = Data.search(clause)
-        return line and line[0].id or None
+        res = []
+        for key in keys:
+            if key is None:
+                res.append(None)
+            elif key[0] == 'notebook_line':
+                res.append(by_notebook_line.get(key[1]))
+            else:
+                data_lines = by_key.get(key[1], [])
+                if key[2] is not None:
+                    data_lines = [x for x in data_lines if x[0] == key[2]]
+                res.append(data_lines and data_lines[0][1] or None)
+        return res
 
     @classmethod
     @ModelView.button
@@ -2177,6 +2261,9 @@ class Compilation(Workflow, ModelSQL, ModelView):
 
             sample_ids = set()
             notebook_lines = []
+            accepted_lines = []
+            to_write = defaultdict(list)
+            to_translate = defaultdict(lambda: defaultdict(list))
             with Transaction().set_context(lims_interface_table=c.table):
                 lines = Data.search([('compilation', '=', c.id)])
                 for line in lines:
@@ -2215,23 +2302,49 @@ class Compilation(Workflow, ModelSQL, ModelView):
                         #data['end_date'] = today
                         data['accepted'] = True
                         data['acceptance_date'] = now
-                    if data:
-                        with Transaction().set_context(
-                                update_samples_state=False,
-                                update_referrals_state=False):
-                            NotebookLine.write([nb_line], data)
-                    if translation_data:
-                        for language, data in translation_data.items():
-                            with Transaction().set_context(language=language,
-                                    update_samples_state=False,
-                                    update_referrals_state=False):
-                                NotebookLine.write([nb_line], data)
-                    if data or translation_data:
-                        sample_ids.add(nb_line.sample.id)
-                        notebook_lines.append(nb_line)
-            Sample.update_samples_state(list(sample_ids))
+                        accepted_lines.append(nb_line)
+                    to_write[cls._get_confirm_values_key(data)].append(
+                        (nb_line, data))
+                    for language, data in translation_data.items():
+                        to_translate[language][
+                            cls._get_confirm_values_key(data)].append(
+                                (nb_line, data))
+                    sample_ids.add(nb_line.sample.id)
+                    notebook_lines.append(nb_line)
+
+            # lines with identical values are written together and the
+            # notebook line updates are done once for all of them
+            with Transaction().set_context(
+                    defer_samples_state=True,
+                    update_referrals_state=False,
+                    update_detail_analysis=False):
+                args = []
+                for values in to_write.values():
+                    args.extend(([x[0] for x in values], values[0][1]))
+                if args:
+                    NotebookLine.write(*args)
+                for language, translations in to_translate.items():
+                    args = []
+                    for values in translations.values():
+                        args.extend(([x[0] for x in values], values[0][1]))
+                    with Transaction().set_context(language=language):
+                        NotebookLine.write(*args)
+                Sample.update_samples_state(list(sample_ids))
+            if accepted_lines:
+                NotebookLine.update_detail_analysis(accepted_lines, True)
+            Sample.flush_samples_state()
             NotebookLine.update_referrals_state(notebook_lines)
 
+    @staticmethod
+    def _get_confirm_values_key(values):
+        key = tuple(sorted(values.items()))
+        try:
+            hash(key)
+        except TypeError:
+            # unhashable values are never grouped
+            key = (id(values),)
+        return key
+
     @classmethod
     def _allow_confirm_line(cls, line):
         nb_line = line.notebook_line
@@ -3,13 +3,98 @@
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
 import formulas
+from threading import Lock
 
 from trytond import backend
+from trytond.config import config
 from trytond.model import ModelSQL, ModelView, fields
+from trytond.cache import Cache, LRUDict
 from trytond.transaction import Transaction
 from .interface import FIELD_TYPE_SQL, FIELD_TYPE_SELECTION
 
 
+class CompiledFormula:
+    """
+    Wraps a compiled formula so it can be shared between threads: the
+    compiled function keeps the state of the running evaluation, so calls
+    to the same formula are serialized.
+    """
+
+    def __init__(self, formula):
+        parser = formulas.Parser()
+        self.function = parser.ast(formula)[1].compile()
+        self.inputs = self.function.inputs
+        self._lock = Lock()
+
+    def __call__(self, *args):
+        with self._lock:
+            return self.function(*args)
+
+
+class FormulaCache:
+    """
+    Process-wide LRU cache of compiled formulas.
+    Keys are (model name, record id, formula, write date) so a modified or
+    regenerated table field never hits a previous compilation.
+    """
+
+    def __init__(self, size_limit):
+        self.hits = 0
+        self.misses = 0
+        self._cache = LRUDict(size_limit)
+        self._lock = Lock()
+
+    def get(self, key, formula):
+        with self._lock:
+            compiled = self._cache.get(key)
+            if compiled is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return compiled
+            self.misses += 1
+        compiled = CompiledFormula(formula)
+        with self._lock:
+            self._cache[key] = compiled
+        return compiled
+
+    def invalidate(self, model_name, ids):
+        ids = set(ids)
+        with self._lock:
+            for key in [k for k in self._cache
+                    if k[0] == model_name and k[1] in ids]:
+                del self._cache[key]
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._cache),
+                'size_limit': self._cache.size_limit,
+                'hits': self.hits,
+                'misses': self.misses,
+                }
+
+
+formula_cache = FormulaCache(config.getint('lims_interface',
+    'formula_cache_size', default=1024))
+
+
+def get_compiled_formula(record, formula):
+    """
+    Returns the compiled formula of a table field (or grouped field)
+    record, from the formula cache when the record is stored
+    """
+    if record is None or record.id is None or record.id < 0:
+        return CompiledFormula(formula)
+    key = (record.__name__, record.id, formula,
+        record.write_date or record.create_date)
+    return formula_cache.get(key, formula)
+
+
 class ModelEmulation:
     __doc__ = None
     _table = None
@@ -107,10 +192,66 @@ class TableField(ModelSQL, ModelView):
     group_colspan = fields.Integer('Group Colspan')
     group_col = fields.Integer('Group Col')
 
+    _transfer_columns_cache = Cache(
+        'lims.interface.table.field.transfer_columns', context=False)
+
+    @classmethod
+    def create(cls, vlist):
+        table_fields = super().create(vlist)
+        cls._transfer_columns_cache.clear()
+        return table_fields
+
+    @classmethod
+    def write(cls, *args):
+        super().write(*args)
+        cls._transfer_columns_cache.clear()
+
+    @classmethod
+    def delete(cls, table_fields):
+        super().delete(table_fields)
+        cls._transfer_columns_cache.clear()
+
     def get_ast(self):
-        parser = formulas.Parser()
-        ast = parser.ast(self.formula)[1].compile()
-        return ast
+        return get_compiled_formula(self, self.formula)
+
+    @classmethod
+    def invalidate_formula_cache(cls, table_fields):
+        formula_cache.invalidate(cls.__name__, [f.id for f in table_fields])
+
+    @staticmethod
+    def get_formula_cache_stats():
+        return formula_cache.stats()
+
+    @classmethod
+    def get_transfer_columns(cls, table_ids):
+        '''
+        Returns for each table a dict with the (name, type) of the first
+        column transferred to each notebook line field
+        '''
+        result = {}
+        missing = []
+        for table_id in set(table_ids):
+            columns = cls._transfer_columns_cache.get(table_id)
+            if columns is None:
+                missing.append(table_id)
+            else:
+                result[table_id] = columns
+        if not missing:
+            return result
+
+        for table_id in missing:
+            result[table_id] = {}
+        for field in cls.search([
+                ('table', 'in', missing),
+                ('transfer_field', '=', True),
+                ('related_line_field', '!=', None),
+                ]):
+            columns = result[field.table.id]
+            columns.setdefault(field.related_line_field.name,
+                (field.name, field.type))
+        for table_id in missing:
+            cls._transfer_columns_cache.set(table_id, result[table_id])
+        return result
 
 
 class TableGroupedField(ModelSQL, ModelView):
@@ -140,14 +281,15 @@ class TableGroupedField(ModelSQL, ModelView):
     def get_inputs(self, name=None):
         if not self.formula:
             return
-        parser = formulas.Parser()
-        ast = parser.ast(self.formula)[1].compile()
+        ast = self.get_ast()
         return (' '.join([x for x in ast.inputs])).lower()
 
     def get_ast(self):
-        parser = formulas.Parser()
-        ast = parser.ast(self.formula)[1].compile()
-        return ast
+        return get_compiled_formula(self, self.formula)
+
+    @classmethod
+    def invalidate_formula_cache(cls, table_fields):
+        formula_cache.invalidate(cls.__name__, [f.id for f in table_fields])
 
 
 class TableView(ModelSQL, ModelView):
@@ -1,16 +1,271 @@
 # This file is part of lims_interface module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
+import datetime
 import unittest
+from collections import namedtuple
+from decimal import Decimal
+from unittest import mock
 
 import trytond.tests.test_tryton
-from trytond.tests.test_tryton import ModuleTestCase
+from trytond import backend
+from trytond.pool import Pool
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.transaction import Transaction
+
+InterfaceTable = namedtuple('InterfaceTable', ['name'])
 
 
 class LimsTestCase(ModuleTestCase):
     'Test lims_interface module'
     module = 'lims_interface'
 
+    def test_formula_cache(self):
+        "Compiled formulas are reused and evicted in LRU order"
+        from trytond.modules.lims_interface.table import FormulaCache
+
+        cache = FormulaCache(2)
+        first = cache.get(('field', 1, '=A+1', None), '=A+1')
+        self.assertEqual(float(first(1)), 2.0)
+        self.assertIs(cache.get(('field', 1, '=A+1', None), '=A+1'), first)
+        cache.get(('field', 2, '=A*2', None), '=A*2')
+        cache.get(('field', 3, '=A*3', None), '=A*3')
+        self.assertEqual(cache.stats()['size'], 2)
+        self.assertIsNot(cache.get(('field', 1, '=A+1', None), '=A+1'),
+            first)
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.misses, 4)
+
+        cache.invalidate('field', [1])
+        self.assertEqual(cache.stats()['size'], 1)
+
+    def _get_line_field(self, name):
+        ModelField = Pool().get('ir.model.field')
+        field, = ModelField.search([
+            ('model.model', '=', 'lims.notebook.line'),
+            ('name', '=', name),
+            ])
+        return field
+
+    @with_transaction()
+    def test_transfer_columns_cache(self):
+        "The transfer columns are cached until the table fields change"
+        pool = Pool()
+        Table = pool.get('lims.interface.table')
+        Field = pool.get('lims.interface.table.field')
+        cursor = Transaction().connection.cursor()
+
+        result = self._get_line_field('result')
+        table, = Table.create([{
+            'name': 'lims_interface_test_transfer',
+            'fields_': [('create', [{
+                'name': 'res',
+                'string': 'Result',
+                'type': 'char',
+                'transfer_field': True,
+                'related_line_field': result.id,
+                }, {
+                'name': 'notes',
+                'string': 'Notes',
+                'type': 'char',
+                }])],
+            }])
+        self.assertEqual(Field.get_transfer_columns([table.id]),
+            {table.id: {'result': ('res', 'char')}})
+
+        cursor.execute('UPDATE "' + Field._table + '" '
+            'SET name = %s WHERE "table" = %s AND name = %s',
+            ('renamed', table.id, 'res'))
+        self.assertEqual(Field.get_transfer_columns([table.id]),
+            {table.id: {'result': ('res', 'char')}})
+
+        res, = Field.search([
+            ('table', '=', table.id),
+            ('name', '=', 'renamed'),
+            ])
+        literal_result = self._get_line_field('literal_result')
+        Field.write([res], {'related_line_field': literal_result.id})
+        self.assertEqual(Field.get_transfer_columns([table.id]),
+            {table.id: {'literal_result': ('renamed', 'char')}})
+
+        modifier, = Field.create([{
+            'table': table.id,
+            'name': 'modifier',
+            'string': 'Modifier',
+            'type': 'many2one',
+            'transfer_field': True,
+            'related_line_field': (
+                self._get_line_field('result_modifier').id),
+            }])
+        self.assertEqual(Field.get_transfer_columns([table.id]),
+            {table.id: {
+                'literal_result': ('renamed', 'char'),
+                'result_modifier': ('modifier', 'many2one'),
+                }})
+
+        Field.delete([res])
+        self.assertEqual(Field.get_transfer_columns([table.id]),
+            {table.id: {'result_modifier': ('modifier', 'many2one')}})
+
+    def _get_collect_compilation(self, columns, origin_file, **kwargs):
+        pool = Pool()
+        Compilation = pool.get('lims.interface.compilation')
+        Origin = pool.get('lims.interface.compilation.origin')
+        Interface = pool.get('lims.interface')
+        Column = pool.get('lims.interface.column')
+
+        column_values = []
+        for values in columns:
+            column = {
+                'name': values['alias'],
+                'type_': 'char',
+                'source_column': None,
+                'source_start': None,
+                'source_end': None,
+                'source_row': None,
+                'singleton': False,
+                'default_value': None,
+                'related_model': None,
+                'group': None,
+                'expression': None,
+                'evaluation_order': None,
+                }
+            column.update(values)
+            column_values.append(Column(**column))
+        interface = Interface(columns=column_values, grouped_repetitions=[],
+            first_row=2, charset='utf-8', language=None, **kwargs)
+        return Compilation(interface=interface, table=None,
+            origins=[Origin(origin_file=origin_file, imported=False)])
+
+    def _collect(self, compilation, method):
+        pool = Pool()
+        Compilation = pool.get('lims.interface.compilation')
+        Origin = pool.get('lims.interface.compilation.origin')
+
+        with mock.patch(
+                'trytond.modules.lims_interface.interface.COLLECT_CHUNK_SIZE',
+                2), \
+                mock.patch.object(Compilation, '_collect_lines') as collect, \
+                mock.patch.object(Origin, 'write') as write:
+            getattr(compilation, method)()
+            write.assert_called_once_with(list(compilation.origins),
+                {'imported': True})
+        return [call[0][0] for call in collect.call_args_list]
+
+    @with_transaction()
+    def test_collect_csv(self):
+        "Origin rows are collected in chunks from the csv columns"
+        compilation = self._get_collect_compilation([
+                {'alias': 'sample', 'source_column': 1},
+                {'alias': 'result', 'source_column': 2, 'type_': 'float'},
+                {'alias': 'position', 'source_start': 1, 'source_end': 3},
+                {'alias': 'method', 'default_value': 'M1'},
+                {'alias': 'analysis', 'default_value': '=analysis.code'},
+                ], b'sample;result\nS1;1.5\nS2;\n\nS3;3\n',
+            field_separator='semicolon', field_separator_other=None)
+
+        chunks = self._collect(compilation, 'collect_csv')
+        self.assertEqual(chunks, [[
+                    {'compilation': None, 'sample': 'S1', 'result': 1.5,
+                        'method': 'M1'},
+                    {'compilation': None, 'sample': 'S2', 'result': None,
+                        'method': 'M1'},
+                    ], [
+                    {'compilation': None, 'sample': 'S3', 'result': 3.0,
+                        'method': 'M1'},
+                    ]])
+
+    @with_transaction()
+    def test_collect_txt(self):
+        "Origin rows are collected in chunks from the fixed width columns"
+        compilation = self._get_collect_compilation([
+                {'alias': 'sample', 'source_start': 1, 'source_end': 3},
+                {'alias': 'result', 'source_start': 4, 'source_end': 8,
+                    'type_': 'float'},
+                {'alias': 'column', 'source_column': 1},
+                ], b'header\nS1 1.5\nS2\n\nS3 3')
+
+        chunks = self._collect(compilation, 'collect_txt')
+        self.assertEqual(chunks, [[
+                    {'compilation': None, 'sample': 'S1', 'result': 1.5},
+                    {'compilation': None, 'sample': 'S2', 'result': None},
+                    ], [
+                    {'compilation': None, 'sample': 'S3', 'result': 3.0},
+                    ]])
+
+    def _create_values_table(self):
+        cursor = Transaction().connection.cursor()
+        table = InterfaceTable('lims_interface_test_values')
+        cursor.execute('CREATE TABLE "' + table.name + '" ('
+            'id SERIAL PRIMARY KEY, '
+            'int_field INTEGER, '
+            'float_field DOUBLE PRECISION, '
+            'numeric_field NUMERIC(16, 4), '
+            'char_field VARCHAR, '
+            'date_field DATE, '
+            'boolean_field BOOLEAN)')
+        cursor.execute('INSERT INTO "' + table.name + '" (int_field) '
+            'VALUES (0), (0), (0) RETURNING id')
+        return table, [x[0] for x in cursor.fetchall()]
+
+    def _read_values_table(self, table, fields):
+        cursor = Transaction().connection.cursor()
+        cursor.execute('SELECT id, ' + ', '.join(fields) + ' '
+            'FROM "' + table.name + '"')
+        return {x[0]: x[1:] for x in cursor.fetchall()}
+
+    @unittest.skipIf(backend.name != 'postgresql', 'requires PostgreSQL')
+    @with_transaction()
+    def test_write_formula_values(self):
+        "Formula values of mixed types are written in bulk"
+        Data = Pool().get('lims.interface.data')
+
+        table, (id1, id2, id3) = self._create_values_table()
+        columns = Data._get_column_types(table)
+        date = datetime.date(2021, 3, 4)
+        updates = [
+            (id1, {'int_field': 1, 'float_field': 1.5,
+                'numeric_field': Decimal('1.2345'), 'char_field': 'a',
+                'date_field': date, 'boolean_field': True}),
+            (id2, {'int_field': 2, 'float_field': None,
+                'numeric_field': Decimal('2'), 'char_field': 'b',
+                'date_field': None, 'boolean_field': False}),
+            (id3, {'char_field': 'c'}),
+            ]
+        with mock.patch.object(Data,
+                '_write_formula_values_by_record') as by_record:
+            Data._write_formula_values(table, updates, columns)
+            by_record.assert_not_called()
+
+        values = self._read_values_table(table, ['int_field',
+                'float_field', 'numeric_field', 'char_field',
+                'date_field', 'boolean_field'])
+        self.assertEqual(values[id1],
+            (1, 1.5, Decimal('1.2345'), 'a', date, True))
+        self.assertEqual(values[id2],
+            (2, None, Decimal('2'), 'b', None, False))
+        self.assertEqual(values[id3], (0, None, None, 'c', None, None))
+
+    @unittest.skipIf(backend.name != 'postgresql', 'requires PostgreSQL')
+    @with_transaction()
+    def test_write_formula_values_fallback(self):
+        "A failing bulk update is written record by record"
+        Data = Pool().get('lims.interface.data')
+
+        table, (id1, id2, id3) = self._create_values_table()
+        columns = Data._get_column_types(table)
+        updates = [
+            (id1, {'int_field': 1, 'char_field': 'a'}),
+            (id2, {'int_field': 'invalid', 'char_field': 'b'}),
+            ]
+        Data._write_formula_values(table, updates, columns)
+
+        values = self._read_values_table(table,
+            ['int_field', 'char_field'])
+        self.assertEqual(values[id1], (1, 'a'))
+        self.assertEqual(values[id2], (0, 'b'))
+        self.assertEqual(values[id3], (0, None))
+
 
 def suite():
     suite = trytond.tests.test_tryton.suite()
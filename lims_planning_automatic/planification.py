@@ -1,6 +1,9 @@
 # This file is part of lims_planning_automatic module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
+import logging
+import time
+from contextlib import contextmanager
 from datetime import datetime
 
 from trytond.model import ModelSQL, ModelView, fields
@@ -8,6 +11,17 @@ from trytond.wizard import Wizard, StateTransition, StateView, Button
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval
 from trytond.transaction import Transaction
+from trytond.modules.lims.tools import id_set_clause
+
+logger = logging.getLogger(__name__)
+
+
+@contextmanager
+def planning_stage(laboratory, stage):
+    start = time.monotonic()
+    yield
+    logger.info('Automatic planning of %s: %s in %.2fs',
+        laboratory.rec_name, stage, time.monotonic() - start)
 
 
 class Planification(metaclass=PoolMeta):
@@ -18,10 +32,6 @@ class Planification(metaclass=PoolMeta):
     @classmethod
     def automatic_plan(cls, entries=None, tests=None):
         pool = Pool()
-        SearchFractions = pool.get(
-            'lims.planification.search_fractions', type='wizard')
-        SearchFractionsDetail = pool.get(
-            'lims.planification.search_fractions.detail')
         TechniciansQualification = pool.get(
             'lims.planification.technicians_qualification', type='wizard')
         try:
@@ -33,36 +43,86 @@ class Planification(metaclass=PoolMeta):
 
         for planification in cls._get_automatic_planifications(
                 entries=entries, tests=tests):
-
-            session_id, _, _ = SearchFractions.create()
-            search_fractions = SearchFractions(session_id)
-            with Transaction().set_context(active_id=planification.id):
-                search_fractions.transition_search()
-                details = SearchFractionsDetail.search([
-                    ('session_id', '=', session_id)])
-                search_fractions.next.details = details
-                search_fractions.transition_add()
-
-            cls.preplan([planification])
+            laboratory = planification.laboratory
 
             staff = [t.laboratory_professional.id
                 for t in planification.technicians]
-            for f in planification.details:
-                for s in f.details:
-                    s.staff_responsible = staff
-                    s.save()
-            planification.save()
+            with planning_stage(laboratory, 'details'):
+                cls._create_automatic_details(planification, staff)
+
+            with planning_stage(laboratory, 'preplan'):
+                cls.preplan([planification])
 
             if analysis_sheet_activated:
-                planification.load_analysis_sheets()
+                with planning_stage(laboratory, 'analysis sheets'):
+                    planification.load_analysis_sheets()
+
+            with planning_stage(laboratory, 'qualification'):
+                session_id, _, _ = TechniciansQualification.create()
+                technicians_qualification = TechniciansQualification(
+                    session_id)
+                with Transaction().set_context(active_id=planification.id):
+                    res = technicians_qualification.transition_start()
+                    while res == 'next_':
+                        res = technicians_qualification.transition_next_()
+                    technicians_qualification.transition_confirm()
+
+    @classmethod
+    def _create_automatic_details(cls, planification, staff):
+        '''
+        Adds to the planification all its plannable fractions with the
+        staff responsible of their services, without going through the
+        search fractions wizard steps
+        '''
+        pool = Pool()
+        SearchFractions = pool.get(
+            'lims.planification.search_fractions', type='wizard')
+        PlanificationDetail = pool.get('lims.planification.detail')
+
+        session_id, _, _ = SearchFractions.create()
+        search_fractions = SearchFractions(session_id)
+        data = search_fractions._get_service_details(planification,
+            lines=True)
+        SearchFractions.delete(session_id)
+
+        data = dict((k, v) for k, v in data.items() if v)
+        if not data:
+            return
 
-            session_id, _, _ = TechniciansQualification.create()
-            technicians_qualification = TechniciansQualification(session_id)
-            with Transaction().set_context(active_id=planification.id):
-                res = technicians_qualification.transition_start()
-                while res == 'next_':
-                    res = technicians_qualification.transition_next_()
-                technicians_qualification.transition_confirm()
+        urgent_services = cls._get_urgent_services(list(data.keys()))
+        to_create = []
+        for (fraction, analysis), service_details in data.items():
+            for service_detail in service_details:
+                service_detail['staff_responsible'] = [('add', staff)]
+            values = {
+                'planification': planification.id,
+                'fraction': fraction,
+                'service_analysis': analysis,
+                'details': [('create', service_details)],
+                }
+            if (fraction, analysis) in urgent_services:
+                values['urgent'] = True
+            to_create.append(values)
+        PlanificationDetail.create(to_create)
+
+    @classmethod
+    def _get_urgent_services(cls, keys):
+        '''
+        Returns the (fraction, analysis) keys whose service is urgent,
+        using the newest service of each key as Service.is_service_urgent
+        '''
+        cursor = Transaction().connection.cursor()
+        Service = Pool().get('lims.service')
+
+        keys_clause, keys_params = id_set_clause(('fraction', 'analysis'),
+            keys)
+        cursor.execute('SELECT DISTINCT ON (fraction, analysis) '
+                'fraction, analysis, urgent '
+            'FROM "' + Service._table + '" '
+            'WHERE ' + keys_clause + ' '
+            'ORDER BY fraction, analysis, number DESC, id',
+            keys_params)
+        return set((x[0], x[1]) for x in cursor.fetchall() if x[2])
 
     @classmethod
     def _get_automatic_planifications(cls, entries=None, tests=None):
@@ -159,19 +219,25 @@ class Planification(metaclass=PoolMeta):
             'AND nl.laboratory = %s '
             'AND an.behavior != \'internal_relation\' ')
 
+        sql_params = [laboratory.id]
         if entries:
-            sql_where += 'AND sa.entry IN (%s) ' % ', '.join(
-                str(e.id) for e in entries)
+            entries_clause, entries_params = id_set_clause('sa.entry',
+                [e.id for e in entries])
+            sql_where += 'AND ' + entries_clause + ' '
+            sql_params += entries_params
         if tests:
-            sql_where += 'AND fr.sample IN (%s) ' % ', '.join(
-                str(t.sample.id) for t in tests)
+            samples_clause, samples_params = id_set_clause('fr.sample',
+                [t.sample.id for t in tests])
+            sql_where += 'AND ' + samples_clause + ' '
+            sql_params += samples_params
 
         sql_order = 'ORDER BY nb.fraction ASC'
 
-        with Transaction().set_user(0):
-            cursor.execute(sql_select + sql_from + sql_where + sql_order,
-                (laboratory.id,))
-        res = cursor.fetchall()
+        with planning_stage(laboratory, 'lines'):
+            with Transaction().set_user(0):
+                cursor.execute(sql_select + sql_from + sql_where + sql_order,
+                    sql_params)
+            res = cursor.fetchall()
         if not res:
             return
 
@@ -186,18 +252,21 @@ class Planification(metaclass=PoolMeta):
         start_date = Date.today()
         professional_id = laboratory.default_laboratory_professional.id
 
-        NotebookLine.write(lines, {'start_date': start_date})
+        with planning_stage(laboratory, 'start'):
+            NotebookLine.write(lines, {'start_date': start_date})
 
-        EntryDetailAnalysis.write(details, {'state': 'planned'})
+            EntryDetailAnalysis.write(details, {'state': 'planned'})
 
-        notebook_lines_ids = ', '.join(str(nl_id) for nl_id in notebook_lines)
-        cursor.execute('DELETE FROM "' +
-            NotebookLineProfessional._table + '" '
-            'WHERE notebook_line IN (' + notebook_lines_ids + ')')
-        NotebookLineProfessional.create([{
-            'notebook_line': nl_id,
-            'professional': professional_id,
-            } for nl_id in notebook_lines])
+        with planning_stage(laboratory, 'staff'):
+            lines_clause, lines_params = id_set_clause('notebook_line',
+                notebook_lines)
+            cursor.execute('DELETE FROM "' +
+                NotebookLineProfessional._table + '" '
+                'WHERE ' + lines_clause, lines_params)
+            NotebookLineProfessional.create([{
+                'notebook_line': nl_id,
+                'professional': professional_id,
+                } for nl_id in notebook_lines])
 
         if analysis_sheet_activated:
 
@@ -206,25 +275,27 @@ class Planification(metaclass=PoolMeta):
             date_time = company_timezone.localize(datetime.combine(
                 start_date, datetime.min.time()))
 
-            analysis_sheets = {}
-            for nl in lines:
-                template_id = nl.get_analysis_sheet_template()
-                if not template_id:
-                    continue
-                key = (template_id, professional_id)
-                if key not in analysis_sheets:
-                    analysis_sheets[key] = []
-                analysis_sheets[key].append(nl)
-
-            for key, values in analysis_sheets.items():
-                sheet = AnalysisSheet()
-                sheet.template = key[0]
-                sheet.compilation = sheet.get_new_compilation(
-                    {'date_time': date_time})
-                sheet.professional = key[1]
-                sheet.laboratory = laboratory.id
-                sheet.save()
-                sheet.create_lines(values)
+            with planning_stage(laboratory, 'analysis sheets'):
+                templates = NotebookLine.get_analysis_sheet_templates(lines)
+                analysis_sheets = {}
+                for nl in lines:
+                    template_id = templates.get(nl.id)
+                    if not template_id:
+                        continue
+                    key = (template_id, professional_id)
+                    if key not in analysis_sheets:
+                        analysis_sheets[key] = []
+                    analysis_sheets[key].append(nl)
+
+                for key, values in analysis_sheets.items():
+                    sheet = AnalysisSheet()
+                    sheet.template = key[0]
+                    sheet.compilation = sheet.get_new_compilation(
+                        {'date_time': date_time})
+                    sheet.professional = key[1]
+                    sheet.laboratory = laboratory.id
+                    sheet.save()
+                    sheet.create_lines(values)
 
         return res
 
@@ -5,6 +5,14 @@
 from weasyprint import HTML, CSS
 
 
+def write_pdf(main_html, **kwargs):
+    '''
+    Returns the PDF of the document. It only takes strings, so it can be
+    run in a worker process
+    '''
+    return PdfGenerator(main_html, **kwargs).render_html().write_pdf()
+
+
 class PdfGenerator:
 
     def __init__(self, main_html, header_html=None, footer_html=None,
@@ -4,6 +4,10 @@
 import os
 import operator
 from io import BytesIO
+from threading import Lock, local
+from concurrent.futures import Future
+from contextlib import contextmanager
+from importlib import import_module
 from decimal import Decimal
 from datetime import date, datetime, timedelta
 from binascii import b2a_base64
@@ -24,12 +28,55 @@ from trytond.pool import Pool
 from trytond.pyson import Eval, Bool, Or
 from trytond.transaction import Transaction
 from trytond.cache import Cache
+from trytond.config import config
 from trytond.exceptions import UserError
 from trytond.i18n import gettext
 from trytond.tools import file_open
 from trytond import backend
 from trytond.modules.lims.configuration import get_print_date
-from .generator import PdfGenerator
+from trytond.modules.lims.tools import LRUCache, WorkerPool
+from .generator import write_pdf
+
+TEMPLATE_CACHE_SIZE = config.getint('lims_report_html',
+    'template_cache_size', default=256)
+IMAGE_CACHE_SIZE = config.getint('lims_report_html', 'image_cache_size',
+    default=256)
+# Number of worker processes that render the PDF documents, 0 renders them
+# in the thread of the request
+PDF_WORKERS = config.getint('lims_report_html', 'pdf_workers', default=0)
+
+
+class TemplateCache(LRUCache):
+    """
+    Process-wide LRU cache of the compiled code of the report templates,
+    so each template is compiled once and then only instantiated in the
+    environment of each report.
+    """
+
+    def get_template(self, env, key, source):
+        code = self.compute(key, env.compile, source)
+        return env.template_class.from_code(env, code,
+            env.make_globals(None))
+
+
+template_cache = TemplateCache(TEMPLATE_CACHE_SIZE)
+# Data URIs of the images and contents of the stylesheets of the templates
+attachment_cache = LRUCache(IMAGE_CACHE_SIZE)
+
+_pdf_workers = None
+_pdf_workers_lock = Lock()
+# Futures of the PDF documents submitted by batch_html_lims_reports
+_pending_pdfs = local()
+
+
+def get_pdf_workers():
+    "Returns the pool of PDF workers, that preload WeasyPrint"
+    global _pdf_workers
+    with _pdf_workers_lock:
+        if _pdf_workers is None:
+            _pdf_workers = WorkerPool(PDF_WORKERS,
+                initializer=import_module, initargs=(write_pdf.__module__,))
+    return _pdf_workers
 
 
 class ReportTemplate(DeactivableMixin, ModelSQL, ModelView):
@@ -418,16 +465,7 @@ class LimsReport:
 
     @classmethod
     def execute_html_lims_report(cls, ids, data):
-        pool = Pool()
-        ActionReport = pool.get('ir.action.report')
-
-        action_reports = ActionReport.search([
-            ('report_name', '=', cls.__name__),
-            ('template_extension', '=', 'lims'),
-            ])
-        assert action_reports, '%s not found' % cls
-        action = action_reports[0]
-
+        action = cls.get_html_lims_action()
         records = []
         model = action.model or data.get('model')
         if model:
@@ -438,41 +476,65 @@ class LimsReport:
         return (oext, content, action.direct_print, action.name)
 
     @classmethod
-    def _execute_html_lims_report(cls, records, data, action):
-        record = records[0]
-        template, tcontent, theader, tfooter = (
-            cls.get_lims_template(action, record))
-        context = Transaction().context
-        context['template'] = template.id
-        if not template:
-            context['default_translations'] = os.path.join(
-                os.path.dirname(__file__), 'report', 'translations')
-        with Transaction().set_context(**context):
-            content = cls.render_lims_template(action,
-                tcontent, record=record, records=records,
-                data=data)
-            header = theader and cls.render_lims_template(action,
-                theader, record=record, records=records,
-                data=data)
-            footer = tfooter and cls.render_lims_template(action,
-                tfooter, record=record, records=records,
-                data=data)
+    def get_html_lims_action(cls):
+        ActionReport = Pool().get('ir.action.report')
 
-        stylesheets = cls.parse_stylesheets(tcontent)
-        if theader:
-            stylesheets += cls.parse_stylesheets(theader)
-        if tfooter:
-            stylesheets += cls.parse_stylesheets(tfooter)
+        action_reports = ActionReport.search([
+            ('report_name', '=', cls.__name__),
+            ('template_extension', '=', 'lims'),
+            ])
+        assert action_reports, '%s not found' % cls
+        return action_reports[0]
 
-        page_orientation = (template and
-            template.page_orientation or 'portrait')
+    @classmethod
+    @contextmanager
+    def batch_html_lims_reports(cls, ids, data):
+        '''
+        Submits the PDF documents of the records to the PDF workers when
+        entering the block, where executing the report of each record
+        only waits for its document
+        '''
+        pending = getattr(_pending_pdfs, 'documents', None)
+        if pending is None:
+            pending = _pending_pdfs.documents = {}
+        keys = []
+        if PDF_WORKERS:
+            action = cls.get_html_lims_action()
+            model = action.model or data.get('model')
+            for id_, id_data in cls.get_html_lims_batch(ids, data):
+                records = cls._get_records([id_], model, id_data)
+                key = cls._get_pending_pdf_key(records, id_data)
+                pending[key] = cls._submit_html_lims_pdf(records, id_data,
+                    action)
+                keys.append(key)
+        try:
+            yield
+        finally:
+            for key in keys:
+                pending.pop(key, None)
 
-        document = PdfGenerator(content,
-            header_html=header, footer_html=footer,
-            side_margin=1, extra_vertical_margin=30,
-            stylesheets=stylesheets,
-            page_orientation=page_orientation).render_html().write_pdf()
+    @classmethod
+    def get_html_lims_batch(cls, ids, data):
+        '''
+        Returns the (id, data) of the records of the batch whose report
+        is rendered from an HTML template
+        '''
+        return [(id_, data) for id_ in ids]
+
+    @classmethod
+    def _get_pending_pdf_key(cls, records, data):
+        return (cls.__name__, records[0].id, data.get('alt_lang'))
 
+    @classmethod
+    def _execute_html_lims_report(cls, records, data, action):
+        record = records[0]
+        pending = getattr(_pending_pdfs, 'documents', {})
+        document = pending.pop(cls._get_pending_pdf_key(records, data), None)
+        if document is None:
+            document = cls._submit_html_lims_pdf(records, data, action)
+        document = document.result()
+
+        template = action.lims_template or record.template
         previous_sections = []
         if hasattr(record, 'previous_sections'):
             previous_sections = record.previous_sections
@@ -504,6 +566,50 @@ class LimsReport:
 
         return 'pdf', document
 
+    @classmethod
+    def _submit_html_lims_pdf(cls, records, data, action):
+        '''
+        Renders the HTML of the report and returns the future of its PDF
+        document
+        '''
+        record = records[0]
+        template, tcontent, theader, tfooter = (
+            cls.get_lims_template(action, record))
+        kcontent, kheader, kfooter = cls.get_lims_template_keys(action,
+            template)
+        context = Transaction().context
+        context['template'] = template.id
+        if not template:
+            context['default_translations'] = os.path.join(
+                os.path.dirname(__file__), 'report', 'translations')
+        with Transaction().set_context(**context):
+            with Transaction().set_context(locale=cls.get_lims_locale(data)):
+                env = cls.get_lims_environment()
+            content = cls.render_lims_template(action,
+                tcontent, record=record, records=records,
+                data=data, env=env, template_key=kcontent)
+            header = theader and cls.render_lims_template(action,
+                theader, record=record, records=records,
+                data=data, env=env, template_key=kheader)
+            footer = tfooter and cls.render_lims_template(action,
+                tfooter, record=record, records=records,
+                data=data, env=env, template_key=kfooter)
+
+        stylesheets = cls.parse_stylesheets(tcontent)
+        if theader:
+            stylesheets += cls.parse_stylesheets(theader)
+        if tfooter:
+            stylesheets += cls.parse_stylesheets(tfooter)
+
+        page_orientation = (template and
+            template.page_orientation or 'portrait')
+
+        return cls.submit_lims_pdf(content,
+            header_html=header, footer_html=footer,
+            side_margin=1, extra_vertical_margin=30,
+            stylesheets=stylesheets,
+            page_orientation=page_orientation)
+
     @classmethod
     def get_lims_template(cls, action, record):
         template, content, header, footer = None, None, None, None
@@ -524,22 +630,62 @@ class LimsReport:
         return template, content, header, footer
 
     @classmethod
-    def render_lims_template(cls, action, template_string,
-            record=None, records=None, data=None):
+    def get_lims_template_keys(cls, action, template):
+        '''
+        Returns the keys of the compiled content, header and footer in the
+        templates cache, they change when the templates are modified
+        '''
+        def key(part, record):
+            return (cls.__name__, part, record.__name__, record.id,
+                record.write_date or record.create_date)
+
+        if not template:
+            return key('content', action), None, None
+        return (key('content', template),
+            template.header and key('header', template.header),
+            template.footer and key('footer', template.footer))
+
+    @classmethod
+    def get_lims_locale(cls, data=None):
         User = Pool().get('res.user')
         user = User(Transaction().user)
 
         if data and data.get('alt_lang'):
-            locale = data['alt_lang']
+            return data['alt_lang']
         elif user.language:
-            locale = user.language.code
-        else:
-            locale = Transaction().language
-        with Transaction().set_context(locale=locale):
-            env = cls.get_lims_environment()
+            return user.language.code
+        return Transaction().language
+
+    @classmethod
+    def write_lims_pdf(cls, main_html, **kwargs):
+        return cls.submit_lims_pdf(main_html, **kwargs).result()
+
+    @classmethod
+    def submit_lims_pdf(cls, main_html, **kwargs):
+        '''
+        Returns the future of the PDF document, rendered by the PDF workers
+        when there are
+        '''
+        if PDF_WORKERS:
+            return get_pdf_workers().submit(write_pdf, main_html, **kwargs)
+        future = Future()
+        future.set_result(write_pdf(main_html, **kwargs))
+        return future
+
+    @classmethod
+    def render_lims_template(cls, action, template_string,
+            record=None, records=None, data=None, env=None,
+            template_key=None):
+        if env is None:
+            with Transaction().set_context(locale=cls.get_lims_locale(data)):
+                env = cls.get_lims_environment()
 
         header = {}
-        report_template = env.from_string(template_string)
+        if template_key:
+            report_template = template_cache.get_template(env,
+                template_key, template_string)
+        else:
+            report_template = env.from_string(template_string)
         context = cls.get_context(records, header, data=data)
         context.update({
             'report': action,
@@ -679,14 +825,16 @@ class LimsReport:
 
     @classmethod
     def parse_images(cls, template_string):
-        Attachment = Pool().get('ir.attachment')
         root = lxml_html.fromstring(template_string)
+        images = cls.get_attachments_data(
+            [int(elem.attrib['id']) for elem in root.iter('img')
+                if 'id' in elem.attrib], cls.get_image)
         for elem in root.iter('img'):
             # get image from attachments
             if 'id' in elem.attrib:
-                img = Attachment.search([('id', '=', int(elem.attrib['id']))])
-                if img:
-                    elem.attrib['src'] = cls.get_image(img[0].data)
+                image = images.get(int(elem.attrib['id']))
+                if image is not None:
+                    elem.attrib['src'] = image
             # get image from TinyMCE widget
             elif 'data-mce-src' in elem.attrib:
                 elem.attrib['src'] = elem.attrib['data-mce-src']
@@ -700,6 +848,28 @@ class LimsReport:
             elem.attrib['style'] = style
         return lxml_html.tostring(root).decode()
 
+    @classmethod
+    def get_attachments_data(cls, attachment_ids, convert=None):
+        '''
+        Returns a dict with the data of the attachments, converted with
+        convert if given. The results are cached until the attachments
+        are modified
+        '''
+        Attachment = Pool().get('ir.attachment')
+
+        if not attachment_ids:
+            return {}
+        res = {}
+        for attachment in Attachment.search([
+                ('id', 'in', list(set(attachment_ids))),
+                ]):
+            key = (attachment.id, convert and convert.__name__,
+                attachment.write_date or attachment.create_date)
+            res[attachment.id] = attachment_cache.compute(key,
+                lambda a: convert(a.data) if convert else a.data or b'',
+                attachment)
+        return res
+
     @classmethod
     def get_image(cls, image):
         if not image:
@@ -713,17 +883,12 @@ class LimsReport:
 
     @classmethod
     def parse_stylesheets(cls, template_string):
-        Attachment = Pool().get('ir.attachment')
         root = lxml_html.fromstring(template_string)
-        res = []
         # get stylesheets from attachments
         elems = root.xpath("//div[@id='tryton_styles_container']/div")
-        for elem in elems:
-            css = Attachment.search([('id', '=', int(elem.attrib['id']))])
-            if not css:
-                continue
-            res.append(css[0].data)
-        return res
+        attachment_ids = [int(elem.attrib['id']) for elem in elems]
+        stylesheets = cls.get_attachments_data(attachment_ids)
+        return [stylesheets[i] for i in attachment_ids if i in stylesheets]
 
 
 class TemplateTranslations:
@@ -127,6 +127,13 @@ class ResultsReportVersionDetail(metaclass=PoolMeta):
             return
         cls.write(sections, {'sections': value})
 
+    @classmethod
+    def generate_reports(cls, details):
+        ResultReport = Pool().get('lims.result_report', type='report')
+        with ResultReport.batch_html_lims_reports([d.id for d in details],
+                {'save_cache': True}):
+            super().generate_reports(details)
+
     @classmethod
     def _get_fields_from_samples(cls, samples, generate_report_form=None):
         pool = Pool()
@@ -532,6 +539,32 @@ class ResultsReportVersionDetailSample(metaclass=PoolMeta):
 class ResultReport(LimsReport, metaclass=PoolMeta):
     __name__ = 'lims.result_report'
 
+    @classmethod
+    def get_html_lims_batch(cls, ids, data):
+        pool = Pool()
+        ResultsDetail = pool.get('lims.results_report.version.detail')
+        CachedReport = pool.get('lims.results_report.cached_report')
+
+        batch = []
+        for results_report in ResultsDetail.browse(ids):
+            template = results_report.template
+            if (results_report.state == 'annulled'
+                    or not template or template.type != 'base'):
+                continue
+            if CachedReport.search([
+                    ('version_detail', '=', results_report.id),
+                    ('report_language', '=',
+                        results_report.report_language.id),
+                    ['OR',
+                        ('report_cache', '!=', None),
+                        ('report_cache_id', '!=', None)],
+                    ], limit=1):
+                continue
+            current_data = data.copy()
+            current_data['alt_lang'] = results_report.report_language.code
+            batch.append((results_report.id, current_data))
+        return batch
+
     @classmethod
     def execute(cls, ids, data):
         pool = Pool()
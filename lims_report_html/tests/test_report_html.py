@@ -2,6 +2,9 @@
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
 import unittest
+from concurrent.futures import Future
+from types import SimpleNamespace
+from unittest import mock
 
 import trytond.tests.test_tryton
 from trytond.tests.test_tryton import ModuleTestCase
@@ -11,6 +14,58 @@ class LimsTestCase(ModuleTestCase):
     'Test lims_report_html module'
     module = 'lims_report_html'
 
+    def test_template_cache(self):
+        "Templates are compiled once per key and evicted by count"
+        from jinja2 import Environment
+        from trytond.modules.lims_report_html.html_template import (
+            TemplateCache)
+
+        env = Environment()
+        cache = TemplateCache(1)
+        template = cache.get_template(env, 'a', 'Hello {{ name }}')
+        self.assertEqual(template.render(name='x'), 'Hello x')
+        template = cache.get_template(env, 'a', 'Bye {{ name }}')
+        self.assertEqual(template.render(name='x'), 'Hello x')
+
+        cache.get_template(env, 'b', '')
+        template = cache.get_template(env, 'a', 'Bye {{ name }}')
+        self.assertEqual(template.render(name='x'), 'Bye x')
+
+    def test_batch_html_lims_reports(self):
+        "The PDF documents of a batch are submitted before they are used"
+        from trytond.modules.lims_report_html.html_template import LimsReport
+
+        def submit(records, data, action):
+            future = Future()
+            future.set_result(b'%d' % records[0].id)
+            submitted.append(records[0].id)
+            return future
+
+        def get_records(ids, model, data):
+            return [SimpleNamespace(id=i, template=None,
+                    previous_sections=[], following_sections=[])
+                for i in ids]
+
+        submitted = []
+        action = SimpleNamespace(model='model', lims_template=None)
+        with mock.patch('trytond.modules.lims_report_html.html_template.'
+                'PDF_WORKERS', 2), \
+                mock.patch.object(LimsReport, 'get_html_lims_action',
+                    return_value=action), \
+                mock.patch.object(LimsReport, '_get_records', get_records), \
+                mock.patch.object(LimsReport, '_submit_html_lims_pdf',
+                    side_effect=submit):
+            with LimsReport.batch_html_lims_reports([1, 2], {}):
+                self.assertEqual(submitted, [1, 2])
+                for id_ in [2, 1]:
+                    self.assertEqual(LimsReport._execute_html_lims_report(
+                            get_records([id_], None, {}), {}, action),
+                        ('pdf', b'%d' % id_))
+                self.assertEqual(submitted, [1, 2])
+            LimsReport._execute_html_lims_report(get_records([1], None, {}),
+                {}, action)
+            self.assertEqual(submitted, [1, 2, 1])
+
 
 def suite():
     suite = trytond.tests.test_tryton.suite()